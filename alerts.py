@@ -0,0 +1,329 @@
+import datetime
+import re
+import threading
+from collections import deque
+from typing import NamedTuple
+
+from db_pool import adapt_query, dialect_of
+from watermark import Watermark
+
+#flagged-vehicle watchlist and alert engine
+
+TABLE = "policedb.logs"
+BATCH = 50000
+
+_PLATE_JUNK = re.compile(r"[^0-9A-Z*?]")
+_WILDCARDS = re.compile(r"[*?]+")
+
+# column sizes of the watchlist table
+MAX_PATTERN = 50
+MAX_REASON = 255
+
+REPEAT_OFFENDERS = ("SELECT vehicle_number, drug_stops, typed_searches FROM policedb.rollup_vehicle "
+                    "WHERE drug_stops >= %s OR typed_searches >= %s")
+
+# every flag/unflag moves the version in the same transaction, engines in other processes reload on a change;
+# the row count also catches rows written without it
+BUMP_VERSION = "UPDATE policedb.watchlist_state SET version = version + 1 WHERE name = 'watchlist'"
+FIRST_VERSION = "INSERT INTO policedb.watchlist_state (name, version) VALUES ('watchlist', 1)"
+WATCHLIST_VERSION = ("SELECT (SELECT COALESCE(MAX(version), 0) FROM policedb.watchlist_state), "
+                     "(SELECT COUNT(*) FROM policedb.watchlist)")
+
+
+def execute(pool, query, params=(), bump_version=False):
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(adapt_query(query, dialect_of(conn)), params)
+        if bump_version:
+            cursor.execute(BUMP_VERSION)
+            if cursor.rowcount == 0:
+                cursor.execute(FIRST_VERSION)
+        conn.commit()
+
+
+def read_version(pool):
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(WATCHLIST_VERSION)
+        return tuple(cursor.fetchone())
+
+
+class Hit(NamedTuple):
+    vehicle_number: str
+    pattern: str
+    reason: str
+    log_id: object
+    seen_at: datetime.datetime
+
+
+def normalize_plate(plate):
+    # 'tn-01 ab 1234' and 'TN01AB1234' are the same plate
+    return _PLATE_JUNK.sub("", str(plate).upper())
+
+
+#multi-pattern matcher (Aho-Corasick over the literal part of each pattern)
+
+class _Automaton:
+
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for index, word in enumerate(keywords):
+            node = 0
+            for char in word:
+                if char not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[node][char] = len(self._goto) - 1
+                node = self._goto[node][char]
+            self._out[node].append(index)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def search(self, text):
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            found.update(self._out[node])
+        return found
+
+
+class Watchlist:
+
+    def __init__(self):
+        self._exact = {}
+        self._patterns = {}
+        self._matcher = None
+        self._keyed = []
+        self._unkeyed = []
+
+    def __len__(self):
+        return len(self._exact) + len(self._patterns)
+
+    @staticmethod
+    def check(pattern, reason=""):
+        # the normalised pattern, ValueError for one the watchlist table can't hold
+        pattern = normalize_plate(pattern)
+        if not pattern:
+            raise ValueError("the pattern has no letters, digits or wildcards to match plates with")
+        if len(pattern) > MAX_PATTERN:
+            raise ValueError(f"the pattern is longer than {MAX_PATTERN} characters")
+        if len(reason or "") > MAX_REASON:
+            raise ValueError(f"the reason is longer than {MAX_REASON} characters")
+        return pattern
+
+    def add(self, pattern, reason=""):
+        # plain plates go in a hash set, '*' / '?' patterns go through the matcher
+        pattern = self.check(pattern, reason)
+        if _WILDCARDS.search(pattern):
+            regex = re.compile("".join(".*" if c == "*" else "." if c == "?" else c for c in pattern) + r"\Z")
+            self._patterns[pattern] = (regex, reason)
+            self._matcher = None
+        else:
+            self._exact[pattern] = reason
+        return pattern
+
+    def remove(self, pattern):
+        pattern = normalize_plate(pattern)
+        self._exact.pop(pattern, None)
+        if self._patterns.pop(pattern, None) is not None:
+            self._matcher = None
+
+    def _build(self):
+        # each pattern is keyed by its longest literal run, candidates are confirmed by regex
+        self._keyed = []
+        self._unkeyed = []
+        keywords = []
+        for pattern in self._patterns:
+            literal = max(_WILDCARDS.split(pattern), key=len)
+            if literal:
+                keywords.append(literal)
+                self._keyed.append(pattern)
+            else:
+                self._unkeyed.append(pattern)
+        self._matcher = _Automaton(keywords)
+
+    def match(self, plate):
+        plate = normalize_plate(plate)
+        matches = []
+        if plate in self._exact:
+            matches.append((plate, self._exact[plate]))
+        if self._patterns:
+            if self._matcher is None:
+                self._build()
+            candidates = [self._keyed[i] for i in self._matcher.search(plate)] + self._unkeyed
+            for pattern in candidates:
+                regex, reason = self._patterns[pattern]
+                if regex.match(plate):
+                    matches.append((pattern, reason))
+        return matches
+
+    def entries(self):
+        return [(p, r, "plate") for p, r in self._exact.items()] + \
+               [(p, r, "pattern") for p, (_, r) in self._patterns.items()]
+
+
+class AlertEngine:
+
+    def __init__(self, pool, max_hits=500):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._watchlist = Watchlist()
+        self._hits = deque(maxlen=max_hits)
+        self._watermark = None
+        self._version = None
+        self._scan_lock = threading.Lock()
+
+    #persistence
+
+    def _execute(self, query, params=(), bump_version=False):
+        execute(self.pool, query, params, bump_version)
+
+    def _read_version(self):
+        return read_version(self.pool)
+
+    def ensure_tables(self):
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS policedb.watchlist ("
+            f"pattern VARCHAR({MAX_PATTERN}) PRIMARY KEY, reason VARCHAR({MAX_REASON}), source VARCHAR(20) NOT NULL)"
+        )
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS policedb.watchlist_state ("
+            "name VARCHAR(50) PRIMARY KEY, version INT NOT NULL)"
+        )
+
+    def _read_watchlist(self, pool):
+        # (pattern, reason) rows, and the id watermark to scan from
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT pattern, reason FROM policedb.watchlist")
+            rows = cursor.fetchall()
+            # only stops logged from now on raise alerts
+            cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE}")
+            return rows, Watermark(cursor.fetchone()[0])
+
+    def load(self, version=None):
+        # the version is read first, a change made while the rows are read is picked up next time
+        version = self._read_version() if version is None else version
+        rows, watermark = self._read_watchlist(self.pool)
+        if self._watermark is None:
+            self._watermark = watermark
+        self._set_watchlist(rows)
+        self._version = version
+
+    def _reload_if_changed(self):
+        # flags added or removed by another process (the API server, another dashboard)
+        version = self._read_version()
+        if version != self._version:
+            self.load(version)
+
+    def _set_watchlist(self, rows):
+        watchlist = Watchlist()
+        for pattern, reason in rows:
+            watchlist.add(pattern, reason or "")
+        with self._lock:
+            self._watchlist = watchlist
+
+    def flag(self, pattern, reason="", source="manual"):
+        # stored first, so a refused write never leaves a flag that only this process knows
+        pattern = Watchlist.check(pattern, reason)
+        self._execute("REPLACE INTO policedb.watchlist (pattern, reason, source) VALUES (%s, %s, %s)",
+                      (pattern, reason, source), bump_version=True)
+        with self._lock:
+            self._watchlist.add(pattern, reason)
+        return pattern
+
+    def unflag(self, pattern):
+        pattern = normalize_plate(pattern)
+        self._execute("DELETE FROM policedb.watchlist WHERE pattern = %s", (pattern,), bump_version=True)
+        with self._lock:
+            self._watchlist.remove(pattern)
+
+    def _offenders(self, min_drug_stops, min_searches):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(adapt_query(REPEAT_OFFENDERS, dialect_of(conn)), (min_drug_stops, min_searches))
+            return cursor.fetchall()
+
+    def promote_repeat_offenders(self, min_drug_stops=2, min_searches=3):
+        # read from the vehicle rollup, so promotion never scans the raw logs
+        promoted = []
+        for plate, drug_stops, searches in self._offenders(min_drug_stops, min_searches):
+            if not plate or self.match(plate):
+                continue
+            reason = f"repeat offender: {int(drug_stops)} drug-related stops, {int(searches)} searches"
+            promoted.append(self.flag(plate, reason, source="auto"))
+        return promoted
+
+    #checking
+
+    def match(self, vehicle_number):
+        with self._lock:
+            return self._watchlist.match(vehicle_number)
+
+    def scan_new(self):
+        # checks only stops past the id watermark, whoever wrote them (Add Logs, ingest, other servers),
+        # and the ones that committed late below it
+        with self._scan_lock:
+            if self._watermark is None:
+                self.load()
+            else:
+                self._reload_if_changed()
+            hits = self._scan(self.pool, self._watermark)
+            with self._lock:
+                self._hits.extend(hits)
+            return hits
+
+    def _scan(self, pool, watermark, source=None):
+        # source names the database when log ids of several are reported side by side
+        hits = []
+
+        def check(rows):
+            for log_id, plate in rows:
+                if not plate:
+                    continue
+                for pattern, reason in self.match(plate):
+                    hits.append(Hit(plate, pattern, reason, log_id if source is None else f"{source}:{log_id}",
+                                    datetime.datetime.now()))
+
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            dialect = dialect_of(conn)
+            gaps = watermark.gap_filter()
+            if gaps is not None:
+                cursor.execute(adapt_query(
+                    f"SELECT id, vehicle_number FROM {TABLE} WHERE {gaps[0]} ORDER BY id", dialect), gaps[1])
+                rows = cursor.fetchall()
+                check(rows)
+                watermark.fill([row[0] for row in rows])
+            query = adapt_query(
+                f"SELECT id, vehicle_number FROM {TABLE} WHERE id > %s ORDER BY id LIMIT {BATCH}", dialect)
+            while True:
+                cursor.execute(query, (watermark.last_id,))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                check(rows)
+                watermark.advance_to([row[0] for row in rows], rows[-1][0])
+        return hits
+
+    def recent_hits(self, limit=50):
+        with self._lock:
+            return list(self._hits)[-limit:][::-1]
+
+    def watchlist(self):
+        with self._lock:
+            return self._watchlist.entries()
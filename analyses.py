@@ -0,0 +1,157 @@
+#raw SQL for the View logs insights (the rollup versions live in rollups.py)
+
+QUERY_MAP = {
+    "Top 10 vehicle_Number involved in Drug-Related Stops": """ SELECT VEHICLE_NUMBER,COUNT(*) AS TOTAL_STOPS
+                                                                FROM POLICEDB.LOGS
+                                                                WHERE DRUGS_RELATED_STOP
+                                                                GROUP BY VEHICLE_NUMBER
+                                                                LIMIT 10; """,
+    "Most Frequently Searched Vehicles": """ SELECT VEHICLE_NUMBER,COUNT(*) AS TOTAL_SEARCHS
+                                             FROM POLICEDB.LOGS
+                                             WHERE SEARCH_TYPE != "NO SEARCH"
+                                             GROUP BY VEHICLE_NUMBER
+                                             ORDER BY  VEHICLE_NUMBER DESC
+                                             LIMIT 10; """,
+    "Driver Age Group with Highest Arrest Rate": """ SELECT
+                                                        CASE
+                                                           WHEN driver_age < 18 THEN 'Under 18'
+                                                           WHEN driver_age BETWEEN 18 AND 25 THEN '18-25'
+                                                           WHEN driver_age BETWEEN 26 AND 40 THEN '26-40'
+                                                           WHEN driver_age BETWEEN 41 AND 60 THEN '41-60'
+                                                           ELSE '60+'
+                                                        END AS age_group,
+                                                        COUNT(*) AS arrest_count
+                                                        FROM POLICEDB.LOGS
+                                                        WHERE stop_outcome = 'Arrest'
+                                                        GROUP BY age_group
+                                                        ORDER BY arrest_count DESC; """,
+    "Gender Distribution of Drivers Stopped in each Country": """ SELECT COUNTRY_NAME,DRIVER_GENDER,COUNT(*) AS COUNT
+                                                                  FROM POLICEDB.LOGS
+                                                                  GROUP BY COUNTRY_NAME,DRIVER_GENDER
+                                                                  ORDER BY COUNTRY_NAME; """,
+    "Race & Gender Combination with Highest Search Rate": """SELECT DRIVER_RACE,DRIVER_GENDER,COUNT(*) AS STOP_COUNT
+                                                             FROM POLICEDB.LOGS
+                                                             WHERE SEARCH_TYPE != "No Search"
+                                                             GROUP BY DRIVER_RACE,DRIVER_GENDER
+                                                             ORDER BY STOP_COUNT DESC;
+                                                             LIMIT 1; """,
+    "Time of Day with Most Traffic Stops": """SELECT HOUR(STOP_TIME) AS STOP_HOUR,COUNT(*) AS COUNT
+                                             FROM POLICEDB.LOGS
+                                             GROUP BY STOP_HOUR
+                                             ORDER BY COUNT DESC; """,
+    "Average Stop Duration for different Violations": """SELECT VIOLATION,AVG(STOP_DURATION) AS AVG_STOP_DURATION
+                                                         FROM POLICEDB.LOGS
+                                                         GROUP BY VIOLATION
+                                                         ORDER BY AVG_STOP_DURATION DESC; """,
+    "Night Stops More Likely to Lead to Arrests": """SELECT 
+	                                                     CASE 
+		                                                     WHEN HOUR(STOP_TIME) BETWEEN 20 AND 23 
+                                                         OR HOUR(STOP_TIME) BETWEEN 0 AND 5 THEN 'NIGHT'
+		                                                     ELSE 'DAY'
+		                                                     END AS TIME_OF_THE_DAY, 
+                                                         COUNT(*) AS STOP_COUNTS,
+                                                         SUM(CASE WHEN IS_ARRESTED = 1 THEN  1 ELSE 0 END) AS TOTAL_ARREST,
+		                                                     ROUND(SUM(CASE WHEN IS_ARRESTED = 1 THEN  1 ELSE 0 END) * 100.0/COUNT(*),2) AS TOTAL_ARREST_PERCENTAGE
+                                                     FROM POLICEDB.LOGS
+                                                     GROUP BY TIME_OF_THE_DAY
+                                                     ORDER BY TOTAL_ARREST_PERCENTAGE DESC; """,
+    "Violations Most Associated with Searches or Arrests": """SELECT VIOLATION,SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) AS TOTAL_ARRESTED,
+                                                              SUM(CASE WHEN SEARCH_CONDUCTED = 1 THEN 1 ELSE 0 END) AS TOTAL_SEARCH_CONDUCTED,
+                                                              SUM(CASE WHEN IS_ARRESTED = 1 OR SEARCH_CONDUCTED = 1 THEN 1 ELSE 0 END) AS SEARCH_OR_ARREST
+                                                              FROM POLICEDB.LOGS
+                                                              GROUP BY VIOLATION
+                                                              ORDER BY SEARCH_OR_ARREST DESC """,
+    "Most Common Violations for Young Drivers Under 25":""" SELECT violation, COUNT(*) AS count
+                                                            FROM traffic_stops
+                                                            WHERE driver_age < 25
+                                                            GROUP BY violation
+                                                            ORDER BY count DESC; """,
+    "Violation Rarely Resulting in Search or Arrest":""" SELECT VIOLATION,
+                                                         SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) AS TOTAL_ARRESTED,
+                                                         SUM(CASE WHEN SEARCH_CONDUCTED = 1 THEN 1 ELSE 0 END) AS TOTAL_SEARCH_CONDUCTED,
+                                                         SUM(CASE WHEN IS_ARRESTED = 1 OR SEARCH_CONDUCTED = 1 THEN 1 ELSE 0 END) AS SEARCH_OR_ARREST
+                                                         FROM POLICEDB.LOGS
+                                                         GROUP BY VIOLATION
+                                                         ORDER BY SEARCH_OR_ARREST 
+                                                         LIMIT 1; """,
+    "Countries Report with Highest Drug-Related Stop Rates": """ SELECT COUNTRY_NAME,
+                                                                 SUM(CASE WHEN DRUGS_RELATED_STOP =1 THEN 1 ELSE 0 END) AS DRUG_RELATED_STOPS,
+                                                                 ROUND(SUM(CASE WHEN DRUGS_RELATED_STOP =1 THEN 1 ELSE 0 END)*100.0/COUNT(*),2) AS PERCENTAGE_OF_DRUG_RELATED_STOPS
+                                                                 FROM POLICEDB.LOGS
+                                                                 GROUP BY COUNTRY_NAME
+                                                                 ORDER BY PERCENTAGE_OF_DRUG_RELATED_STOPS; """,
+    "Arrest Rate by Country & Violation":"""SELECT COUNTRY_NAME,
+                                            VIOLATION,
+                                            ROUND(SUM(CASE WHEN IS_ARRESTED=1 THEN 1 ELSE 0 END)*100.0/COUNT(*),2) AS ARREST_RATE
+                                            FROM POLICEDB.LOGS
+                                            GROUP BY COUNTRY_NAME,VIOLATION
+                                            ORDER BY COUNTRY_NAME; """,
+    "Country has the Most Stops with Search Conducted": """ SELECT COUNTRY_NAME,COUNT(*)AS COUNT
+                                                            FROM POLICEDB.LOGS
+                                                            WHERE SEARCH_CONDUCTED=1
+                                                            GROUP BY COUNTRY_NAME
+                                                            ORDER BY COUNT DESC
+                                                            LIMIT 1; """,
+    "Yearly Breakdown of Stops and Arrests by Country": """ SELECT COUNTRY_NAME,STOP_YEAR,TOTAL_STOP,TOTAL_ARREST,
+                                                            ROUND(TOTAL_ARREST * 100.0 / TOTAL_STOP,2),
+                                                            RANK() OVER(PARTITION BY STOP_YEAR ORDER BY TOTAL_ARREST DESC) AS ARREST_RANK_IN_YEAR
+                                                            FROM
+                                                            (SELECT COUNTRY_NAME,YEAR(STOP_TIME) AS STOP_YEAR,COUNT(*) AS TOTAL_STOP,
+                                                             SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) AS TOTAL_ARREST
+                                                             FROM POLICEDB.LOGS
+                                                             GROUP BY COUNTRY_NAME,STOP_YEAR
+                                                             ORDER BY STOP_YEAR
+                                                            ) AS YEARLY_STATS;""",
+    "Driver Violation Trends by Age & Race": """ SELECT DRIVER_RACE,VIOLATION,AGE_GROUP,COUNT(*) AS STOP_COUNT 
+                                                  FROM
+                                                  (SELECT DRIVER_RACE,VIOLATION,
+                                                  CASE
+	                                                  WHEN DRIVER_AGE < 18 THEN 'UNDER 18'
+                                                  WHEN DRIVER_AGE BETWEEN 18 AND 25 THEN '18-25'
+	                                                  WHEN DRIVER_AGE BETWEEN 26 AND 40 THEN '26-40'
+	                                                  WHEN DRIVER_AGE BETWEEN 41 AND 60 THEN '41-60'
+	                                                  ELSE'ABOVE 60'
+                                                  END AS AGE_GROUP
+                                                  FROM POLICEDB.LOGS) AS SUB
+                                                GROUP BY DRIVER_RACE,VIOLATION,AGE_GROUP
+                                                ORDER BY STOP_COUNT DESC;""",
+    "Time Period Analysis of Stops, Number of Stops by Year, Month, Hour of the Day": """ SELECT EXTRACT(YEAR FROM STOP_DATE) AS YEAR,
+                                                                                          EXTRACT(MONTH FROM STOP_DATE) AS MONTH,
+                                                                                          EXTRACT(HOUR FROM STOP_TIME) AS HOUR,
+                                                                                          COUNT(*) AS TOTAL_STOPS
+                                                                                          FROM POLICEDB.LOGS
+                                                                                          GROUP BY YEAR,MONTH,HOUR
+                                                                                          ORDER BY YEAR;""",
+    "Violations with High Search & Arrest Rates":"""SELECT VIOLATION,TOTAL_STOP,TOTAL_ARREST,TOTAL_SEARCH,
+                                                    ROUND(100*(TOTAL_ARREST/ TOTAL_STOP), 2) AS ARREST_RATE,
+                                                    ROUND(100*(TOTAL_SEARCH / TOTAL_STOP), 2) AS SEARCH_RATE,
+                                                    RANK() OVER (ORDER BY (TOTAL_ARREST * 1.0 / TOTAL_STOP) DESC) AS ARREST_RANK,
+                                                    RANK() OVER (ORDER BY (TOTAL_SEARCH * 1.0 / TOTAL_STOP) DESC) AS SEARCH_RANK
+                                                    FROM (
+                                                    SELECT VIOLATION,COUNT(*) AS TOTAL_STOP,
+                                                    SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) AS TOTAL_ARREST,
+                                                    SUM(CASE WHEN SEARCH_CONDUCTED = 1 THEN 1 ELSE 0 END) AS TOTAL_SEARCH
+                                                    FROM POLICEDB.LOGS
+                                                    GROUP BY VIOLATION;) AS LOGS
+                                                    ORDER BY ARREST_RANK ASC,SEARCH_RANK ASC;""",
+    "Driver Demographics by Country (Age, Gender and Race)":""" SELECT 
+                                                                COUNTRY_NAME,CASE
+                                                                WHEN DRIVER_AGE < 18 THEN 'UNDER 18'
+                                                                WHEN DRIVER_AGE BETWEEN 18 AND 25 THEN '18-25'
+                                                                WHEN DRIVER_AGE BETWEEN 26 AND 40 THEN '26-40'
+                                                                WHEN DRIVER_AGE BETWEEN 41 AND 60 THEN '41-60'
+                                                                ELSE'ABOVE 60'
+                                                                END AS AGE_GROUP,
+                                                                DRIVER_GENDER,DRIVER_RACE,COUNT(*)AS TOTAL_COUNT
+                                                                FROM POLICEDB.LOGS
+                                                                GROUP BY COUNTRY_NAME,AGE_GROUP,DRIVER_GENDER,DRIVER_RACE
+                                                                ORDER BY COUNTRY_NAME,AGE_GROUP,DRIVER_GENDER,DRIVER_RACE;""",
+    "Top 5 Violations with Highest Arrest Rates":""" SELECT VIOLATION,TOTAL_ARREST,ARREST_RATE
+                                                     FROM (
+                                                     SELECT VIOLATION,COUNT(*) AS TOTAL_STOP,SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) AS TOTAL_ARREST,
+                                                     ROUND(100.0 * SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) / COUNT(*), 4) AS ARREST_RATE
+                                                     FROM POLICEDB.LOGS
+                                                     GROUP BY VIOLATION
+                                                     ) AS ARREST_LOGS
+                                                    ORDER BY ARREST_RATE DESC;"""   
+}
@@ -0,0 +1,462 @@
+import math
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from db_pool import adapt_query, dialect_of, sqlite_factory
+from predictor import normalize_time
+from rollups import CUBES, DURATION_NUMBER, create_sql
+from schema import LOG_COLUMNS
+from watermark import Watermark, between, read_runs
+
+#approximate previews of the View logs insights from a maintained sample and sketches
+
+TABLE = "policedb.logs"
+BATCH = 50000
+Z_95 = 1.96
+# previews reuse cubes this old after new stops arrive, a rebuild costs a few seconds
+REBUILD_INTERVAL = 60.0
+# ids are ordered by MOD(MOD(id, M) * A + B, M) to draw the first sample in SQL, M is 2^31 - 1
+HASH_MODULUS = 2147483647
+
+_CUBE_NAMES = re.compile(r"policedb\.(rollup_\w+)")
+
+
+def estimable(query):
+    # the vehicle cube only holds the count-min heavy hitters, an answer ordered by plate needs every plate
+    cubes = _CUBE_NAMES.findall(query)
+    return bool(cubes) and not ("rollup_vehicle" in cubes and re.search(r"ORDER BY\s+vehicle_number", query, re.I))
+
+
+#sketches
+
+def _hash(values, key="0123456789abcdef"):
+    # stable 64-bit hashes, the same plate hashes the same way in every process
+    return pd.util.hash_array(np.asarray(values, dtype=object), hash_key=key)
+
+
+class HyperLogLog:
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self._registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, values):
+        hashes = _hash(values)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - self.precision)) - 1)
+        # rank = position of the first set bit in the remaining 64 - p bits
+        bits = np.frexp(rest.astype(np.float64))[1]
+        rank = (64 - self.precision - bits + 1).astype(np.uint8)
+        np.maximum.at(self._registers, index, rank)
+
+    def estimate(self):
+        m = len(self._registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.power(2.0, -self._registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self._registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)
+        return float(raw)
+
+    def margin(self):
+        # 95% relative error is 1.96 * 1.04 / sqrt(m)
+        return Z_95 * 1.04 / math.sqrt(len(self._registers)) * self.estimate()
+
+
+class CountMinTopK:
+
+    def __init__(self, width=4096, depth=4, k=100):
+        # counts are over-estimated by at most e/width of the total, with probability 1 - e^-depth
+        self.width = width
+        self.depth = depth
+        self.k = k
+        self.total = 0
+        self._table = np.zeros((depth, width), dtype=np.int64)
+        self._keys = [f"countmin{row:08d}" for row in range(depth)]
+        self._top = {}
+
+    def _columns(self, values):
+        return [(_hash(values, key) % np.uint64(self.width)).astype(np.int64) for key in self._keys]
+
+    def add(self, values, counts):
+        values = np.asarray(values, dtype=object)
+        counts = np.asarray(counts, dtype=np.int64)
+        keep = counts > 0
+        values, counts = values[keep], counts[keep]
+        if not len(values):
+            return
+        for row, columns in enumerate(self._columns(values)):
+            np.add.at(self._table[row], columns, counts)
+        self.total += int(counts.sum())
+        # heavy-hitter candidates: the batch's own top k compete with the current top k, anything
+        # below them can't make the cut
+        touched = pd.unique(values)
+        estimates = self.estimate(touched)
+        if len(touched) > self.k:
+            best = np.argpartition(-estimates, self.k)[:self.k]
+            touched, estimates = touched[best], estimates[best]
+        for value, estimate in zip(touched, estimates):
+            self._top[value] = estimate
+        if len(self._top) > self.k:
+            self._top = dict(sorted(self._top.items(), key=lambda kv: -kv[1])[:self.k])
+
+    def estimate(self, values):
+        values = np.asarray(values, dtype=object)
+        if not len(values):
+            return np.zeros(0, dtype=np.int64)
+        return np.min([self._table[row][columns] for row, columns in enumerate(self._columns(values))], axis=0)
+
+    def error_bound(self):
+        return math.e / self.width * self.total
+
+    def top(self, n=10):
+        return sorted(self._top.items(), key=lambda kv: -kv[1])[:n]
+
+
+#stratified reservoir sample
+
+class StratifiedSample:
+
+    def __init__(self, per_stratum=5000, seed=7):
+        # one reservoir per country, so small check posts are sampled as well as busy ones
+        self.per_stratum = per_stratum
+        self._random = random.Random(seed)
+        self._rows = {}
+        self._seen = {}
+
+    def add(self, stratum, row):
+        seen = self._seen.get(stratum, 0) + 1
+        self._seen[stratum] = seen
+        rows = self._rows.setdefault(stratum, [])
+        if len(rows) < self.per_stratum:
+            rows.append(row)
+        else:
+            slot = self._random.randrange(seen)
+            if slot < self.per_stratum:
+                rows[slot] = row
+
+    def merge(self, stratum, rows, seen):
+        # rows is a uniform sample of seen stops drawn elsewhere (SQL, another shard); the stratum keeps
+        # a uniform sample of both: how many come from each side is drawn like picking from the union
+        held, held_seen = self._rows.get(stratum, []), self._seen.get(stratum, 0)
+        total = held_seen + seen
+        size = min(self.per_stratum, total)
+        picked = sum(1 for i in self._random.sample(range(total), size) if i < held_seen)
+        self._rows[stratum] = self._random.sample(held, picked) + self._random.sample(list(rows), size - picked)
+        self._seen[stratum] = total
+
+    def weighted_rows(self):
+        # every sampled row stands for population / sample rows of its stratum
+        for stratum, rows in self._rows.items():
+            weight = self._seen[stratum] / len(rows)
+            for row in rows:
+                yield row, weight
+
+    def sampled(self):
+        return sum(len(rows) for rows in self._rows.values())
+
+    def population(self):
+        return sum(self._seen.values())
+
+
+#weighted cubes
+
+def _t_95(df):
+    # Student t quantile for the few bootstrap replicates (Cornish-Fisher expansion around z)
+    z = Z_95
+    return z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+
+
+def _weighted(expression, weight):
+    # the cube measures are counts and sums over one logs row, each row now counts weight times
+    if expression == "COUNT(*)":
+        return f"SUM({weight})"
+    counted = re.fullmatch(r"COUNT\((\w+)\)", expression)
+    if counted:
+        return f"SUM(CASE WHEN {counted.group(1)} IS NOT NULL THEN {weight} ELSE 0 END)"
+    if "THEN 1 ELSE 0 END" in expression:
+        return expression.replace("THEN 1 ELSE 0 END", f"THEN {weight} ELSE 0 END")
+    summed = re.fullmatch(r"SUM\((.*)\)", expression)
+    if summed:
+        return f"SUM({weight} * {summed.group(1)})"
+    raise ValueError(f"cannot weight cube measure {expression!r}")
+
+
+def _run(conn, query):
+    cursor = conn.execute(query)
+    return pd.DataFrame(cursor.fetchall(), columns=[c_name[0] for c_name in cursor.description])
+
+
+class Estimate(NamedTuple):
+    result: pd.DataFrame
+    margins: pd.DataFrame
+    sampled: int
+    population: int
+    method: str
+
+
+class ApproxAnalytics:
+
+    def __init__(self, pool, per_stratum=5000, replicates=10, refresh_interval=10.0, seed=7):
+        self.pool = pool
+        self.replicates = replicates
+        self.refresh_interval = refresh_interval
+        self._seed = seed
+        self._lock = threading.Lock()
+        self._sample = StratifiedSample(per_stratum, seed)
+        self._vehicles = HyperLogLog()
+        self._plates = {measure: CountMinTopK() for measure in ("stops", "drug_stops", "typed_searches")}
+        self._watermark = Watermark()
+        self._refreshed_at = float("-inf")
+        self._cubes = None
+        self._built_at = float("-inf")
+        self._dirty = True
+        self._estimates = {}
+        self._executor = ThreadPoolExecutor(max_workers=min(8, replicates + 1), thread_name_prefix="approx")
+
+    def refresh(self, force=False):
+        # sketches see every new stop, the sample keeps a bounded share of them; stops that
+        # committed late below the watermark are folded in first
+        if self._due(force):
+            self._read(self.pool, self._watermark)
+
+    def _due(self, force):
+        with self._lock:
+            if not force and time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return False
+            self._refreshed_at = time.monotonic()
+            return True
+
+    def _read(self, pool, watermark):
+        with self._lock:
+            gaps = watermark.gap_filter()
+            last_id = watermark.last_id
+        columns = ["id"] + LOG_COLUMNS
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            dialect = dialect_of(conn)
+            if not last_id and gaps is None:
+                last_id = self._seed_sample(cursor, dialect, watermark)
+            if gaps is not None:
+                cursor.execute(adapt_query(f"SELECT {', '.join(columns)} FROM {TABLE} WHERE {gaps[0]} ORDER BY id",
+                                           dialect), gaps[1])
+                rows = cursor.fetchall()
+                if rows:
+                    self._fold(pd.DataFrame(rows, columns=columns), rows)
+                with self._lock:
+                    watermark.fill([row[0] for row in rows])
+            query = adapt_query(f"SELECT {', '.join(columns)} FROM {TABLE} WHERE id > %s ORDER BY id LIMIT {BATCH}",
+                                dialect)
+            while True:
+                cursor.execute(query, (last_id,))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                self._fold(pd.DataFrame(rows, columns=columns), rows)
+                with self._lock:
+                    watermark.advance_to([row[0] for row in rows], rows[-1][0])
+                last_id = rows[-1][0]
+
+    def _seed_sample(self, cursor, dialect, watermark):
+        # the stops already logged are sampled and counted in SQL instead of being read one by one:
+        # each country's sample is its first per_stratum ids in a seeded hash order, the plate sketches
+        # take per-plate totals
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE}")
+        high = cursor.fetchone()[0]
+        if not high:
+            return 0
+        _, runs = read_runs(cursor, dialect, TABLE, 0, high)
+        where, params = "id <= %s", [high]
+        if runs:
+            gaps, gap_params = between(runs)
+            where += f" AND NOT {gaps}"
+            params += gap_params
+        rng = random.Random(self._seed)
+        multiplier, offset = rng.randrange(1, HASH_MODULUS), rng.randrange(HASH_MODULUS)
+        columns = ", ".join(["id"] + LOG_COLUMNS)
+        cursor.execute(adapt_query(
+            f"SELECT country_name, COUNT(*) FROM {TABLE} WHERE {where} GROUP BY country_name", dialect), params)
+        seen = dict(cursor.fetchall())
+        cursor.execute(adapt_query(
+            f"SELECT {columns} FROM (SELECT {columns}, ROW_NUMBER() OVER (PARTITION BY country_name "
+            f"ORDER BY MOD(MOD(id, {HASH_MODULUS}) * {multiplier} + {offset}, {HASH_MODULUS})) AS pick "
+            f"FROM {TABLE} WHERE {where}) AS ranked WHERE pick <= %s", dialect),
+            params + [self._sample.per_stratum])
+        strata = {}
+        country_at = LOG_COLUMNS.index("country_name")
+        for row in cursor.fetchall():
+            strata.setdefault(row[1 + country_at], []).append(row[1:])
+        with self._lock:
+            for stratum, count in seen.items():
+                self._sample.merge(stratum, strata.get(stratum, []), count)
+            self._dirty = True
+
+        cube = CUBES["rollup_vehicle"]
+        selects = [expression for _, _, expression in cube["dims"] + cube["measures"]]
+        cursor.execute(adapt_query(f"SELECT {', '.join(selects)} FROM {TABLE} WHERE {where} GROUP BY 1", dialect),
+                       params)
+        while True:
+            totals = cursor.fetchmany(BATCH)
+            if not totals:
+                break
+            plates = np.array([row[0] for row in totals], dtype=object)
+            counts = np.array([row[1:] for row in totals], dtype=np.int64)
+            with self._lock:
+                self._vehicles.add(plates[plates != ""])
+                for i, measure in enumerate(("stops", "drug_stops", "typed_searches")):
+                    self._plates[measure].add(plates, counts[:, i])
+        with self._lock:
+            watermark.advance(high, runs)
+        return high
+
+    def _fold(self, batch, rows):
+        plates = batch["vehicle_number"].fillna("")
+        drugs = pd.to_numeric(batch["drugs_related_stop"], errors="coerce").fillna(0).astype(np.int64)
+        searched = (batch["search_type"].fillna("").str.lower() != "no search").astype(np.int64) \
+            * batch["search_type"].notna()
+        country_at = LOG_COLUMNS.index("country_name")
+        with self._lock:
+            self._vehicles.add(plates[plates != ""])
+            self._plates["stops"].add(plates, np.ones(len(plates), dtype=np.int64))
+            self._plates["drug_stops"].add(plates, drugs)
+            self._plates["typed_searches"].add(plates, searched)
+            for row in rows:
+                self._sample.add(row[1 + country_at], row[1:])
+            self._dirty = True
+
+    #estimates
+
+    def _build(self):
+        # the sample is loaded once with a point weight and bootstrap replicate weights, each weight
+        # gets its own copy of the cubes so the rollup analyses run on them unchanged
+        rng = np.random.default_rng(self._seed)
+        rows = list(self._sample.weighted_rows())
+        weights = np.array([w for _, w in rows], dtype=np.float64)
+        replicate_weights = [weights * rng.poisson(1.0, len(rows)) for _ in range(self.replicates)]
+        names = [f"w{i}" for i in range(self.replicates + 1)]
+        loader = sqlite_factory(":memory:")()
+        loader.execute(f"CREATE TABLE policedb.sample ({', '.join(LOG_COLUMNS + names)})")
+        date_at, time_at = LOG_COLUMNS.index("stop_date"), LOG_COLUMNS.index("stop_time")
+
+        def as_text(row):
+            row = list(row)
+            row[date_at] = None if row[date_at] is None else str(row[date_at])[:10]
+            row[time_at] = normalize_time(row[time_at])
+            return row
+        loader.executemany(
+            f"INSERT INTO policedb.sample VALUES ({', '.join(['?'] * (len(LOG_COLUMNS) + len(names)))})",
+            (as_text(row) + [float(weights[i])] + [float(w[i]) for w in replicate_weights]
+             for i, (row, _) in enumerate(rows)),
+        )
+        cubes = [sqlite_factory(":memory:")() for _ in names]
+        vehicle_rows = self._vehicle_cells()
+        for name, cube in CUBES.items():
+            dims = [dim for dim, _, _ in cube["dims"]]
+            measures = [measure for measure, _, _ in cube["measures"]]
+            insert = (f"INSERT INTO policedb.{name} ({', '.join(dims + measures)}) "
+                      f"VALUES ({', '.join(['?'] * (len(dims) + len(measures)))})")
+            if name == "rollup_vehicle":
+                cells = [vehicle_rows] * len(names)
+            else:
+                # one pass over the sample computes the cells of every replicate side by side
+                selects = [f"{expression} AS {dim}" for dim, _, expression in cube["dims"]]
+                # a cell whose stops have no duration sums to NULL, the cube columns are NOT NULL
+                selects += [f"COALESCE({_weighted(expression, weight)}, 0)".format(duration=DURATION_NUMBER["sqlite"])
+                            for weight in names for _, _, expression in cube["measures"]]
+                rows = loader.execute(
+                    f"SELECT {', '.join(selects)} FROM policedb.sample "
+                    f"GROUP BY {', '.join(str(i + 1) for i in range(len(dims)))}").fetchall()
+                width = len(measures)
+                cells = [[row[:len(dims)] + row[len(dims) + i * width:len(dims) + (i + 1) * width] for row in rows]
+                         for i in range(len(names))]
+            for conn, replicate_cells in zip(cubes, cells):
+                # estimates are REAL, an integer affinity would turn 3.0 into a key-looking 3
+                conn.execute(create_sql(name, "REAL"))
+                conn.executemany(insert, replicate_cells)
+        for conn in cubes:
+            conn.commit()
+        loader.close()
+        return cubes
+
+    def _vehicle_cells(self):
+        # plates are heavy hitters from the count-min sketches, a sample would miss most of them
+        candidates = set()
+        for sketch in self._plates.values():
+            candidates.update(plate for plate, _ in sketch.top(sketch.k))
+        plates = sorted(p for p in candidates if p)
+        if not plates:
+            return []
+        columns = [self._plates[m].estimate(plates) for m in ("stops", "drug_stops", "typed_searches")]
+        # stored as REAL like the weighted sample cells, integer columns are read as group keys
+        return [(plate, *(float(c[i]) for c in columns)) for i, plate in enumerate(plates)]
+
+    def estimate(self, query):
+        # point estimate from the sample weights, 95% margins from the spread over the replicates
+        if not estimable(query):
+            raise ValueError("approximate mode answers rollup queries not ordered by plate only")
+        cubes = _CUBE_NAMES.findall(query)
+        with self._lock:
+            if self._cubes is None or (self._dirty and time.monotonic() - self._built_at >= REBUILD_INTERVAL):
+                if self._cubes is not None:
+                    for conn in self._cubes:
+                        conn.close()
+                self._cubes = self._build()
+                self._built_at = time.monotonic()
+                self._dirty = False
+                self._estimates = {}
+            if query in self._estimates:
+                return self._estimates[query]
+            # sqlite releases the GIL while it runs, so the replicates are queried side by side
+            results = list(self._executor.map(lambda conn: _run(conn, query), self._cubes))
+            sampled, population = self._sample.sampled(), self._sample.population()
+            count_min_bound = max(s.error_bound() for s in self._plates.values())
+        point = results[0]
+        # weighted measures come back as floats, integers are keys (hour, year) unless they are ranks
+        numeric = [c for c in point.columns if pd.api.types.is_float_dtype(point[c])
+                   or (pd.api.types.is_integer_dtype(point[c]) and "RANK" in c.upper())]
+        keys = [c for c in point.columns if c not in numeric]
+        margins = pd.DataFrame(index=point.index, columns=numeric, dtype=np.float64)
+        if numeric and len(results) > 2:
+            # replicate cells are matched to the point rows by their non-numeric key columns
+            def keyed(result):
+                if keys:
+                    return list(result[keys].itertuples(index=False, name=None))
+                return list(range(len(result)))
+            stacked = np.full((len(results) - 1, len(point), len(numeric)), np.nan)
+            point_keys = keyed(point)
+            for r, result in enumerate(results[1:]):
+                lookup = dict(zip(keyed(result), result[numeric].to_numpy(dtype=np.float64, na_value=np.nan)))
+                for i, key in enumerate(point_keys):
+                    if key in lookup:
+                        stacked[r, i] = lookup[key]
+            with np.errstate(invalid="ignore"):
+                spread = np.nanstd(stacked, axis=0, ddof=1)
+            margins[numeric] = _t_95(len(results) - 2) * spread
+        method = f"stratified sample of {sampled:,} / {population:,} stops, {self.replicates} bootstrap replicates"
+        if "rollup_vehicle" in cubes:
+            margins[numeric] = margins[numeric].fillna(0) + count_min_bound
+            method += f", plate counts from count-min sketches (over-count at most {count_min_bound:,.0f})"
+        estimate = Estimate(point, margins.round(2), sampled, population, method)
+        with self._lock:
+            self._estimates[query] = estimate
+        return estimate
+
+    def distinct_vehicles(self):
+        with self._lock:
+            return self._vehicles.estimate(), self._vehicles.margin()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sampled": self._sample.sampled(),
+                "population": self._sample.population(),
+                "last_id": self._watermark.last_id,
+                "plate_sketch_total": self._plates["stops"].total,
+            }
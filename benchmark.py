@@ -0,0 +1,277 @@
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from analyses import QUERY_MAP
+from db_pool import ConnectionPool, adapt_query, add_connection_args, connect_from_args, dialect_of
+from log_browser import ensure_sort_indexes, fetch_page
+from metrics import compute_metrics
+from predictor import PredictionIndex
+from rollups import ROLLUP_QUERIES, Rollups
+from schema import create_logs_table, insert_sql
+from search import LogSearch
+
+#synthetic data generator and benchmark harness for the dashboard queries
+
+COUNTRIES = (["USA", "Canada", "India"], [0.5, 0.3, 0.2])
+GENDERS = (["M", "F"], [0.68, 0.32])
+RACES = (["White", "Black", "Hispanic", "Asian", "Other"], [0.62, 0.15, 0.13, 0.06, 0.04])
+VIOLATIONS = (["Speeding", "Signal", "Seatbelt", "DUI", "Other"], [0.55, 0.17, 0.12, 0.06, 0.10])
+OUTCOMES = (["Ticket", "Warning", "Arrest"], [0.62, 0.30, 0.08])
+DURATIONS = (["0-15 Min", "16-30 Min", "30+ Min"], [0.72, 0.21, 0.07])
+SEARCH_TYPES = (["Vehicle Search", "Frisk"], [0.7, 0.3])
+# stops per hour of day: quiet before dawn, peaks in the morning and late afternoon
+HOURS = np.array([2, 1.5, 1, 1, 1, 1.5, 3, 5, 6, 6, 6, 5.5, 5, 5, 5.5, 6, 6.5, 6, 5, 4, 3.5, 3, 2.5, 2])
+START_DATE = datetime.date(2019, 1, 1)
+DAYS = 6 * 365
+
+
+#generator
+
+def _pick(rng, choices, size):
+    values, weights = choices
+    return np.array(values, dtype=object)[rng.choice(len(values), size=size, p=weights)]
+
+
+def generate_batch(rng, size, plates):
+    # plates are reused with a heavy tail, so repeat offenders and frequent searches exist
+    searched = rng.random(size) < 0.12
+    outcomes = _pick(rng, OUTCOMES, size)
+    # arrests are more likely after a search
+    outcomes[searched & (rng.random(size) < 0.15)] = "Arrest"
+    drugs = (rng.random(size) < np.where(searched, 0.25, 0.01)).astype(int)
+    days = rng.integers(0, DAYS, size)
+    hours = rng.choice(24, size=size, p=HOURS / HOURS.sum())
+    seconds = hours * 3600 + rng.integers(0, 3600, size)
+    plate_index = np.minimum((rng.pareto(1.1, size) * plates / 50).astype(np.int64), plates - 1)
+    ages = np.clip(rng.normal(36, 13, size).round(), 16, 90).astype(int)
+    search_types = np.where(searched, _pick(rng, SEARCH_TYPES, size), "No Search")
+    violations = _pick(rng, VIOLATIONS, size)
+    dates = [(START_DATE + datetime.timedelta(days=int(d))).isoformat() for d in days]
+    times = [f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in seconds]
+    plate_numbers = [f"TN{i % 90 + 10:02d}{chr(65 + i // 90 % 26)}{chr(65 + i // 2340 % 26)}{i % 10000:04d}"
+                     for i in plate_index]
+    return list(zip(
+        dates, times, _pick(rng, COUNTRIES, size), _pick(rng, GENDERS, size), ages.tolist(),
+        _pick(rng, RACES, size), violations, violations, searched.astype(int).tolist(), search_types,
+        outcomes, (outcomes == "Arrest").astype(int).tolist(), _pick(rng, DURATIONS, size),
+        drugs.tolist(), plate_numbers,
+    ))
+
+
+def generate(conn, rows, batch_size=100000, seed=7, progress=print):
+    create_logs_table(conn)
+    rng = np.random.default_rng(seed)
+    plates = max(rows // 5, 100)
+    query = adapt_query(insert_sql(), dialect_of(conn))
+    cursor = conn.cursor()
+    started = time.monotonic()
+    written = 0
+    while written < rows:
+        size = min(batch_size, rows - written)
+        cursor.executemany(query, generate_batch(rng, size, plates))
+        conn.commit()
+        written += size
+        progress(f"{written:,} rows generated ({written / (time.monotonic() - started):,.0f} rows/s)")
+    return written
+
+
+#harness
+
+def measure(fn, repeat=5):
+    # latency from untraced runs and peak memory from one extra traced run; one-shot steps
+    # (index builds) can't be repeated, so their single run is traced and timed together
+    times = []
+    result = None
+    try:
+        for _ in range(repeat if repeat > 1 else 0):
+            started = time.perf_counter()
+            result = fn()
+            times.append((time.perf_counter() - started) * 1000)
+        tracemalloc.start()
+        started = time.perf_counter()
+        traced = fn()
+        if not times:
+            times.append((time.perf_counter() - started) * 1000)
+            result = traced
+        peak = tracemalloc.get_traced_memory()[1]
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+    ordered = sorted(times)
+    return {
+        "median_ms": round(statistics.median(times), 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        "min_ms": round(ordered[0], 3),
+        "rows": _row_count(result),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def _row_count(result):
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if hasattr(result, "rows"):
+        return len(result.rows)
+    return None
+
+
+def run_benchmarks(pool, repeat=5, progress=print):
+    def fetch(query, params=None):
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            if params is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(adapt_query(query, dialect_of(conn)), params)
+            return pd.DataFrame(cursor.fetchall(), columns=[c_name[0] for c_name in cursor.description])
+
+    results = {}
+
+    def record(name, fn, times=repeat):
+        results[name] = measure(fn, times)
+        progress(f"{name}: {results[name]}")
+
+    record("home/key_metrics", lambda: compute_metrics(fetch))
+
+    for title, query in QUERY_MAP.items():
+        record(f"analysis/raw/{title}", lambda q=query: fetch(q))
+
+    rollups = Rollups(pool)
+    rollups.ensure_tables()
+    record("rollups/initial_refresh", lambda: rollups.refresh(force=True), times=1)
+    for title, query in ROLLUP_QUERIES.items():
+        record(f"analysis/rollup/{title}", lambda q=query: fetch(q))
+
+    search = LogSearch(pool)
+    search.ensure_indexes()
+    ensure_sort_indexes(pool)
+    record("search/index_refresh", lambda: search.refresh(force=True), times=1)
+    cases = {
+        "plate_3_chars": ("AB1", "", ""),
+        "plate_full": ("TN15AA0005", "", ""),
+        "violation_country": ("", "speed", "usa"),
+        "all_filters": ("TN1", "sig", "ind"),
+    }
+    for name, (vehicle, violation, country) in cases.items():
+        def run(vehicle=vehicle, violation=violation, country=country):
+            plan = search.plan(vehicle, violation, country)
+            return fetch_page(pool, where=plan.where, params=plan.params, page_size=50)
+        record(f"search/{name}", run)
+
+    predictor = PredictionIndex(pool)
+    record("predictor/build", lambda: predictor.refresh(force=True), times=1)
+    probes = [("M", 30, "0", datetime.time(14, 5, 0), "0"), ("F", 22, "1", datetime.time(2, 40, 10), "1"),
+              ("M", 71, "1", datetime.time(23, 59, 59), "0")]
+    record("predictor/predict_x1000",
+           lambda: [predictor.predict(*probes[i % len(probes)]) for i in range(1000)])
+    return results
+
+
+#reports
+
+def write_report(results, path, meta):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2, sort_keys=True)
+
+
+def compare(current, baseline, threshold=1.25):
+    # ratios of median latency, anything slower than threshold x baseline is a regression
+    regressions = []
+    lines = []
+    for name, result in sorted(current["results"].items()):
+        before = baseline["results"].get(name)
+        if not before or "median_ms" not in before or "median_ms" not in result:
+            lines.append(f"{name:<100} {'n/a':>10}")
+            continue
+        ratio = result["median_ms"] / max(before["median_ms"], 1e-6)
+        marker = "REGRESSION" if ratio > threshold else ""
+        if marker:
+            regressions.append(name)
+        lines.append(f"{name:<100} {before['median_ms']:>10.2f} -> {result['median_ms']:>10.2f} ms "
+                     f"x{ratio:5.2f} {marker}")
+    return lines, regressions
+
+
+#command line
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic stops and benchmark the dashboard queries")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="append synthetic stops to policedb.logs")
+    gen.add_argument("--rows", type=int, default=1000000)
+    gen.add_argument("--seed", type=int, default=7)
+    add_connection_args(gen)
+
+    run = commands.add_parser("run", help="benchmark every page section and analysis")
+    run.add_argument("--repeat", type=int, default=5)
+    run.add_argument("--out", default="bench_report.json")
+    run.add_argument("--label", default="")
+    run.add_argument("--compare", help="baseline report to compare against")
+    run.add_argument("--threshold", type=float, default=1.25)
+    add_connection_args(run)
+
+    cmp = commands.add_parser("compare", help="compare two saved reports")
+    cmp.add_argument("baseline")
+    cmp.add_argument("current")
+    cmp.add_argument("--threshold", type=float, default=1.25)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        conn = connect_from_args(args)
+        try:
+            generate(conn, args.rows, seed=args.seed)
+        finally:
+            conn.close()
+        return 0
+
+    if args.command == "compare":
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.current, encoding="utf-8") as f:
+            current = json.load(f)
+    else:
+        pool = ConnectionPool(lambda: connect_from_args(args), max_size=2)
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM policedb.logs")
+            table_rows = cursor.fetchone()[0]
+            dialect = dialect_of(conn)
+        meta = {
+            "label": args.label,
+            "rows": table_rows,
+            "dialect": dialect,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+        current = {"meta": meta, "results": run_benchmarks(pool, args.repeat)}
+        write_report(current["results"], args.out, meta)
+        print(f"report written to {args.out}")
+        if not args.compare:
+            return 0
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    lines, regressions = compare(current, baseline, args.threshold)
+    print("\n".join(lines))
+    if regressions:
+        print(f"{len(regressions)} regression(s) above x{args.threshold}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+#connection pool shared by every streamlit session
+
+class PoolTimeout(Exception):
+    pass
+
+
+def dialect_of(conn):
+    if isinstance(conn, sqlite3.Connection):
+        return "sqlite"
+    return "mysql"
+
+
+def adapt_query(query, dialect):
+    # queries are written with pymysql's %s placeholders, sqlite wants ?
+    if dialect == "sqlite":
+        return query.replace("%s", "?")
+    return query
+
+
+#sqlite stand-in for local testing
+
+def _sql_hour(value):
+    if value is None:
+        return None
+    return int(str(value).split()[-1].split(":")[0])
+
+
+def _sql_year(value):
+    if value is None:
+        return None
+    return int(str(value)[:4])
+
+
+def _sql_month(value):
+    if value is None:
+        return None
+    return int(str(value)[5:7])
+
+
+def _sql_mod(value, divisor):
+    # integer MOD like MySQL's, sqlite's own (when built in) works on floats
+    if value is None or divisor is None:
+        return None
+    return value % divisor
+
+
+def sqlite_factory(path):
+    # the file is attached as "policedb" so the dashboard's policedb.logs queries run unchanged
+    def connect():
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        conn.execute("ATTACH DATABASE ? AS policedb", (path,))
+        conn.create_function("HOUR", 1, _sql_hour)
+        conn.create_function("YEAR", 1, _sql_year)
+        conn.create_function("MONTH", 1, _sql_month)
+        conn.create_function("MOD", 2, _sql_mod)
+        return conn
+    return connect
+
+
+#command line connection options shared by the maintenance scripts
+
+def add_connection_args(parser):
+    parser.add_argument("--sqlite", help="use this sqlite file instead of MySQL")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="policedb")
+
+
+def connect_from_args(args, **options):
+    if args.sqlite:
+        return sqlite_factory(args.sqlite)()
+    import pymysql
+    return pymysql.connect(
+        host=args.host,
+        user=args.user,
+        password=args.password,
+        database=args.database,
+        **options
+    )
+
+
+class ConnectionPool:
+
+    def __init__(self, factory, max_size=5, checkout_timeout=5.0, max_idle=300.0):
+        self.factory = factory
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.max_idle = max_idle
+        self._idle = queue.LifoQueue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._stats = {
+            "checkouts": 0,
+            "created": 0,
+            "reconnects": 0,
+            "timeouts": 0,
+            "wait_time": 0.0,
+        }
+
+    def _create(self):
+        conn = self.factory()
+        with self._lock:
+            self._stats["created"] += 1
+        return conn
+
+    def _is_healthy(self, conn, idle_for):
+        # only ping connections that sat idle long enough to have gone stale
+        if idle_for < self.max_idle:
+            return True
+        try:
+            if dialect_of(conn) == "sqlite":
+                conn.execute("SELECT 1")
+            else:
+                if not conn.open:
+                    return False
+                conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        while True:
+            try:
+                conn, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+                with self._lock:
+                    can_open = self._opened < self.max_size
+                    if can_open:
+                        self._opened += 1
+                if can_open:
+                    try:
+                        conn = self._create()
+                    except Exception:
+                        with self._lock:
+                            self._opened -= 1
+                        raise
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._lock:
+                        self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"no connection available within {self.checkout_timeout}s")
+                try:
+                    conn, released_at = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+            if self._is_healthy(conn, time.monotonic() - released_at):
+                break
+            # stale socket: replace it with a fresh connection in the same slot
+            self._discard(conn)
+            try:
+                conn = self._create()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+            with self._lock:
+                self._stats["reconnects"] += 1
+            break
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["wait_time"] += time.monotonic() - started
+        return conn
+
+    def release(self, conn, broken=False):
+        if broken:
+            self._discard(conn)
+            with self._lock:
+                self._opened -= 1
+            return
+        try:
+            conn.rollback()
+        except Exception:
+            self.release(conn, broken=True)
+            return
+        self._idle.put((conn, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception as e:
+            self.release(conn, broken=is_disconnect(e))
+            raise
+        else:
+            self.release(conn)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["open"] = self._opened
+        stats["idle"] = self._idle.qsize()
+        stats["in_use"] = stats["open"] - stats["idle"]
+        stats["max_size"] = self.max_size
+        return stats
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+            with self._lock:
+                self._opened -= 1
+
+
+# pymysql codes for "server has gone away", "lost connection" and "lost connection during query"
+DISCONNECT_CODES = {2006, 2013, 2055}
+
+
+def is_disconnect(error):
+    if isinstance(error, (OSError, ConnectionError)):
+        return True
+    if type(error).__name__ == "InterfaceError":
+        return True
+    if error.args and error.args[0] in DISCONNECT_CODES:
+        return True
+    return isinstance(error, sqlite3.ProgrammingError) and "closed" in str(error).lower()
@@ -0,0 +1,177 @@
+import datetime
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import NamedTuple
+
+from query_cache import normalize_sql, result_size
+
+#query instrumentation behind fetch_data
+
+
+class QueryRecord(NamedTuple):
+    label: str
+    sql: str
+    params: object
+    source: str
+    started_at: datetime.datetime
+    total_ms: float
+    phases: dict
+    rows: int
+    bytes: int
+    cached: bool
+    error: str
+    plan: str
+
+
+class QueryTrace:
+
+    def __init__(self, query, params, source, label):
+        self.query = query
+        self.params = params
+        self.source = source
+        self.label = label
+        self.phases = {}
+        self.rows = 0
+        self.bytes = 0
+        self.computed = False
+        self.error = ""
+
+    @contextmanager
+    def phase(self, name):
+        # phases only run on a cache miss, a trace without any was served from the cache
+        self.computed = True
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+    def result(self, frame):
+        self.rows = len(frame)
+        self.bytes = result_size(frame)
+        return frame
+
+
+@contextmanager
+def tracked(monitor, query, params=None, source="live", label=""):
+    # monitor.track when there is a monitor, a bare trace otherwise so callers time phases either way
+    if monitor is None:
+        yield QueryTrace(query, params, source, label)
+        return
+    with monitor.track(query, params, source, label) as trace:
+        yield trace
+
+
+class QueryMonitor:
+
+    def __init__(self, slow_ms=500.0, capacity=200, slow_capacity=50, explain_fn=None, metrics_path=None):
+        # explain_fn(query, params, source) returns the plan text of a slow query
+        self.slow_ms = slow_ms
+        self.explain_fn = explain_fn
+        self.metrics_path = metrics_path
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._recent = deque(maxlen=capacity)
+        self._slow = deque(maxlen=slow_capacity)
+        self._plans = {}
+        self._totals = {}
+
+    @contextmanager
+    def track(self, query, params=None, source="live", label=""):
+        trace = QueryTrace(query, params, source, label)
+        started_at = datetime.datetime.now()
+        started = time.perf_counter()
+        try:
+            yield trace
+        except Exception as e:
+            trace.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self._record(trace, started_at, (time.perf_counter() - started) * 1000)
+
+    def _explain(self, trace, key):
+        # one EXPLAIN per statement, it is the same plan every time it's slow
+        with self._lock:
+            plan = self._plans.get(key)
+        if plan is not None or self.explain_fn is None:
+            return plan or ""
+        try:
+            plan = self.explain_fn(trace.query, trace.params, trace.source)
+        except Exception as e:
+            plan = f"EXPLAIN failed: {type(e).__name__}: {e}"
+        with self._lock:
+            self._plans[key] = plan
+        return plan
+
+    def _record(self, trace, started_at, total_ms):
+        sql = normalize_sql(trace.query)
+        key = (trace.source, sql)
+        slow = trace.computed and not trace.error and total_ms >= self.slow_ms
+        record = QueryRecord(
+            label=trace.label,
+            sql=sql,
+            params=trace.params,
+            source=trace.source,
+            started_at=started_at,
+            total_ms=round(total_ms, 3),
+            phases={name: round(ms, 3) for name, ms in trace.phases.items()},
+            rows=trace.rows,
+            bytes=trace.bytes,
+            cached=not trace.computed and not trace.error,
+            error=trace.error,
+            plan=self._explain(trace, key) if slow else "",
+        )
+        with self._lock:
+            self._recent.append(record)
+            if slow:
+                self._slow.append(record)
+            totals = self._totals.setdefault(key, {
+                "label": trace.label, "source": trace.source, "sql": sql, "calls": 0, "cache_hits": 0,
+                "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0, "bytes": 0,
+            })
+            totals["label"] = trace.label or totals["label"]
+            totals["calls"] += 1
+            totals["cache_hits"] += record.cached
+            totals["errors"] += bool(record.error)
+            totals["total_ms"] += total_ms
+            totals["max_ms"] = max(totals["max_ms"], total_ms)
+            totals["rows"] = max(totals["rows"], record.rows)
+            totals["bytes"] = max(totals["bytes"], record.bytes)
+        if self.metrics_path:
+            self._export(record)
+
+    def _export(self, record):
+        line = record._asdict()
+        line["started_at"] = record.started_at.isoformat(timespec="milliseconds")
+        line["params"] = None if record.params is None else [str(p) for p in record.params]
+        with self._file_lock:
+            with open(self.metrics_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(line) + "\n")
+
+    def recent(self, limit=50):
+        with self._lock:
+            return list(self._recent)[-limit:][::-1]
+
+    def slow(self):
+        with self._lock:
+            return list(self._slow)[::-1]
+
+    def summary(self):
+        # per statement, heaviest total time first
+        with self._lock:
+            rows = [dict(totals) for totals in self._totals.values()]
+        for row in rows:
+            row["avg_ms"] = round(row["total_ms"] / row["calls"], 3)
+            row["total_ms"] = round(row["total_ms"], 3)
+            row["max_ms"] = round(row["max_ms"], 3)
+        return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._recent.clear()
+            self._slow.clear()
+            self._plans.clear()
+            self._totals.clear()
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+
+from schema import COLUMN_TYPES
+
+#compact, typed DataFrames for query results
+
+# a handful of distinct values repeated on every row
+CATEGORY_COLUMNS = {
+    "country_name", "driver_gender", "driver_race", "violation_raw", "violation",
+    "search_type", "stop_outcome", "stop_duration",
+}
+BOOL_COLUMNS = {column for column, (kind, _) in COLUMN_TYPES.items() if kind == "bool"}
+INT_COLUMNS = {"id"} | {column for column, (kind, _) in COLUMN_TYPES.items() if kind == "int"}
+TEXT_COLUMNS = {column for column, (kind, _) in COLUMN_TYPES.items() if kind == "str"} - CATEGORY_COLUMNS
+
+_NULLABLE_INTS = ["Int8", "Int16", "Int32", "Int64"]
+
+
+def _text_dtype():
+    # Arrow-backed strings when the optional pyarrow is installed, plain objects otherwise
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return None
+    return pd.StringDtype("pyarrow")
+
+
+TEXT_DTYPE = _text_dtype()
+
+
+def _downcast_int(series):
+    values = pd.to_numeric(series, errors="coerce")
+    if not values.isna().any():
+        return pd.to_numeric(values, downcast="integer")
+    if values.isna().all():
+        return values.astype("Int8")
+    low, high = values.min(), values.max()
+    for dtype in _NULLABLE_INTS:
+        info = np.iinfo(dtype.lower())
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+    return values.astype("Int64")
+
+
+def _parse_distinct(series, parse, missing):
+    # stops share a few thousand dates and at most 86400 times, only the distinct values are parsed
+    codes, uniques = pd.factorize(series)
+    parsed = parse(pd.Index(uniques))
+    return pd.Series(parsed.take(codes, allow_fill=True, fill_value=missing), index=series.index, name=series.name)
+
+
+def parse_time(series):
+    # TIME arrives as timedelta from pymysql, text from sqlite and datetime.time from duckdb
+    if pd.api.types.is_timedelta64_dtype(series):
+        return series
+    return _parse_distinct(series, lambda values: pd.to_timedelta(values.astype("string"), errors="coerce"), pd.NaT)
+
+
+def parse_date(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    return _parse_distinct(series, lambda values: pd.to_datetime(values, errors="coerce"), pd.NaT)
+
+
+def time_text(series):
+    # HH:MM:SS for display, without a Python call per row
+    times = parse_time(series)
+    seconds = times.dt.total_seconds().fillna(0).astype("int64") % 86400
+    text = ((seconds // 3600).astype(str).str.zfill(2) + ":" + (seconds % 3600 // 60).astype(str).str.zfill(2)
+            + ":" + (seconds % 60).astype(str).str.zfill(2))
+    return text.where(times.notna(), "")
+
+
+def date_text(series):
+    # YYYY-MM-DD for display, the compact frame keeps stop_date as datetime64 at midnight
+    dates = parse_date(series)
+    return dates.dt.strftime("%Y-%m-%d").where(dates.notna(), "")
+
+
+def compact(frame):
+    # only columns named like the logs columns are touched, aggregate aliases pass through
+    for column in frame.columns:
+        if not isinstance(column, str):
+            continue
+        series = frame[column]
+        if column in CATEGORY_COLUMNS:
+            frame[column] = series.astype("category")
+        elif column in BOOL_COLUMNS:
+            frame[column] = pd.to_numeric(series, errors="coerce").astype("boolean")
+        elif column in INT_COLUMNS:
+            frame[column] = _downcast_int(series)
+        elif column == "stop_time":
+            frame[column] = parse_time(series)
+        elif column == "stop_date":
+            frame[column] = parse_date(series)
+        elif column in TEXT_COLUMNS and TEXT_DTYPE is not None:
+            frame[column] = series.astype(TEXT_DTYPE)
+    return frame
+
+
+def decode_rows(rows, columns):
+    return compact(pd.DataFrame(rows, columns=columns))
@@ -0,0 +1,172 @@
+import argparse
+import csv
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+from db_pool import adapt_query, add_connection_args, connect_from_args, dialect_of
+from schema import LOG_COLUMNS, LOGS_TABLE, create_logs_table, insert_sql
+
+#chunked bulk loader for the traffic stops CSV (replaces the notebook's iterrows insert)
+
+FLAG_COLUMNS = ["search_conducted", "is_arrested", "drugs_related_stop"]
+_FLAGS = {"true": 1, "1": 1, "1.0": 1, "false": 0, "0": 0, "0.0": 0}
+
+
+#cleaning, the notebook's steps applied to one chunk at a time
+
+def _to_flag(series):
+    if series.dtype == bool:
+        return series.astype("Int8")
+    return series.astype("string").str.lower().map(_FLAGS).astype("Int8")
+
+
+def clean_chunk(chunk):
+    chunk = chunk.dropna(axis=1, how="all")
+    chunk = chunk.drop(columns=["driver_age_raw"], errors="ignore")
+    # columns that were all-null in this chunk come back as NULLs
+    chunk = chunk.reindex(columns=LOG_COLUMNS)
+    chunk["search_type"] = chunk["search_type"].fillna("No Search")
+    chunk["stop_date"] = pd.to_datetime(chunk["stop_date"], format="%Y-%m-%d", errors="coerce").dt.strftime("%Y-%m-%d")
+    chunk["stop_time"] = pd.to_datetime(chunk["stop_time"], format="%H:%M:%S", errors="coerce").dt.strftime("%H:%M:%S")
+    chunk["driver_age"] = pd.to_numeric(chunk["driver_age"], errors="coerce").astype("Int64")
+    for column in FLAG_COLUMNS:
+        chunk[column] = _to_flag(chunk[column])
+    return chunk
+
+
+def chunk_rows(chunk):
+    # plain python values, NULL for anything missing
+    data = chunk.astype(object).where(chunk.notna(), None)
+    return list(data.itertuples(index=False, name=None))
+
+
+#checkpoints live in the database and commit in the same transaction as each chunk
+
+def _ensure_checkpoints(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS policedb.ingest_checkpoints ("
+        "source VARCHAR(255) PRIMARY KEY, rows_done BIGINT NOT NULL)"
+    )
+    conn.commit()
+
+
+def read_checkpoint(conn, source):
+    cursor = conn.cursor()
+    cursor.execute(adapt_query("SELECT rows_done FROM policedb.ingest_checkpoints WHERE source = %s",
+                               dialect_of(conn)), (source,))
+    row = cursor.fetchone()
+    return int(row[0]) if row else 0
+
+
+def _save_checkpoint(cursor, dialect, source, rows_done):
+    cursor.execute(adapt_query("REPLACE INTO policedb.ingest_checkpoints (source, rows_done) VALUES (%s, %s)",
+                               dialect), (source, rows_done))
+
+
+def clear_checkpoint(conn, source):
+    cursor = conn.cursor()
+    cursor.execute(adapt_query("DELETE FROM policedb.ingest_checkpoints WHERE source = %s",
+                               dialect_of(conn)), (source,))
+    conn.commit()
+
+
+#bulk write paths
+
+def _insert_rows(cursor, dialect, rows):
+    # pymysql rewrites executemany of INSERT ... VALUES into multi-row statements
+    cursor.executemany(adapt_query(insert_sql(), dialect), rows)
+
+
+def write_load_data_csv(chunk, f):
+    # with ESCAPED BY '' MySQL reads \N as text, only an unquoted NULL field loads as NULL
+    chunk.to_csv(f, header=False, index=False, na_rep="NULL", quoting=csv.QUOTE_MINIMAL)
+
+
+def _load_data(cursor, chunk):
+    # LOAD DATA LOCAL INFILE needs local_infile=True on the pymysql connection
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", delete=False) as f:
+        path = f.name
+        write_load_data_csv(chunk, f)
+    try:
+        cursor.execute(
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {LOGS_TABLE} "
+            "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+            "LINES TERMINATED BY '\\n' "
+            f"({', '.join(LOG_COLUMNS)})",
+            (path,),
+        )
+    finally:
+        os.remove(path)
+
+
+def ingest_csv(conn, csv_path, chunk_size=50000, method="insert", progress=print):
+    dialect = dialect_of(conn)
+    if method == "load-data" and dialect != "mysql":
+        raise ValueError("load-data is only available on MySQL")
+    create_logs_table(conn)
+    _ensure_checkpoints(conn)
+    source = os.path.abspath(csv_path)
+    rows_done = read_checkpoint(conn, source)
+    if rows_done:
+        progress(f"resuming {source} after {rows_done:,} rows")
+
+    started = time.monotonic()
+    loaded = 0
+    # skip already loaded data lines, keep the header (line 0); a callable, because pandas turns a
+    # range into a set of every skipped line number. done is bound now, rows_done grows in the loop
+    reader = pd.read_csv(csv_path, chunksize=chunk_size, skiprows=lambda line, done=rows_done: 0 < line <= done,
+                         low_memory=False)
+    cursor = conn.cursor()
+    for chunk in reader:
+        chunk_started = time.monotonic()
+        cleaned = clean_chunk(chunk)
+        try:
+            if method == "load-data":
+                _load_data(cursor, cleaned)
+            else:
+                _insert_rows(cursor, dialect, chunk_rows(cleaned))
+            rows_done += len(chunk)
+            _save_checkpoint(cursor, dialect, source, rows_done)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        loaded += len(chunk)
+        elapsed = time.monotonic() - started
+        chunk_rate = len(chunk) / max(time.monotonic() - chunk_started, 1e-9)
+        progress(f"{rows_done:,} rows loaded ({chunk_rate:,.0f} rows/s this chunk, "
+                 f"{loaded / max(elapsed, 1e-9):,.0f} rows/s overall)")
+    elapsed = time.monotonic() - started
+    progress(f"done: {loaded:,} rows in {elapsed:.1f}s ({loaded / max(elapsed, 1e-9):,.0f} rows/s)")
+    return loaded
+
+
+#command line
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load a traffic stops CSV into policedb.logs")
+    parser.add_argument("csv_path")
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    parser.add_argument("--method", choices=["insert", "load-data"], default="insert")
+    parser.add_argument("--restart", action="store_true", help="ignore the saved checkpoint and load from the top")
+    add_connection_args(parser)
+    args = parser.parse_args(argv)
+
+    # LOAD DATA LOCAL INFILE is refused unless the client enables it
+    options = {"local_infile": True} if args.method == "load-data" else {}
+    conn = connect_from_args(args, **options)
+    try:
+        if args.restart:
+            _ensure_checkpoints(conn)
+            clear_checkpoint(conn, os.path.abspath(args.csv_path))
+        ingest_csv(conn, args.csv_path, args.chunk_size, args.method)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
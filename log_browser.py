@@ -0,0 +1,181 @@
+from typing import NamedTuple
+
+import pandas as pd
+
+from db_pool import adapt_query, dialect_of
+from diagnostics import tracked
+from frames import decode_rows
+
+#keyset-paginated log browser, one bounded page per request
+
+TABLE = "policedb.logs"
+
+# sort option -> keyset columns, id always breaks ties so every row has a unique position
+SORT_KEYS = {
+    "stop_date": ["stop_date", "stop_time", "id"],
+    "id": ["id"],
+    "country_name": ["country_name", "id"],
+    "violation": ["violation", "id"],
+    "driver_age": ["driver_age", "id"],
+    "vehicle_number": ["vehicle_number", "id"],
+    "stop_outcome": ["stop_outcome", "id"],
+}
+
+# one (sort columns..., id) index per sort option, id alone is the primary key
+SORT_INDEXES = {f"idx_logs_sort_{sort}": keys for sort, keys in SORT_KEYS.items() if keys != ["id"]}
+
+
+class Page(NamedTuple):
+    rows: pd.DataFrame
+    next_cursor: tuple
+    has_more: bool
+
+
+def ensure_sort_indexes(pool):
+    # idempotent, so ORDER BY and the keyset predicate range-scan an index instead of sorting the table
+    with pool.connection() as conn:
+        dialect = dialect_of(conn)
+        cursor = conn.cursor()
+        for name, keys in SORT_INDEXES.items():
+            columns = ", ".join(keys)
+            if dialect == "sqlite":
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS policedb.{name} ON logs ({columns})")
+                continue
+            try:
+                cursor.execute(f"CREATE INDEX {name} ON {TABLE} ({columns})")
+            except Exception as e:
+                # 1061: duplicate key name, the index already exists
+                if not e.args or e.args[0] != 1061:
+                    raise
+        conn.commit()
+    return SORT_INDEXES
+
+
+def _after(key, value, descending):
+    # NULLs sort first ascending and last descending in both MySQL and SQLite
+    if value is None:
+        return ("1 = 0" if descending else f"{key} IS NOT NULL"), []
+    if descending:
+        # the NULLs still to come sort after every value
+        return f"({key} < %s OR {key} IS NULL)", [value]
+    return f"{key} > %s", [value]
+
+
+def _equal(key, value):
+    if value is None:
+        return f"{key} IS NULL", []
+    return f"{key} = %s", [value]
+
+
+def _keyset_predicate(keys, cursor_values, descending):
+    # (a, b, id) > (x, y, z) expanded so MySQL can range-scan the (a, b, id) index from ensure_sort_indexes
+    clauses = []
+    params = []
+    for i, key in enumerate(keys):
+        parts = []
+        for prev_key, prev_value in zip(keys[:i], cursor_values[:i]):
+            sql, values = _equal(prev_key, prev_value)
+            parts.append(sql)
+            params.extend(values)
+        sql, values = _after(key, cursor_values[i], descending)
+        parts.append(sql)
+        params.extend(values)
+        clauses.append("(" + " AND ".join(parts) + ")")
+    return "(" + " OR ".join(clauses) + ")", params
+
+
+def page_query(sort="stop_date", descending=False, after=None, page_size=50, where="", params=()):
+    if sort not in SORT_KEYS:
+        raise ValueError(f"cannot sort logs by {sort!r}")
+    keys = SORT_KEYS[sort]
+    conditions = []
+    query_params = list(params)
+    if where:
+        conditions.append(f"({where})")
+    if after is not None:
+        predicate, predicate_params = _keyset_predicate(keys, list(after), descending)
+        conditions.append(predicate)
+        query_params.extend(predicate_params)
+    direction = " DESC" if descending else ""
+    query = f"SELECT * FROM {TABLE}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY " + ", ".join(k + direction for k in keys)
+    # one extra row tells us whether a next page exists
+    query += f" LIMIT {int(page_size) + 1}"
+    return query, query_params
+
+
+def _streaming_cursor(conn):
+    if dialect_of(conn) == "sqlite":
+        return conn.cursor()
+    from pymysql.cursors import SSCursor
+    return conn.cursor(SSCursor)
+
+
+def fetch_rows(pool, sort="stop_date", descending=False, after=None, page_size=50, where="", params=(),
+               monitor=None, source="live"):
+    # raw rows of one page plus the look-ahead row, the keyset values are read from these
+    query, query_params = page_query(sort, descending, after, page_size, where, params)
+    with tracked(monitor, query, query_params, source, f"browse/page by {sort}") as trace:
+        with pool.connection() as conn:
+            cursor = _streaming_cursor(conn)
+            try:
+                with trace.phase("execute"):
+                    cursor.execute(adapt_query(query, dialect_of(conn)), query_params)
+                with trace.phase("fetch"):
+                    columns = [c_name[0] for c_name in cursor.description]
+                    rows = cursor.fetchmany(page_size + 1)
+            finally:
+                cursor.close()
+        trace.rows = len(rows)
+    return columns, rows
+
+
+def fetch_page(pool, sort="stop_date", descending=False, after=None, page_size=50, where="", params=(),
+               monitor=None, source="live"):
+    columns, rows = fetch_rows(pool, sort, descending, after, page_size, where, params, monitor, source)
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    data = decode_rows(rows, columns)
+    next_cursor = None
+    if rows:
+        last = dict(zip(columns, rows[-1]))
+        next_cursor = tuple(last[k] for k in SORT_KEYS[sort])
+    return Page(data, next_cursor, has_more)
+
+
+def _count_query(dialect, where):
+    # planner/statistics estimates instead of COUNT(*) so the count costs the same at any table size
+    if dialect == "sqlite":
+        if where:
+            return f"SELECT COUNT(*) FROM {TABLE} WHERE {where}"
+        return f"SELECT COALESCE(MAX(id) - MIN(id) + 1, 0) FROM {TABLE}"
+    if not where:
+        return ("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = 'policedb' AND TABLE_NAME = 'logs'")
+    return f"EXPLAIN SELECT id FROM {TABLE} WHERE {where}"
+
+
+def approximate_count(pool, where="", params=(), monitor=None, source="live"):
+    with pool.connection() as conn:
+        dialect = dialect_of(conn)
+        query = _count_query(dialect, where)
+        query_params = list(params) if where else None
+        cursor = conn.cursor()
+        try:
+            with tracked(monitor, query, query_params, source, "browse/approximate count") as trace:
+                with trace.phase("execute"):
+                    if query_params is None:
+                        cursor.execute(query)
+                    else:
+                        cursor.execute(adapt_query(query, dialect), query_params)
+                    row = cursor.fetchone()
+                trace.rows = 1
+            if dialect == "sqlite" or not where:
+                return int(row[0] or 0) if row else 0
+            columns = [c_name[0].lower() for c_name in cursor.description]
+            plan = dict(zip(columns, row))
+            return int((plan.get("rows") or 0) * float(plan.get("filtered") or 100) / 100)
+        finally:
+            cursor.close()
@@ -0,0 +1,69 @@
+from dataclasses import dataclass
+from typing import NamedTuple
+
+#key metrics computed in one aggregate pass on the database side
+
+class Metric(NamedTuple):
+    name: str
+    label: str
+    expression: str
+
+
+class MetricValue(NamedTuple):
+    name: str
+    label: str
+    value: int
+
+
+KEY_METRICS = [
+    Metric("total_stops", "🚓 Total Police Stops", "COUNT(*)"),
+    Metric("arrests", "🚨 Total Arrests",
+           "SUM(CASE WHEN LOWER(stop_outcome) LIKE '%arrest%' THEN 1 ELSE 0 END)"),
+    Metric("warnings", "⚠️ Total Warnings",
+           "SUM(CASE WHEN LOWER(stop_outcome) LIKE '%warning%' THEN 1 ELSE 0 END)"),
+    Metric("drug_stops", "💊 Drug Related Stops",
+           "SUM(CASE WHEN drugs_related_stop = 1 THEN 1 ELSE 0 END)"),
+]
+
+
+def register_metric(name, label, expression):
+    # expression is any SQL aggregate over one logs row, e.g. SUM(CASE WHEN ... THEN 1 ELSE 0 END)
+    if any(m.name == name for m in KEY_METRICS):
+        raise ValueError(f"metric {name!r} is already registered")
+    KEY_METRICS.append(Metric(name, label, expression))
+
+
+def metrics_query(metrics=None, table="policedb.logs"):
+    metrics = KEY_METRICS if metrics is None else metrics
+    columns = ",\n       ".join(f"COALESCE({m.expression}, 0) AS {m.name}" for m in metrics)
+    return f"SELECT {columns}\nFROM {table}"
+
+
+@dataclass(frozen=True)
+class MetricsResult:
+    values: tuple
+
+    def __getitem__(self, name):
+        if isinstance(name, int):
+            return self.values[name]
+        for metric in self.values:
+            if metric.name == name:
+                return metric.value
+        raise KeyError(name)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+
+def compute_metrics(fetch, metrics=None, table="policedb.logs"):
+    # fetch is fetch_data (or anything returning a one-row DataFrame for a query)
+    metrics = KEY_METRICS if metrics is None else metrics
+    row = fetch(metrics_query(metrics, table))
+    values = []
+    for metric in metrics:
+        value = 0 if row.empty else row[metric.name].iloc[0]
+        values.append(MetricValue(metric.name, metric.label, int(value or 0)))
+    return MetricsResult(tuple(values))
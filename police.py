@@ -1,41 +1,94 @@
 import pandas as pd
 import streamlit as st
-import pymysql
-import matplotlib.pyplot as plt
-import cryptography
+from metrics import compute_metrics
+from log_browser import SORT_KEYS
+from write_queue import InvalidStop, WriterBusy
+from analyses import QUERY_MAP
+from frames import date_text, time_text
+from service import AnalyticsService, QueryFailed
 
-#DB connection
+#analytics service: connections, caches, indexes and writers, shared across sessions and reruns
+
+# SECURECHECK_SQLITE, SECURECHECK_SNAPSHOT, SECURECHECK_SLOW_MS, SECURECHECK_QUERY_LOG,
+# SECURECHECK_SHARDS and SECURECHECK_SPOOL_DIR are read by the service (see service.py), which builds
+# each part on first use; the dashboard's stop writer spools to its own file
+
+@st.cache_resource
+def get_service():
+    return AnalyticsService.from_env("dashboard")
+
+SHARDS_PATH = get_service().settings.shards_path
+
+def get_monitor():
+    return get_service().monitor
+
+def get_predictor():
+    return get_service().predictor
+
+def get_alerts():
+    return get_service().alerts
+
+def get_writer():
+    return get_service().writer
+
+def get_rollups():
+    return get_service().rollups
+
+def get_approx():
+    return get_service().approx
 
-def new_connection():
-    try:
-        mydb = pymysql.connect(
-            host="localhost",
-            user="root",
-            password="",
-            database="policedb"
-        )
-        return mydb
-    except pymysql.MySQLError as e:
-        st.error(f"Connection Error: {e}")
-        return None
-       
 #fetch data
 
-def fetch_data(query):
-    conn=new_connection()
-    if conn:
-        try:
-            cursor=conn.cursor()
-            cursor.execute(query)
-            data=cursor.fetchall()
-            columns=[c_name[0] for c_name in cursor.description]
-            data=pd.DataFrame(data,columns=columns)
-            return data
-        finally:
-            conn.close()
-    else:
+def fetch_data(query, params=None, cached=True, snapshot=False, label="", group_by=()):
+    try:
+        return get_service().fetch(query, params, cached, snapshot, label, group_by)
+    except QueryFailed as e:
+        st.error(str(e))
         return pd.DataFrame()
 
+#paginated log browser
+
+def format_stop_time(data):
+    # stop_date and stop_time come back as datetime64/timedelta64, shown as plain text
+    if 'stop_date' in data.columns:
+        data['stop_date'] = date_text(data['stop_date'])
+    if 'stop_time' in data.columns:
+        data['stop_time'] = time_text(data['stop_time'])
+    return data
+
+def show_logs_browser(key, where="", params=(), plans=None):
+    # plans maps shard name -> (where, params) in sharded mode, None browses every shard
+    col1, col2, col3 = st.columns(3)
+    sort = col1.selectbox("Sort by", list(SORT_KEYS), key=f"{key}_sort")
+    descending = col2.checkbox("Descending", key=f"{key}_desc")
+    page_size = col3.selectbox("Rows per page", [25, 50, 100, 500], index=1, key=f"{key}_size")
+
+    # cursors[i] is the keyset position page i starts after, reset when the view changes
+    view = (sort, descending, page_size, where, tuple(params),
+            plans and tuple((name, w, tuple(p)) for name, (w, p) in sorted(plans.items())))
+    nav = st.session_state.setdefault(key, {"view": None, "cursors": [None]})
+    if nav["view"] != view:
+        nav["view"] = view
+        nav["cursors"] = [None]
+
+    try:
+        page, total = get_service().browse(sort, descending, nav["cursors"][-1], page_size, where, params, plans)
+    except QueryFailed as e:
+        st.error(str(e))
+        return None
+
+    st.caption(f"Page {len(nav['cursors'])} · about {total:,} matching logs")
+    st.dataframe(format_stop_time(page.rows), use_container_width=True)
+
+    prev_col, next_col = st.columns(2)
+    if prev_col.button("⬅️ Previous", key=f"{key}_prev", disabled=len(nav["cursors"]) == 1):
+        nav["cursors"].pop()
+        st.rerun()
+    if next_col.button("Next ➡️", key=f"{key}_next", disabled=not page.has_more):
+        nav["cursors"].append(page.next_cursor)
+        st.rerun()
+    return page
+
 print("All packages loaded successfully!")
 
 #streamlit UI
@@ -47,9 +100,25 @@ st.title("🚓 SecureCheck: Police Post Dashboard")
 
 menu = st.sidebar.selectbox(
     "Navigate",
-    ["Home", "View logs","Add Logs"]
+    ["Home", "View logs","Add Logs","Diagnostics"]
 )
 
+# analytics can run on the Parquet snapshot instead of competing with check-post writes
+analytics_source = st.sidebar.radio("Analytics source", ["Live database", "Columnar snapshot"])
+use_snapshot = analytics_source == "Columnar snapshot"
+
+# only what this session has already used is shown, the sidebar doesn't start the writer or the shards
+service_stats = get_service().stats()
+
+with st.sidebar.expander("🔌 Connection pool"):
+    st.json(service_stats.get("shards" if SHARDS_PATH else "pool", {}))
+
+with st.sidebar.expander("🗃️ Query cache"):
+    st.json(service_stats.get("cache", {}))
+
+with st.sidebar.expander("📝 Log writer"):
+    st.json(service_stats.get("writer", {}))
+
 #Home page
 
 #Title and description
@@ -69,32 +138,44 @@ if menu == "Home":
 #metics
 
     st.header("📊Key Metrics")
-    query="select * from policedb.logs"
-    data=fetch_data(query)
-    col1, col2, col3, col4 = st.columns(4)
-    with col1:
-        total_stops=data.shape[0]
-        st.metric("🚓 Total Police Stops", total_stops)
-
-    with col2:
-            
-        arrests = data[data["stop_outcome"].str.contains("arrest", case=False, na=False)].shape[0]
-        st.metric("🚨 Total Arrests", arrests)
-
-    with col3:
-        warnings = data[data["stop_outcome"].str.contains("Warning", case=False, na=False)].shape[0]
-        st.metric("⚠️ Total Warnings", warnings)
-
-    with col4:
-        drug_stop = data[data["drugs_related_stop"] == 1].shape[0]
-        st.metric("💊 Drug Related Stops", drug_stop)
+    key_metrics=compute_metrics(fetch_data)
+    for col, metric in zip(st.columns(len(key_metrics)), key_metrics):
+        with col:
+            st.metric(metric.label, metric.value)
+
+#flagged vehicle alerts
+
+    st.header("🚨 Flagged Vehicle Alerts")
+    alerts = get_alerts()
+    alerts.scan_new()
+    hits = alerts.recent_hits()
+    if hits:
+        st.dataframe(pd.DataFrame(hits), use_container_width=True)
+    else:
+        st.info("No flagged vehicles seen since the dashboard started.")
+
+    with st.expander("🛑 Manage watchlist"):
+        with st.form("watchlist_form"):
+            pattern = st.text_input("Plate or pattern (use * and ? as wildcards)")
+            reason = st.text_input("Reason")
+            flag_clicked = st.form_submit_button("Flag vehicle")
+        if flag_clicked and pattern:
+            try:
+                st.success(f"Flagged {alerts.flag(pattern, reason)}")
+            except ValueError as e:
+                # nothing left of the pattern once spaces and punctuation are dropped, or too long to store
+                st.error(f"Can't flag '{pattern}': {e}")
+        if st.button("Flag repeat drug/search offenders"):
+            get_rollups().refresh(force=True)
+            st.success(f"Flagged {len(alerts.promote_repeat_offenders())} repeat offenders")
+        watchlist = alerts.watchlist()
+        if watchlist:
+            st.dataframe(pd.DataFrame(watchlist, columns=["pattern", "reason", "kind"]), use_container_width=True)
 
 #display logs
 
     st.header("📋Police Logs Overview")
-    query="select * from policedb.logs"
-    data=fetch_data(query)
-    st.dataframe(data,use_container_width=True)
+    show_logs_browser("home_logs")
     st.markdown("---")  
     
 #description 
@@ -115,9 +196,11 @@ if menu == "Home":
     with tab[0]:
    
         query = "select violation, count(violation) as counts from policedb.logs group by violation"
-        data = fetch_data(query)
+        data = fetch_data(query, snapshot=use_snapshot, label="Stops By Violations", group_by=["violation"])
         st.dataframe(data)
 
+        # matplotlib is only loaded once a chart is drawn
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(figsize=(4, 2.5))
         ax.bar(data['violation'], data['counts'], color='red', width=0.5)
         ax.set_xlabel("Violation", fontsize=5)
@@ -132,9 +215,10 @@ if menu == "Home":
     with tab[1]:
    
         query = "select driver_gender, count(*) as count from policedb.logs group by driver_gender"
-        data = fetch_data(query)
+        data = fetch_data(query, snapshot=use_snapshot, label="Driver Gender Distribution", group_by=["driver_gender"])
         st.dataframe(data)
 
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(figsize=(4, 2.5)) 
         ax.bar(data['driver_gender'], data['count'], color='blue', width=0.5)
         ax.set_xlabel("Driver Gender", fontsize=5)
@@ -160,27 +244,18 @@ elif menu=="View logs":
     violation_input=st.text_input("🔍 Search by Violation")
     country_input=st.text_input("🔍 Search by Country")
    
-    query = "SELECT * FROM policedb.logs WHERE 1=1"
-
-    if vehicle_input:
-        query += f" AND vehicle_number LIKE '%{vehicle_input}%'"
-
-    if violation_input:
-        query += f" AND violation LIKE '%{violation_input}%'"
-
-    if country_input:
-        query += f" AND country_name LIKE '%{country_input}%'"
+    # shards whose check posts can't match the country are pruned before any query runs
+    where, params, plans, strategy, empty = get_service().plan_search(vehicle_input, violation_input, country_input)
+    with st.expander("🔎 Search plan"):
+        for step in strategy:
+            st.write(f"- {step}")
 
-    data=fetch_data(query)
-
-    if not data.empty:
-        if 'stop_time' in data.columns:
-            data['stop_time'] = data['stop_time'].apply(lambda x: str(x).split()[-1] if pd.notnull(x) else '')
-
-        st.success(f"✅ Showing {len(data)} matching logs")
-        st.dataframe(data)
-    else:
+    if empty:
         st.warning("⚠️ No matching logs found.")
+    else:
+        page = show_logs_browser("filtered_logs", where, params, plans)
+        if page is not None and page.rows.empty:
+            st.warning("⚠️ No matching logs found.")
     
     st.markdown("---")  
     
@@ -190,191 +265,33 @@ elif menu=="View logs":
 
     analysis_option = st.selectbox(
         "Choose 🚗 Vehicle/🧍Demographic/ 🕒 Time & Duration/ ⚖️ Violation-Based analysis to run:",
-        [
-            "Top 10 vehicle_Number involved in Drug-Related Stops",
-            "Most Frequently Searched Vehicles",
-            "Driver Age Group with Highest Arrest Rate",
-            "Gender Distribution of Drivers Stopped in each Country",
-            "Race & Gender Combination with Highest Search Rate",
-            "Time of Day with Most Traffic Stops",
-            "Average Stop Duration for different Violations",
-            "Night Stops More Likely to Lead to Arrests",
-            "Violations Most Associated with Searches or Arrests",
-            "Most Common Violations for Young Drivers Under 25",
-            "Violation Rarely Resulting in Search or Arrest",
-            "Countries Report with Highest Drug-Related Stop Rates",
-            "Arrest Rate by Country & Violation",
-            "Country has the Most Stops with Search Conducted",
-            "Yearly Breakdown of Stops and Arrests by Country",
-            "Driver Violation Trends by Age & Race",
-            "Time Period Analysis of Stops, Number of Stops by Year, Month, Hour of the Day",
-            "Violations with High Search & Arrest Rates",
-            "Driver Demographics by Country (Age, Gender and Race)",
-            "Top 5 Violations with Highest Arrest Rates"
-        ]
+        list(QUERY_MAP)
     )
 
-    query_map={
-        "Top 10 vehicle_Number involved in Drug-Related Stops": """ SELECT VEHICLE_NUMBER,COUNT(*) AS TOTAL_STOPS
-                                                                    FROM POLICEDB.LOGS
-                                                                    WHERE DRUGS_RELATED_STOP
-                                                                    GROUP BY VEHICLE_NUMBER
-                                                                    LIMIT 10; """,
-        "Most Frequently Searched Vehicles": """ SELECT VEHICLE_NUMBER,COUNT(*) AS TOTAL_SEARCHS
-                                                 FROM POLICEDB.LOGS
-                                                 WHERE SEARCH_TYPE != "NO SEARCH"
-                                                 GROUP BY VEHICLE_NUMBER
-                                                 ORDER BY  VEHICLE_NUMBER DESC
-                                                 LIMIT 10; """,
-        "Driver Age Group with Highest Arrest Rate": """ SELECT
-                                                            CASE
-                                                               WHEN driver_age < 18 THEN 'Under 18'
-                                                               WHEN driver_age BETWEEN 18 AND 25 THEN '18-25'
-                                                               WHEN driver_age BETWEEN 26 AND 40 THEN '26-40'
-                                                               WHEN driver_age BETWEEN 41 AND 60 THEN '41-60'
-                                                               ELSE '60+'
-                                                            END AS age_group,
-                                                            COUNT(*) AS arrest_count
-                                                            FROM POLICEDB.LOGS
-                                                            WHERE stop_outcome = 'Arrest'
-                                                            GROUP BY age_group
-                                                            ORDER BY arrest_count DESC; """,
-        "Gender Distribution of Drivers Stopped in each Country": """ SELECT COUNTRY_NAME,DRIVER_GENDER,COUNT(*) AS COUNT
-                                                                      FROM POLICEDB.LOGS
-                                                                      GROUP BY COUNTRY_NAME,DRIVER_GENDER
-                                                                      ORDER BY COUNTRY_NAME; """,
-        "Race & Gender Combination with Highest Search Rate": """SELECT DRIVER_RACE,DRIVER_GENDER,COUNT(*) AS STOP_COUNT
-                                                                 FROM POLICEDB.LOGS
-                                                                 WHERE SEARCH_TYPE != "No Search"
-                                                                 GROUP BY DRIVER_RACE,DRIVER_GENDER
-                                                                 ORDER BY STOP_COUNT DESC;
-                                                                 LIMIT 1; """,
-        "Time of Day with Most Traffic Stops": """SELECT HOUR(STOP_TIME) AS STOP_HOUR,COUNT(*) AS COUNT
-                                                 FROM POLICEDB.LOGS
-                                                 GROUP BY STOP_HOUR
-                                                 ORDER BY COUNT DESC; """,
-        "Average Stop Duration for different Violations": """SELECT VIOLATION,AVG(STOP_DURATION) AS AVG_STOP_DURATION
-                                                             FROM POLICEDB.LOGS
-                                                             GROUP BY VIOLATION
-                                                             ORDER BY AVG_STOP_DURATION DESC; """,
-        "Night Stops More Likely to Lead to Arrests": """SELECT 
-	                                                     CASE 
-		                                                     WHEN HOUR(STOP_TIME) BETWEEN 20 AND 23 
-                                                             OR HOUR(STOP_TIME) BETWEEN 0 AND 5 THEN 'NIGHT'
-		                                                     ELSE 'DAY'
-		                                                     END AS TIME_OF_THE_DAY, 
-                                                             COUNT(*) AS STOP_COUNTS,
-                                                             SUM(CASE WHEN IS_ARRESTED = 1 THEN  1 ELSE 0 END) AS TOTAL_ARREST,
-		                                                     ROUND(SUM(CASE WHEN IS_ARRESTED = 1 THEN  1 ELSE 0 END) * 100.0/COUNT(*),2) AS TOTAL_ARREST_PERCENTAGE
-                                                         FROM POLICEDB.LOGS
-                                                         GROUP BY TIME_OF_THE_DAY
-                                                         ORDER BY TOTAL_ARREST_PERCENTAGE DESC; """,
-        "Violations Most Associated with Searches or Arrests": """SELECT VIOLATION,SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) AS TOTAL_ARRESTED,
-                                                                  SUM(CASE WHEN SEARCH_CONDUCTED = 1 THEN 1 ELSE 0 END) AS TOTAL_SEARCH_CONDUCTED,
-                                                                  SUM(CASE WHEN IS_ARRESTED = 1 OR SEARCH_CONDUCTED = 1 THEN 1 ELSE 0 END) AS SEARCH_OR_ARREST
-                                                                  FROM POLICEDB.LOGS
-                                                                  GROUP BY VIOLATION
-                                                                  ORDER BY SEARCH_OR_ARREST DESC """,
-        "Most Common Violations for Young Drivers Under 25":""" SELECT violation, COUNT(*) AS count
-                                                                FROM traffic_stops
-                                                                WHERE driver_age < 25
-                                                                GROUP BY violation
-                                                                ORDER BY count DESC; """,
-        "Violation Rarely Resulting in Search or Arrest":""" SELECT VIOLATION,
-                                                             SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) AS TOTAL_ARRESTED,
-                                                             SUM(CASE WHEN SEARCH_CONDUCTED = 1 THEN 1 ELSE 0 END) AS TOTAL_SEARCH_CONDUCTED,
-                                                             SUM(CASE WHEN IS_ARRESTED = 1 OR SEARCH_CONDUCTED = 1 THEN 1 ELSE 0 END) AS SEARCH_OR_ARREST
-                                                             FROM POLICEDB.LOGS
-                                                             GROUP BY VIOLATION
-                                                             ORDER BY SEARCH_OR_ARREST 
-                                                             LIMIT 1; """,
-        "Countries Report with Highest Drug-Related Stop Rates": """ SELECT COUNTRY_NAME,
-                                                                     SUM(CASE WHEN DRUGS_RELATED_STOP =1 THEN 1 ELSE 0 END) AS DRUG_RELATED_STOPS,
-                                                                     ROUND(SUM(CASE WHEN DRUGS_RELATED_STOP =1 THEN 1 ELSE 0 END)*100.0/COUNT(*),2) AS PERCENTAGE_OF_DRUG_RELATED_STOPS
-                                                                     FROM POLICEDB.LOGS
-                                                                     GROUP BY COUNTRY_NAME
-                                                                     ORDER BY PERCENTAGE_OF_DRUG_RELATED_STOPS; """,
-        "Arrest Rate by Country & Violation":"""SELECT COUNTRY_NAME,
-                                                VIOLATION,
-                                                ROUND(SUM(CASE WHEN IS_ARRESTED=1 THEN 1 ELSE 0 END)*100.0/COUNT(*),2) AS ARREST_RATE
-                                                FROM POLICEDB.LOGS
-                                                GROUP BY COUNTRY_NAME,VIOLATION
-                                                ORDER BY COUNTRY_NAME; """,
-        "Country has the Most Stops with Search Conducted": """ SELECT COUNTRY_NAME,COUNT(*)AS COUNT
-                                                                FROM POLICEDB.LOGS
-                                                                WHERE SEARCH_CONDUCTED=1
-                                                                GROUP BY COUNTRY_NAME
-                                                                ORDER BY COUNT DESC
-                                                                LIMIT 1; """,
-        "Yearly Breakdown of Stops and Arrests by Country": """ SELECT COUNTRY_NAME,STOP_YEAR,TOTAL_STOP,TOTAL_ARREST,
-                                                                ROUND(TOTAL_ARREST * 100.0 / TOTAL_STOP,2),
-                                                                RANK() OVER(PARTITION BY STOP_YEAR ORDER BY TOTAL_ARREST DESC) AS ARREST_RANK_IN_YEAR
-                                                                FROM
-                                                                (SELECT COUNTRY_NAME,YEAR(STOP_TIME) AS STOP_YEAR,COUNT(*) AS TOTAL_STOP,
-                                                                 SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) AS TOTAL_ARREST
-                                                                 FROM POLICEDB.LOGS
-                                                                 GROUP BY COUNTRY_NAME,STOP_YEAR
-                                                                 ORDER BY STOP_YEAR
-                                                                ) AS YEARLY_STATS;""",
-        "Driver Violation Trends by Age & Race": """ SELECT DRIVER_RACE,VIOLATION,AGE_GROUP,COUNT(*) AS STOP_COUNT 
-                                                      FROM
-                                                      (SELECT DRIVER_RACE,VIOLATION,
-                                                      CASE
-	                                                  WHEN DRIVER_AGE < 18 THEN 'UNDER 18'
-                                                      WHEN DRIVER_AGE BETWEEN 18 AND 25 THEN '18-25'
-	                                                  WHEN DRIVER_AGE BETWEEN 26 AND 40 THEN '26-40'
-	                                                  WHEN DRIVER_AGE BETWEEN 41 AND 60 THEN '41-60'
-	                                                  ELSE'ABOVE 60'
-                                                      END AS AGE_GROUP
-                                                      FROM POLICEDB.LOGS) AS SUB
-                                                    GROUP BY DRIVER_RACE,VIOLATION,AGE_GROUP
-                                                    ORDER BY STOP_COUNT DESC;""",
-        "Time Period Analysis of Stops, Number of Stops by Year, Month, Hour of the Day": """ SELECT EXTRACT(YEAR FROM STOP_DATE) AS YEAR,
-                                                                                              EXTRACT(MONTH FROM STOP_DATE) AS MONTH,
-                                                                                              EXTRACT(HOUR FROM STOP_TIME) AS HOUR,
-                                                                                              COUNT(*) AS TOTAL_STOPS
-                                                                                              FROM POLICEDB.LOGS
-                                                                                              GROUP BY YEAR,MONTH,HOUR
-                                                                                              ORDER BY YEAR;""",
-        "Violations with High Search & Arrest Rates":"""SELECT VIOLATION,TOTAL_STOP,TOTAL_ARREST,TOTAL_SEARCH,
-                                                        ROUND(100*(TOTAL_ARREST/ TOTAL_STOP), 2) AS ARREST_RATE,
-                                                        ROUND(100*(TOTAL_SEARCH / TOTAL_STOP), 2) AS SEARCH_RATE,
-                                                        RANK() OVER (ORDER BY (TOTAL_ARREST * 1.0 / TOTAL_STOP) DESC) AS ARREST_RANK,
-                                                        RANK() OVER (ORDER BY (TOTAL_SEARCH * 1.0 / TOTAL_STOP) DESC) AS SEARCH_RANK
-                                                        FROM (
-                                                        SELECT VIOLATION,COUNT(*) AS TOTAL_STOP,
-                                                        SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) AS TOTAL_ARREST,
-                                                        SUM(CASE WHEN SEARCH_CONDUCTED = 1 THEN 1 ELSE 0 END) AS TOTAL_SEARCH
-                                                        FROM POLICEDB.LOGS
-                                                        GROUP BY VIOLATION;) AS LOGS
-                                                        ORDER BY ARREST_RANK ASC,SEARCH_RANK ASC;""",
-        "Driver Demographics by Country (Age, Gender and Race)":""" SELECT 
-                                                                    COUNTRY_NAME,CASE
-                                                                    WHEN DRIVER_AGE < 18 THEN 'UNDER 18'
-                                                                    WHEN DRIVER_AGE BETWEEN 18 AND 25 THEN '18-25'
-                                                                    WHEN DRIVER_AGE BETWEEN 26 AND 40 THEN '26-40'
-                                                                    WHEN DRIVER_AGE BETWEEN 41 AND 60 THEN '41-60'
-                                                                    ELSE'ABOVE 60'
-                                                                    END AS AGE_GROUP,
-                                                                    DRIVER_GENDER,DRIVER_RACE,COUNT(*)AS TOTAL_COUNT
-                                                                    FROM POLICEDB.LOGS
-                                                                    GROUP BY COUNTRY_NAME,AGE_GROUP,DRIVER_GENDER,DRIVER_RACE
-                                                                    ORDER BY COUNTRY_NAME,AGE_GROUP,DRIVER_GENDER,DRIVER_RACE;""",
-        "Top 5 Violations with Highest Arrest Rates":""" SELECT VIOLATION,TOTAL_ARREST,ARREST_RATE
-                                                         FROM (
-                                                         SELECT VIOLATION,COUNT(*) AS TOTAL_STOP,SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) AS TOTAL_ARREST,
-                                                         ROUND(100.0 * SUM(CASE WHEN IS_ARRESTED = 1 THEN 1 ELSE 0 END) / COUNT(*), 4) AS ARREST_RATE
-                                                         FROM POLICEDB.LOGS
-                                                         GROUP BY VIOLATION
-                                                         ) AS ARREST_LOGS
-                                                        ORDER BY ARREST_RATE DESC;"""   
-    }
+    # exact by default, previews come from a sample and sketches of the live database
+    approximate = st.toggle("⚡ Approximate preview", value=False, disabled=use_snapshot,
+                            help="Sampled estimates with 95% error bounds, turn off for the exact answer")
+    approximate = approximate and not use_snapshot
+
     result=pd.DataFrame()
    
     if st.button("Run Analysis"):
-        query=query_map.get(analysis_option)
-    if query:
-        result=fetch_data(query)
+        # the chosen analysis stays on screen, so flipping the toggle refines it without another click
+        st.session_state["insight_option"] = analysis_option
+    if st.session_state.get("insight_option") == analysis_option:
+        # answered from the rollup tables, the raw query is kept for analyses without a rollup
+        try:
+            result, estimate = get_service().analysis(analysis_option, approximate, use_snapshot)
+        except QueryFailed as e:
+            st.error(str(e))
+            estimate = None
+        if estimate is not None:
+            result = pd.concat([estimate.result, estimate.margins.add_suffix(" ±")], axis=1)
+            distinct, distinct_margin = get_approx().distinct_vehicles()
+            st.caption(f"≈ Approximate: {estimate.method}. ± is the 95% error bound. "
+                       f"About {distinct:,.0f} ± {distinct_margin:,.0f} distinct vehicles.")
+        elif approximate and not result.empty:
+            st.caption("Exact answer: this analysis can't be previewed from the sample.")
 # display results
 
     if not result.empty:
@@ -393,9 +310,6 @@ elif menu=="Add Logs":
     st.subheader("🔍 Use natural language to filter past police stops and analyze trends.")
     st.markdown("📝 Fill in the details below to log a police stop and get a predicted outcome & violation.")
 
-    query = "select * from policedb.logs"
-    data = fetch_data(query)
-
     predicted_outcome = "Warning"   
     predicted_violation = "Speeding"
 
@@ -407,27 +321,47 @@ elif menu=="Add Logs":
         driver_race = st.selectbox("Race", ["Asian", "Black", "White", "Hispanic", "Other"])
         search_type = st.selectbox("Search Type", ["Vehicle Search", "Frisk", "No Search"])
         stop_outcome = st.selectbox("Stop Outcome", ["Arrest", "Ticket", "Warning"])
+        violation = st.selectbox("Violation", ["Speeding", "Signal", "DUI", "Seatbelt", "Other"])
+        stop_duration = st.selectbox("Stop Duration", ["0-15 Min", "16-30 Min", "30+ Min"])
         search_conducted = st.selectbox("Was a Search Conducted?", ["0", "1"])
         stop_date = st.date_input("Stop Date")
         stop_time = st.time_input("Stop Time")
         drugs_related_stop = st.selectbox("Was it drug related?", ["0", "1"])
         submitted = st.form_submit_button("✅ Predict Stop Outcome & Violation")
+        saved = st.form_submit_button("💾 Save Log")
 
-    if submitted:
-# convert stop_time to string for comparison
-        stop_time_str = stop_time.strftime('%H:%M:%S')  
-
-        filtered_data = data[
-            (data["driver_gender"] == driver_gender) &
-            (data["driver_age"] == driver_age) &
-            (data['search_conducted'] == int(search_conducted)) &
-            (data['stop_time'] == stop_time_str) &
-            (data['drugs_related_stop'] == int(drugs_related_stop))
-        ]
+    if saved:
+        try:
+            get_writer().submit({
+                "stop_date": stop_date,
+                "stop_time": stop_time,
+                "country_name": country_name,
+                "driver_gender": driver_gender[0],
+                "driver_age": driver_age,
+                "driver_race": driver_race,
+                "violation": violation,
+                "search_conducted": search_conducted,
+                "search_type": search_type,
+                "stop_outcome": stop_outcome,
+                "is_arrested": stop_outcome == "Arrest",
+                "stop_duration": stop_duration,
+                "drugs_related_stop": drugs_related_stop,
+                "vehicle_number": vehicle_number,
+            })
+            st.success("✅ Log saved, it will appear in the logs within a second")
+            for flagged, reason in get_alerts().match(vehicle_number):
+                st.error(f"🚨 {vehicle_number} is on the watchlist ({flagged}): {reason}")
+        except InvalidStop as e:
+            st.error(f"Invalid log: {e}")
+        except WriterBusy as e:
+            st.error(f"Too many logs waiting to be written, please retry: {e}")
 
-        if not filtered_data.empty:
-            predicted_outcome = filtered_data["stop_outcome"].mode()[0]
-            predicted_violation = filtered_data["violation"].mode()[0]
+    if submitted:
+        predictor = get_predictor()
+        predictor.refresh()
+        prediction = predictor.predict(driver_gender, driver_age, search_conducted, stop_time, drugs_related_stop)
+        predicted_outcome = prediction.outcome
+        predicted_violation = prediction.violation
 
         search_text = "A search was conducted" if int(search_conducted) else "No search was conducted"
         drug_text = "was drug related" if int(drugs_related_stop) else "was not drug related"
@@ -442,7 +376,48 @@ elif menu=="Add Logs":
             was stopped for **{predicted_violation}** at {stop_time.strftime('%I:%M %p')} on {stop_date}.
             **{search_text}**, received a **{predicted_outcome}**, and **{drug_text}**.
         """)
+        st.caption(f"Based on {prediction.support} past stops ({prediction.level}).")
         st.markdown("---")
     st.markdown("---")
     st.markdown("❤️Built for Law enforcement by Securecheck")
 
+#Diagnostics page
+
+elif menu=="Diagnostics":
+    st.subheader("🩺 Query diagnostics")
+    monitor = get_monitor()
+    st.caption(f"Queries slower than {monitor.slow_ms:.0f} ms keep their EXPLAIN plan."
+               + (f" Every query is also appended to {monitor.metrics_path}." if monitor.metrics_path else ""))
+    if st.button("Reset statistics"):
+        monitor.reset()
+
+    st.markdown("#### Heaviest queries")
+    summary = pd.DataFrame(monitor.summary())
+    if summary.empty:
+        st.info("No queries recorded yet.")
+    else:
+        st.dataframe(summary[["label", "source", "calls", "cache_hits", "errors", "total_ms", "avg_ms", "max_ms",
+                              "rows", "bytes", "sql"]], use_container_width=True)
+
+    st.markdown("#### Slow queries")
+    slow = monitor.slow()
+    if not slow:
+        st.info("No slow queries.")
+    for record in slow:
+        with st.expander(f"{record.total_ms:,.0f} ms · {record.label or record.sql[:60]} · {record.started_at:%H:%M:%S}"):
+            st.code(record.sql, language="sql")
+            if record.params is not None:
+                st.write("Params:", list(record.params))
+            st.write({"phases_ms": record.phases, "rows": record.rows, "bytes": record.bytes, "source": record.source})
+            st.text(record.plan or "no plan captured")
+
+    st.markdown("#### Recent queries")
+    recent = monitor.recent()
+    if recent:
+        st.dataframe(pd.DataFrame([{
+            "at": r.started_at.strftime("%H:%M:%S"), "label": r.label, "source": r.source, "total_ms": r.total_ms,
+            **{f"{name}_ms": r.phases.get(name) for name in ("execute", "fetch", "frame")},
+            "rows": r.rows, "bytes": r.bytes, "cached": r.cached, "error": r.error, "sql": r.sql,
+        } for r in recent]), use_container_width=True)
+    st.markdown("---")
+    st.markdown("❤️Built for Law enforcement by Securecheck")
@@ -0,0 +1,181 @@
+import datetime
+import threading
+import time
+from collections import Counter
+from typing import NamedTuple
+
+from db_pool import adapt_query, dialect_of
+from watermark import Watermark
+
+#outcome/violation predictor for the Add Logs page, answered from in-memory counts
+
+TABLE = "policedb.logs"
+BATCH = 50000
+
+DEFAULT_OUTCOME = "Warning"
+DEFAULT_VIOLATION = "Speeding"
+
+
+class Prediction(NamedTuple):
+    outcome: str
+    violation: str
+    level: str
+    support: int
+
+
+def normalize_time(value):
+    # pymysql returns TIME as timedelta, sqlite as text, the form gives datetime.time
+    if value is None:
+        return None
+    if isinstance(value, datetime.timedelta):
+        seconds = int(value.total_seconds()) % 86400
+        return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    if isinstance(value, (datetime.time, datetime.datetime)):
+        return value.strftime("%H:%M:%S")
+    text = str(value).split()[-1]
+    hours, _, rest = text.partition(":")
+    return f"{int(hours):02d}:{rest}"
+
+
+def normalize_gender(value):
+    # stops store "M"/"F", the Add Logs form offers "Male"/"Female"
+    if value is None:
+        return None
+    text = str(value).strip()
+    return text[:1].upper() if text else None
+
+
+def age_band(age):
+    if age is None:
+        return None
+    age = int(age)
+    if age < 18:
+        return "Under 18"
+    if age <= 25:
+        return "18-25"
+    if age <= 40:
+        return "26-40"
+    if age <= 60:
+        return "41-60"
+    return "60+"
+
+
+def _flag(value):
+    return None if value is None else int(value)
+
+
+def _features(driver_gender, driver_age, search_conducted, stop_time, drugs_related_stop):
+    return (normalize_gender(driver_gender), None if driver_age is None else int(driver_age),
+            _flag(search_conducted), _hour(stop_time), _flag(drugs_related_stop))
+
+
+def _hour(stop_time):
+    text = normalize_time(stop_time)
+    return text and text[:2]
+
+
+# most specific first: hour, then age band, then search/drug flags only; times are bucketed to the
+# hour so the index grows with the feature cardinality, not with the number of stops
+LEVELS = [
+    ("same hour", lambda g, a, s, h, d: (g, a, s, h, d)),
+    ("same age band and hour", lambda g, a, s, h, d: (g, age_band(a), s, h, d)),
+    ("same age band", lambda g, a, s, h, d: (g, age_band(a), s, d)),
+    ("same search and drug flags", lambda g, a, s, h, d: (s, d)),
+]
+
+
+def _mode(counter):
+    # same tie-break as pandas Series.mode()[0]: highest count, then smallest value
+    return min(counter.items(), key=lambda kv: (-kv[1], kv[0]))[0]
+
+
+class PredictionIndex:
+
+    def __init__(self, pool, refresh_interval=10.0):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._levels = [{} for _ in LEVELS]
+        self._overall = (Counter(), Counter())
+        self._watermark = Watermark()
+        self._refreshed_at = float("-inf")
+
+    def add(self, driver_gender, driver_age, search_conducted, stop_time, drugs_related_stop,
+            stop_outcome, violation):
+        with self._lock:
+            self._count(_features(driver_gender, driver_age, search_conducted, stop_time, drugs_related_stop),
+                        stop_outcome, violation, 1)
+
+    def _add_rows(self, rows):
+        # fold a fetched batch by its bucketed features first, so the levels are touched once per
+        # distinct combination rather than once per stop
+        batch = Counter((_features(*row[1:6]), row[6], row[7]) for row in rows)
+        for (features, stop_outcome, violation), count in batch.items():
+            self._count(features, stop_outcome, violation, count)
+
+    def _count(self, features, stop_outcome, violation, count):
+        for (_, key_fn), level in zip(LEVELS, self._levels):
+            key = key_fn(*features)
+            counts = level.get(key)
+            if counts is None:
+                counts = level[key] = (Counter(), Counter())
+            if stop_outcome is not None:
+                counts[0][stop_outcome] += count
+            if violation is not None:
+                counts[1][violation] += count
+        if stop_outcome is not None:
+            self._overall[0][stop_outcome] += count
+        if violation is not None:
+            self._overall[1][violation] += count
+
+    def refresh(self, force=False):
+        # pull only the stops inserted since the last refresh, and the ones that committed late below it
+        if self._due(force):
+            self._read(self.pool, self._watermark)
+
+    def _due(self, force):
+        with self._lock:
+            if not force and time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return False
+            self._refreshed_at = time.monotonic()
+            return True
+
+    def _read(self, pool, watermark):
+        with self._lock:
+            gaps = watermark.gap_filter()
+            last_id = watermark.last_id
+        columns = ("id, driver_gender, driver_age, search_conducted, stop_time, drugs_related_stop, "
+                   "stop_outcome, violation")
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            dialect = dialect_of(conn)
+            if gaps is not None:
+                cursor.execute(adapt_query(f"SELECT {columns} FROM {TABLE} WHERE {gaps[0]} ORDER BY id", dialect),
+                               gaps[1])
+                rows = cursor.fetchall()
+                with self._lock:
+                    self._add_rows(rows)
+                    watermark.fill([row[0] for row in rows])
+            query = adapt_query(f"SELECT {columns} FROM {TABLE} WHERE id > %s ORDER BY id LIMIT {BATCH}", dialect)
+            while True:
+                cursor.execute(query, (last_id,))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                with self._lock:
+                    self._add_rows(rows)
+                    watermark.advance_to([row[0] for row in rows], rows[-1][0])
+                last_id = rows[-1][0]
+
+    def predict(self, driver_gender, driver_age, search_conducted, stop_time, drugs_related_stop):
+        features = (normalize_gender(driver_gender), int(driver_age), _flag(search_conducted),
+                    _hour(stop_time), _flag(drugs_related_stop))
+        with self._lock:
+            for (name, key_fn), level in zip(LEVELS, self._levels):
+                counts = level.get(key_fn(*features))
+                if counts and counts[0] and counts[1]:
+                    return Prediction(_mode(counts[0]), _mode(counts[1]), name, sum(counts[0].values()))
+            outcomes, violations = self._overall
+            if outcomes and violations:
+                return Prediction(_mode(outcomes), _mode(violations), "all stops", sum(outcomes.values()))
+        return Prediction(DEFAULT_OUTCOME, DEFAULT_VIOLATION, "default", 0)
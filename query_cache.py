@@ -0,0 +1,169 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+#result cache in front of fetch_data
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_sql(query):
+    # collapse the indentation of the triple-quoted queries so equal statements share one key
+    return _SPACES.sub(" ", query).strip().rstrip(";").strip()
+
+
+def make_key(query, params=None, namespace=None):
+    # namespace separates backends that answer the same SQL from different data
+    if params is None:
+        return (namespace, normalize_sql(query), None)
+    if isinstance(params, dict):
+        return (namespace, normalize_sql(query), tuple(sorted(params.items())))
+    return (namespace, normalize_sql(query), tuple(params))
+
+
+def result_size(result):
+    try:
+        return int(result.memory_usage(index=True, deep=True).sum())
+    except AttributeError:
+        return 0
+
+
+class _Entry:
+    __slots__ = ("value", "size", "version", "expires_at")
+
+    def __init__(self, value, size, version, expires_at):
+        self.value = value
+        self.size = size
+        self.version = version
+        self.expires_at = expires_at
+
+
+class QueryCache:
+
+    def __init__(self, version_fn=None, ttl=300.0, max_entries=256, max_bytes=256 * 1024 * 1024,
+                 version_check_interval=2.0):
+        # version_fn returns a token that changes whenever the table changes, e.g. MAX(id)
+        self.version_fn = version_fn
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version_check_interval = version_check_interval
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._generation = 0
+        self._table_version = None
+        self._version_checked_at = float("-inf")
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def current_version(self):
+        # the version query is shared by every caller for version_check_interval seconds
+        now = time.monotonic()
+        with self._lock:
+            fresh = now - self._version_checked_at < self.version_check_interval
+            if fresh or self.version_fn is None:
+                return (self._generation, self._table_version)
+        table_version = self.version_fn()
+        with self._lock:
+            if table_version != self._table_version:
+                self._table_version = table_version
+                self._stats["invalidations"] += 1
+            self._version_checked_at = now
+            return (self._generation, self._table_version)
+
+    def invalidate(self):
+        # called by our own writes so readers don't wait for the next version check
+        with self._lock:
+            self._generation += 1
+            self._version_checked_at = float("-inf")
+            self._entries.clear()
+            self._bytes = 0
+            self._stats["invalidations"] += 1
+
+    def get(self, query, params=None, namespace=None):
+        key = make_key(query, params, namespace)
+        version = self.current_version()
+        with self._lock:
+            return self._lookup(key, version)
+
+    def _lookup(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.version != version or entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.value
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def put(self, query, params, value, version=None, namespace=None):
+        key = make_key(query, params, namespace)
+        if version is None:
+            version = self.current_version()
+        self._store(key, value, version)
+
+    def _store(self, key, value, version):
+        size = result_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if version != (self._generation, self._table_version):
+                # the table moved on while this result was computed
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(value, size, version, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats["evictions"] += 1
+
+    def get_or_compute(self, query, params, compute, namespace=None):
+        key = make_key(query, params, namespace)
+        version = self.current_version()
+        while True:
+            with self._lock:
+                value = self._lookup(key, version)
+                if value is not None:
+                    self._stats["hits"] += 1
+                    return _shallow_copy(value)
+                waiter = self._inflight.get(key)
+                if waiter is None:
+                    # this caller computes, concurrent callers for the same key wait for it
+                    done = threading.Event()
+                    self._inflight[key] = done
+                    self._stats["misses"] += 1
+                    break
+            # if the owner failed or its result wasn't stored, the next loop computes it here
+            waiter.wait()
+            version = self.current_version()
+        try:
+            value = compute()
+            self._store(key, value, version)
+            return _shallow_copy(value)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            done.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        return stats
+
+
+def _shallow_copy(value):
+    # callers reassign columns (e.g. stop_time formatting), keep the cached frame untouched
+    try:
+        return value.copy(deep=False)
+    except AttributeError:
+        return value
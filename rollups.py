@@ -0,0 +1,348 @@
+import threading
+import time
+
+from db_pool import adapt_query, dialect_of
+from watermark import GAPS_DDL, Watermark, between, load_gaps, read_runs, save_gaps
+
+#incrementally maintained rollup tables behind the View logs insights
+
+TABLE = "policedb.logs"
+BATCH = 200000
+# late rows are folded by id, this many per statement
+LATE_BATCH = 1000
+
+ARRESTED = "SUM(CASE WHEN is_arrested = 1 THEN 1 ELSE 0 END)"
+SEARCHED = "SUM(CASE WHEN search_conducted = 1 THEN 1 ELSE 0 END)"
+DRUGS = "SUM(CASE WHEN drugs_related_stop = 1 THEN 1 ELSE 0 END)"
+
+# rollup keys are primary keys, so NULLs are stored as sentinels: '' for text, -1 for the hour and
+# 999 for the age (999 falls into the ELSE band of every age CASE, like NULL did on the raw table)
+CUBES = {
+    "rollup_daily": {
+        "dims": [
+            ("stop_date", "DATE", "COALESCE(stop_date, '1000-01-01')"),
+            ("stop_hour", "INT", "COALESCE(HOUR(stop_time), -1)"),
+            ("country_name", "VARCHAR(50)", "COALESCE(country_name, '')"),
+        ],
+        "measures": [
+            ("stops", "BIGINT", "COUNT(*)"),
+            ("arrests", "BIGINT", ARRESTED),
+        ],
+    },
+    "rollup_profile": {
+        "dims": [
+            ("country_name", "VARCHAR(50)", "COALESCE(country_name, '')"),
+            ("violation", "VARCHAR(100)", "COALESCE(violation, '')"),
+            ("driver_gender", "VARCHAR(10)", "COALESCE(driver_gender, '')"),
+            ("driver_race", "VARCHAR(50)", "COALESCE(driver_race, '')"),
+            ("driver_age", "INT", "COALESCE(driver_age, 999)"),
+        ],
+        "measures": [
+            ("stops", "BIGINT", "COUNT(*)"),
+            ("arrests", "BIGINT", ARRESTED),
+            ("arrest_outcomes", "BIGINT", "SUM(CASE WHEN LOWER(stop_outcome) = 'arrest' THEN 1 ELSE 0 END)"),
+            ("searches", "BIGINT", SEARCHED),
+            ("typed_searches", "BIGINT", "SUM(CASE WHEN LOWER(search_type) <> 'no search' THEN 1 ELSE 0 END)"),
+            ("searched_or_arrested", "BIGINT",
+             "SUM(CASE WHEN is_arrested = 1 OR search_conducted = 1 THEN 1 ELSE 0 END)"),
+            ("drug_stops", "BIGINT", DRUGS),
+            # AVG(stop_duration) on the raw table averages the leading number of '16-30 Min' etc.
+            ("duration_sum", "DOUBLE", "SUM({duration})"),
+            ("duration_count", "BIGINT", "COUNT(stop_duration)"),
+        ],
+    },
+    "rollup_vehicle": {
+        "dims": [
+            ("vehicle_number", "VARCHAR(50)", "COALESCE(vehicle_number, '')"),
+        ],
+        "measures": [
+            ("stops", "BIGINT", "COUNT(*)"),
+            ("drug_stops", "BIGINT", DRUGS),
+            ("typed_searches", "BIGINT", "SUM(CASE WHEN LOWER(search_type) <> 'no search' THEN 1 ELSE 0 END)"),
+        ],
+    },
+}
+
+DURATION_NUMBER = {
+    "mysql": "(stop_duration + 0)",
+    "sqlite": "CAST(stop_duration AS REAL)",
+}
+
+
+#schema and maintenance SQL
+
+def create_sql(name, measure_kind=None):
+    # measure_kind overrides the measure column types, e.g. REAL for weighted estimates
+    cube = CUBES[name]
+    columns = [f"{dim} {kind} NOT NULL" for dim, kind, _ in cube["dims"]]
+    columns += [f"{measure} {measure_kind or kind} NOT NULL DEFAULT 0" for measure, kind, _ in cube["measures"]]
+    keys = ", ".join(dim for dim, _, _ in cube["dims"])
+    return f"CREATE TABLE IF NOT EXISTS policedb.{name} ({', '.join(columns)}, PRIMARY KEY ({keys}))"
+
+
+def upsert_sql(name, dialect, where="id > %s AND id <= %s"):
+    # fold the aggregate of the logs rows matching where, by default (low, high], into the existing cube cells
+    cube = CUBES[name]
+    dims = [dim for dim, _, _ in cube["dims"]]
+    measures = [measure for measure, _, _ in cube["measures"]]
+    selects = [f"{expression} AS {dim}" for dim, _, expression in cube["dims"]]
+    # a cell whose stops have no duration sums to NULL, the cube columns are NOT NULL
+    selects += [f"COALESCE({expression.format(duration=DURATION_NUMBER[dialect])}, 0)"
+                for _, _, expression in cube["measures"]]
+    query = (
+        f"INSERT INTO policedb.{name} ({', '.join(dims + measures)}) "
+        f"SELECT {', '.join(selects)} FROM {TABLE} WHERE {where} "
+        f"GROUP BY {', '.join(str(i + 1) for i in range(len(dims)))} "
+    )
+    if dialect == "sqlite":
+        updates = ", ".join(f"{m} = {m} + excluded.{m}" for m in measures)
+        return query + f"ON CONFLICT ({', '.join(dims)}) DO UPDATE SET {updates}"
+    updates = ", ".join(f"{m} = {m} + VALUES({m})" for m in measures)
+    return query + f"ON DUPLICATE KEY UPDATE {updates}"
+
+
+class Rollups:
+
+    def __init__(self, pool, refresh_interval=5.0):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._refreshed_at = float("-inf")
+
+    def ensure_tables(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            for name in CUBES:
+                cursor.execute(create_sql(name))
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS policedb.rollup_state ("
+                "name VARCHAR(50) PRIMARY KEY, last_id INT NOT NULL)"
+            )
+            cursor.execute(GAPS_DDL)
+            conn.commit()
+
+    def refresh(self, force=False):
+        # fold logs rows added since the last refresh into every cube, one id range per transaction,
+        # after the rows that committed late below the watermark
+        with self._lock:
+            if not force and time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return 0
+            self._refreshed_at = time.monotonic()
+            folded = 0
+            late = True
+            with self.pool.connection() as conn:
+                dialect = dialect_of(conn)
+                cursor = conn.cursor()
+                while True:
+                    watermark, max_id = self._claim(cursor, dialect)
+                    try:
+                        rows = self._fold_late(cursor, dialect, watermark) if late else 0
+                        late = False
+                        if max_id > watermark.last_id:
+                            rows += self._fold_range(cursor, dialect, watermark,
+                                                     min(max_id, watermark.last_id + BATCH))
+                        elif not rows:
+                            conn.commit()
+                            break
+                        cursor.execute(adapt_query(
+                            "UPDATE policedb.rollup_state SET last_id = %s WHERE name = 'logs'", dialect),
+                            (watermark.last_id,))
+                        save_gaps(cursor, dialect, "rollups", watermark.gaps)
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    folded += rows
+            return folded
+
+    def _fold_range(self, cursor, dialect, watermark, high):
+        # ids missing from (last_id, high] now are left out of the fold and kept as gaps
+        low = watermark.last_id
+        rows, runs = read_runs(cursor, dialect, TABLE, low, high)
+        where, params = "id > %s AND id <= %s", [low, high]
+        if runs:
+            gaps, gap_params = between(runs)
+            where += f" AND NOT {gaps}"
+            params += gap_params
+        for name in CUBES:
+            cursor.execute(adapt_query(upsert_sql(name, dialect, where), dialect), params)
+        watermark.advance(high, runs)
+        return rows
+
+    def _fold_late(self, cursor, dialect, watermark):
+        gaps = watermark.gap_filter()
+        if gaps is None:
+            return 0
+        cursor.execute(adapt_query(f"SELECT id FROM {TABLE} WHERE {gaps[0]} ORDER BY id", dialect), gaps[1])
+        ids = [row[0] for row in cursor.fetchall()]
+        for start in range(0, len(ids), LATE_BATCH):
+            chunk = ids[start:start + LATE_BATCH]
+            where = f"id IN ({', '.join(['%s'] * len(chunk))})"
+            for name in CUBES:
+                cursor.execute(adapt_query(upsert_sql(name, dialect, where), dialect), chunk)
+        watermark.fill(ids)
+        return len(ids)
+
+    def _claim(self, cursor, dialect):
+        # the state row lock keeps two servers from folding the same id range twice
+        if dialect == "sqlite":
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("INSERT OR IGNORE INTO policedb.rollup_state (name, last_id) VALUES ('logs', 0)")
+            cursor.execute("SELECT last_id FROM policedb.rollup_state WHERE name = 'logs'")
+        else:
+            cursor.execute("INSERT IGNORE INTO policedb.rollup_state (name, last_id) VALUES ('logs', 0)")
+            cursor.execute("SELECT last_id FROM policedb.rollup_state WHERE name = 'logs' FOR UPDATE")
+        watermark = Watermark(cursor.fetchone()[0], load_gaps(cursor, dialect, "rollups"))
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE}")
+        return watermark, cursor.fetchone()[0]
+
+
+#the View logs insights, answered from the cubes
+
+def _age_group(labels):
+    under_18, young, adult, middle, senior = labels
+    return (
+        f"CASE WHEN driver_age < 18 THEN '{under_18}' "
+        f"WHEN driver_age BETWEEN 18 AND 25 THEN '{young}' "
+        f"WHEN driver_age BETWEEN 26 AND 40 THEN '{adult}' "
+        f"WHEN driver_age BETWEEN 41 AND 60 THEN '{middle}' "
+        f"ELSE '{senior}' END"
+    )
+
+
+AGE_GROUP = _age_group(["Under 18", "18-25", "26-40", "41-60", "60+"])
+AGE_GROUP_UPPER = _age_group(["UNDER 18", "18-25", "26-40", "41-60", "ABOVE 60"])
+NIGHT = "CASE WHEN stop_hour BETWEEN 20 AND 23 OR stop_hour BETWEEN 0 AND 5 THEN 'NIGHT' ELSE 'DAY' END"
+
+ROLLUP_QUERIES = {
+    "Top 10 vehicle_Number involved in Drug-Related Stops": """
+        SELECT vehicle_number AS VEHICLE_NUMBER, drug_stops AS TOTAL_STOPS
+        FROM policedb.rollup_vehicle
+        WHERE drug_stops > 0
+        ORDER BY drug_stops DESC
+        LIMIT 10""",
+    "Most Frequently Searched Vehicles": """
+        SELECT vehicle_number AS VEHICLE_NUMBER, typed_searches AS TOTAL_SEARCHS
+        FROM policedb.rollup_vehicle
+        WHERE typed_searches > 0
+        ORDER BY vehicle_number DESC
+        LIMIT 10""",
+    "Driver Age Group with Highest Arrest Rate": f"""
+        SELECT {AGE_GROUP} AS age_group, SUM(arrest_outcomes) AS arrest_count
+        FROM policedb.rollup_profile
+        GROUP BY age_group
+        HAVING SUM(arrest_outcomes) > 0
+        ORDER BY arrest_count DESC""",
+    "Gender Distribution of Drivers Stopped in each Country": """
+        SELECT country_name AS COUNTRY_NAME, driver_gender AS DRIVER_GENDER, SUM(stops) AS COUNT
+        FROM policedb.rollup_profile
+        GROUP BY country_name, driver_gender
+        ORDER BY country_name""",
+    "Race & Gender Combination with Highest Search Rate": """
+        SELECT driver_race AS DRIVER_RACE, driver_gender AS DRIVER_GENDER, SUM(typed_searches) AS STOP_COUNT
+        FROM policedb.rollup_profile
+        GROUP BY driver_race, driver_gender
+        HAVING SUM(typed_searches) > 0
+        ORDER BY STOP_COUNT DESC
+        LIMIT 1""",
+    "Time of Day with Most Traffic Stops": """
+        SELECT stop_hour AS STOP_HOUR, SUM(stops) AS COUNT
+        FROM policedb.rollup_daily
+        GROUP BY stop_hour
+        ORDER BY COUNT DESC""",
+    "Average Stop Duration for different Violations": """
+        SELECT violation AS VIOLATION, SUM(duration_sum) / NULLIF(SUM(duration_count), 0) AS AVG_STOP_DURATION
+        FROM policedb.rollup_profile
+        GROUP BY violation
+        ORDER BY AVG_STOP_DURATION DESC""",
+    "Night Stops More Likely to Lead to Arrests": f"""
+        SELECT {NIGHT} AS TIME_OF_THE_DAY,
+               SUM(stops) AS STOP_COUNTS,
+               SUM(arrests) AS TOTAL_ARREST,
+               ROUND(SUM(arrests) * 100.0 / SUM(stops), 2) AS TOTAL_ARREST_PERCENTAGE
+        FROM policedb.rollup_daily
+        GROUP BY TIME_OF_THE_DAY
+        ORDER BY TOTAL_ARREST_PERCENTAGE DESC""",
+    "Violations Most Associated with Searches or Arrests": """
+        SELECT violation AS VIOLATION, SUM(arrests) AS TOTAL_ARRESTED,
+               SUM(searches) AS TOTAL_SEARCH_CONDUCTED, SUM(searched_or_arrested) AS SEARCH_OR_ARREST
+        FROM policedb.rollup_profile
+        GROUP BY violation
+        ORDER BY SEARCH_OR_ARREST DESC""",
+    "Most Common Violations for Young Drivers Under 25": """
+        SELECT violation, SUM(stops) AS count
+        FROM policedb.rollup_profile
+        WHERE driver_age < 25
+        GROUP BY violation
+        ORDER BY count DESC""",
+    "Violation Rarely Resulting in Search or Arrest": """
+        SELECT violation AS VIOLATION, SUM(arrests) AS TOTAL_ARRESTED,
+               SUM(searches) AS TOTAL_SEARCH_CONDUCTED, SUM(searched_or_arrested) AS SEARCH_OR_ARREST
+        FROM policedb.rollup_profile
+        GROUP BY violation
+        ORDER BY SEARCH_OR_ARREST
+        LIMIT 1""",
+    "Countries Report with Highest Drug-Related Stop Rates": """
+        SELECT country_name AS COUNTRY_NAME, SUM(drug_stops) AS DRUG_RELATED_STOPS,
+               ROUND(SUM(drug_stops) * 100.0 / SUM(stops), 2) AS PERCENTAGE_OF_DRUG_RELATED_STOPS
+        FROM policedb.rollup_profile
+        GROUP BY country_name
+        ORDER BY PERCENTAGE_OF_DRUG_RELATED_STOPS""",
+    "Arrest Rate by Country & Violation": """
+        SELECT country_name AS COUNTRY_NAME, violation AS VIOLATION,
+               ROUND(SUM(arrests) * 100.0 / SUM(stops), 2) AS ARREST_RATE
+        FROM policedb.rollup_profile
+        GROUP BY country_name, violation
+        ORDER BY country_name""",
+    "Country has the Most Stops with Search Conducted": """
+        SELECT country_name AS COUNTRY_NAME, SUM(searches) AS COUNT
+        FROM policedb.rollup_profile
+        GROUP BY country_name
+        HAVING SUM(searches) > 0
+        ORDER BY COUNT DESC
+        LIMIT 1""",
+    "Yearly Breakdown of Stops and Arrests by Country": """
+        SELECT COUNTRY_NAME, STOP_YEAR, TOTAL_STOP, TOTAL_ARREST,
+               ROUND(TOTAL_ARREST * 100.0 / TOTAL_STOP, 2) AS ARREST_RATE,
+               RANK() OVER (PARTITION BY STOP_YEAR ORDER BY TOTAL_ARREST DESC) AS ARREST_RANK_IN_YEAR
+        FROM (SELECT country_name AS COUNTRY_NAME, YEAR(stop_date) AS STOP_YEAR,
+                     SUM(stops) AS TOTAL_STOP, SUM(arrests) AS TOTAL_ARREST
+              FROM policedb.rollup_daily
+              GROUP BY country_name, YEAR(stop_date)) AS YEARLY_STATS
+        ORDER BY STOP_YEAR""",
+    "Driver Violation Trends by Age & Race": f"""
+        SELECT driver_race AS DRIVER_RACE, violation AS VIOLATION, {AGE_GROUP_UPPER} AS AGE_GROUP,
+               SUM(stops) AS STOP_COUNT
+        FROM policedb.rollup_profile
+        GROUP BY driver_race, violation, AGE_GROUP
+        ORDER BY STOP_COUNT DESC""",
+    "Time Period Analysis of Stops, Number of Stops by Year, Month, Hour of the Day": """
+        SELECT YEAR(stop_date) AS YEAR, MONTH(stop_date) AS MONTH, stop_hour AS HOUR, SUM(stops) AS TOTAL_STOPS
+        FROM policedb.rollup_daily
+        GROUP BY YEAR(stop_date), MONTH(stop_date), stop_hour
+        ORDER BY YEAR""",
+    "Violations with High Search & Arrest Rates": """
+        SELECT VIOLATION, TOTAL_STOP, TOTAL_ARREST, TOTAL_SEARCH,
+               ROUND(100.0 * TOTAL_ARREST / TOTAL_STOP, 2) AS ARREST_RATE,
+               ROUND(100.0 * TOTAL_SEARCH / TOTAL_STOP, 2) AS SEARCH_RATE,
+               RANK() OVER (ORDER BY TOTAL_ARREST * 1.0 / TOTAL_STOP DESC) AS ARREST_RANK,
+               RANK() OVER (ORDER BY TOTAL_SEARCH * 1.0 / TOTAL_STOP DESC) AS SEARCH_RANK
+        FROM (SELECT violation AS VIOLATION, SUM(stops) AS TOTAL_STOP,
+                     SUM(arrests) AS TOTAL_ARREST, SUM(searches) AS TOTAL_SEARCH
+              FROM policedb.rollup_profile
+              GROUP BY violation) AS VIOLATION_STATS
+        ORDER BY ARREST_RANK, SEARCH_RANK""",
+    "Driver Demographics by Country (Age, Gender and Race)": f"""
+        SELECT country_name AS COUNTRY_NAME, {AGE_GROUP_UPPER} AS AGE_GROUP,
+               driver_gender AS DRIVER_GENDER, driver_race AS DRIVER_RACE, SUM(stops) AS TOTAL_COUNT
+        FROM policedb.rollup_profile
+        GROUP BY country_name, AGE_GROUP, driver_gender, driver_race
+        ORDER BY country_name, AGE_GROUP, driver_gender, driver_race""",
+    "Top 5 Violations with Highest Arrest Rates": """
+        SELECT violation AS VIOLATION, SUM(arrests) AS TOTAL_ARREST,
+               ROUND(100.0 * SUM(arrests) / SUM(stops), 4) AS ARREST_RATE
+        FROM policedb.rollup_profile
+        GROUP BY violation
+        ORDER BY ARREST_RATE DESC
+        LIMIT 5""",
+}
@@ -0,0 +1,69 @@
+from db_pool import dialect_of
+
+#policedb.logs schema, shared by the loaders and the write path
+
+LOGS_TABLE = "policedb.logs"
+
+# insert columns in table order (id is assigned by the database)
+LOG_COLUMNS = [
+    "stop_date", "stop_time", "country_name", "driver_gender", "driver_age",
+    "driver_race", "violation_raw", "violation", "search_conducted", "search_type",
+    "stop_outcome", "is_arrested", "stop_duration", "drugs_related_stop", "vehicle_number",
+]
+
+# column -> (kind, max length for VARCHAR columns)
+COLUMN_TYPES = {
+    "stop_date": ("date", None),
+    "stop_time": ("time", None),
+    "country_name": ("str", 50),
+    "driver_gender": ("str", 10),
+    "driver_age": ("int", None),
+    "driver_race": ("str", 50),
+    "violation_raw": ("str", 100),
+    "violation": ("str", 100),
+    "search_conducted": ("bool", None),
+    "search_type": ("str", 100),
+    "stop_outcome": ("str", 100),
+    "is_arrested": ("bool", None),
+    "stop_duration": ("str", 50),
+    "drugs_related_stop": ("bool", None),
+    "vehicle_number": ("str", 50),
+}
+
+LOGS_DDL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    stop_date DATE,
+    stop_time TIME,
+    country_name VARCHAR(50),
+    driver_gender VARCHAR(10),
+    driver_age INT,
+    driver_race VARCHAR(50),
+    violation_raw VARCHAR(100),
+    violation VARCHAR(100),
+    search_conducted BOOLEAN,
+    search_type VARCHAR(100),
+    stop_outcome VARCHAR(100),
+    is_arrested BOOLEAN,
+    stop_duration VARCHAR(50),
+    drugs_related_stop BOOLEAN,
+    vehicle_number VARCHAR(50)
+)
+"""
+
+
+def create_logs_table(conn, table=LOGS_TABLE):
+    ddl = LOGS_DDL.format(table=table)
+    if dialect_of(conn) == "sqlite":
+        # sqlite only auto-assigns ids for an INTEGER PRIMARY KEY column
+        ddl = ddl.replace("INT AUTO_INCREMENT PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT")
+    cursor = conn.cursor()
+    cursor.execute(ddl)
+    conn.commit()
+
+
+def insert_sql(table=LOGS_TABLE):
+    return (
+        f"INSERT INTO {table} ({', '.join(LOG_COLUMNS)}) "
+        f"VALUES ({', '.join(['%s'] * len(LOG_COLUMNS))})"
+    )
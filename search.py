@@ -0,0 +1,261 @@
+import threading
+import time
+from typing import NamedTuple
+
+from db_pool import adapt_query, dialect_of
+from diagnostics import tracked
+from watermark import GAPS_DDL, Watermark, between, load_gaps, missing_runs, save_gaps
+
+#indexed search for the View logs filters
+
+TABLE = "policedb.logs"
+
+# above this many candidate plates an IN list stops paying off and we scan with LIKE instead
+MAX_PLATE_CANDIDATES = 2000
+REFRESH_BATCH = 50000
+
+LOG_INDEXES = {
+    "idx_logs_vehicle": "vehicle_number",
+    "idx_logs_country": "country_name",
+    "idx_logs_violation": "violation",
+}
+
+
+class SearchPlan(NamedTuple):
+    where: str
+    params: list
+    strategy: list
+    estimated_rows: int
+    empty: bool
+
+
+def trigrams(text):
+    text = text.upper()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _insert_ignore(dialect):
+    return "INSERT OR IGNORE INTO" if dialect == "sqlite" else "INSERT IGNORE INTO"
+
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+class LogSearch:
+
+    def __init__(self, pool, refresh_interval=30.0, monitor=None, source="live"):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        # the candidate lookups of plan() are recorded here, as source
+        self.monitor = monitor
+        self.source = source
+        self._lock = threading.Lock()
+        self._refreshed_at = float("-inf")
+        # low-cardinality columns: value -> row count, kept in memory for the logs _values_read has read
+        self._values = {"country_name": {}, "violation": {}}
+        self._values_read = None
+        # every log up to this id is counted / has its plate in plate_trigrams
+        self._values_id = 0
+        self._plates_id = 0
+
+    #schema
+
+    def ensure_indexes(self):
+        with self.pool.connection() as conn:
+            dialect = dialect_of(conn)
+            cursor = conn.cursor()
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS policedb.plate_trigrams ("
+                "trigram CHAR(3) NOT NULL, vehicle_number VARCHAR(50) NOT NULL, "
+                "PRIMARY KEY (trigram, vehicle_number))"
+            )
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS policedb.search_index_state ("
+                "name VARCHAR(50) PRIMARY KEY, last_id INT NOT NULL)"
+            )
+            cursor.execute(GAPS_DDL)
+            for name, column in LOG_INDEXES.items():
+                if dialect == "sqlite":
+                    cursor.execute(f"CREATE INDEX IF NOT EXISTS policedb.{name} ON logs ({column})")
+                    continue
+                try:
+                    cursor.execute(f"CREATE INDEX {name} ON {TABLE} ({column})")
+                except Exception as e:
+                    # 1061: duplicate key name, the index already exists
+                    if not e.args or e.args[0] != 1061:
+                        raise
+            conn.commit()
+
+    #maintenance
+
+    def refresh(self, force=False):
+        # index plates of logs added since the last refresh and fold their values into the counts,
+        # logs that committed late below the watermarks are picked up by id
+        with self._lock:
+            if not force and time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return
+            self._refreshed_at = time.monotonic()
+        with self.pool.connection() as conn:
+            dialect = dialect_of(conn)
+            cursor = conn.cursor()
+            plates_id = self._refresh_plates(conn, dialect)
+            with self._lock:
+                read = None if self._values_read is None else self._values_read.copy()
+                values = {column: dict(counts) for column, counts in self._values.items()}
+            if read is None:
+                # the first refresh counts the whole table, later ones only what was added since
+                read = Watermark()
+                values = {column: {} for column in values}
+            self._refresh_values(cursor, dialect, read, values)
+        with self._lock:
+            self._plates_id = plates_id
+            self._values = values
+            self._values_read = read
+            self._values_id = read.covered()
+
+    def _index_plates(self, cursor, dialect, rows):
+        pairs = {(gram, plate) for _, plate in rows if plate for gram in trigrams(plate)}
+        if pairs:
+            cursor.executemany(adapt_query(
+                f"{_insert_ignore(dialect)} policedb.plate_trigrams (trigram, vehicle_number) "
+                "VALUES (%s, %s)", dialect), sorted(pairs))
+
+    def _refresh_plates(self, conn, dialect):
+        # plate_trigrams is shared by every server, so is its watermark
+        cursor = conn.cursor()
+        cursor.execute("SELECT last_id FROM policedb.search_index_state WHERE name = 'plate_trigrams'")
+        row = cursor.fetchone()
+        read = Watermark(row[0] if row else 0, load_gaps(cursor, dialect, "plate_trigrams"))
+        gaps = read.gap_filter()
+        if gaps is not None:
+            cursor.execute(adapt_query(f"SELECT id, vehicle_number FROM {TABLE} WHERE {gaps[0]} ORDER BY id",
+                                       dialect), gaps[1])
+            rows = cursor.fetchall()
+            self._index_plates(cursor, dialect, rows)
+            read.fill([row[0] for row in rows])
+        while True:
+            cursor.execute(adapt_query(
+                f"SELECT id, vehicle_number FROM {TABLE} WHERE id > %s ORDER BY id LIMIT {REFRESH_BATCH}",
+                dialect), (read.last_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            self._index_plates(cursor, dialect, rows)
+            read.advance_to([row[0] for row in rows], rows[-1][0])
+            cursor.execute(adapt_query(
+                "REPLACE INTO policedb.search_index_state (name, last_id) VALUES ('plate_trigrams', %s)",
+                dialect), (read.last_id,))
+            save_gaps(cursor, dialect, "plate_trigrams", read.gaps)
+            conn.commit()
+        save_gaps(cursor, dialect, "plate_trigrams", read.gaps)
+        conn.commit()
+        return read.covered()
+
+    def _refresh_values(self, cursor, dialect, read, values):
+        gaps = read.gap_filter()
+        if gaps is not None:
+            cursor.execute(adapt_query(
+                f"SELECT id, {', '.join(values)} FROM {TABLE} WHERE {gaps[0]} ORDER BY id", dialect), gaps[1])
+            rows = cursor.fetchall()
+            for row in rows:
+                for value, counts in zip(row[1:], values.values()):
+                    if value is not None:
+                        counts[value] = counts.get(value, 0) + 1
+            read.fill([row[0] for row in rows])
+        cursor.execute(f"SELECT MAX(id) FROM {TABLE}")
+        high = cursor.fetchone()[0] or 0
+        low = read.last_id
+        if high <= low:
+            return
+        # late commits land near the top, ids missing further down were deleted or rolled back
+        checked = max(low, high - REFRESH_BATCH)
+        cursor.execute(adapt_query(f"SELECT id FROM {TABLE} WHERE id > %s AND id <= %s ORDER BY id", dialect),
+                       (checked, high))
+        runs = missing_runs([row[0] for row in cursor.fetchall()], checked, high)
+        where, params = "id > %s AND id <= %s", [low, high]
+        if runs:
+            gap_sql, gap_params = between(runs)
+            where += f" AND NOT {gap_sql}"
+            params += gap_params
+        for column, counts in values.items():
+            cursor.execute(adapt_query(f"SELECT {column}, COUNT(*) FROM {TABLE} WHERE {where} GROUP BY {column}",
+                                       dialect), params)
+            for value, count in cursor.fetchall():
+                if value is not None:
+                    counts[value] = counts.get(value, 0) + count
+        read.advance(high, runs)
+
+    #planning
+
+    def _plate_candidates(self, text):
+        grams = sorted(trigrams(text))
+        query = ("SELECT vehicle_number FROM policedb.plate_trigrams "
+                 f"WHERE trigram IN ({_placeholders(grams)}) "
+                 f"GROUP BY vehicle_number HAVING COUNT(*) = {len(grams)}")
+        with tracked(self.monitor, query, grams, self.source, "search/plate candidates") as trace:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                with trace.phase("execute"):
+                    cursor.execute(adapt_query(query, dialect_of(conn)), grams)
+                with trace.phase("fetch"):
+                    plates = [plate for (plate,) in cursor.fetchall()]
+            trace.rows = len(plates)
+        # trigrams only narrow the candidates, the substring itself is checked here
+        needle = text.upper()
+        return [plate for plate in plates if needle in plate.upper()]
+
+    def _value_filter(self, column, text):
+        # country/violation have a handful of values: resolve the substring in memory to an exact IN list
+        with self._lock:
+            counts = self._values[column]
+        needle = text.lower()
+        matches = [value for value in counts if needle in str(value).lower()]
+        return matches, sum(counts[value] for value in matches)
+
+    def plan(self, vehicle="", violation="", country=""):
+        # logs past an index's watermark aren't in it yet, they are matched with LIKE on the id range
+        # after it so a stop written since the last refresh is never reported missing
+        self.refresh()
+        with self._lock:
+            total = sum(self._values["country_name"].values())
+            values_id = self._values_id or 0
+            plates_id = self._plates_id
+        predicates = []
+        for column, text in (("country_name", country), ("violation", violation)):
+            if not text:
+                continue
+            matches, rows = self._value_filter(column, text)
+            unindexed = f"(id > %s AND {column} LIKE %s)"
+            if not matches:
+                predicates.append((0, unindexed, [values_id, f"%{text}%"],
+                                   f"{column}: no indexed values, only logs added since the last refresh"))
+                continue
+            predicates.append((rows, f"({column} IN ({_placeholders(matches)}) OR {unindexed})",
+                               matches + [values_id, f"%{text}%"],
+                               f"{column}: exact index on {len(matches)} value(s)"))
+        if vehicle:
+            like = [f"%{vehicle}%"]
+            if len(vehicle) < 3:
+                predicates.append((total, "vehicle_number LIKE %s", like,
+                                   "vehicle_number: scan (needs 3+ characters for the trigram index)"))
+            else:
+                plates = self._plate_candidates(vehicle)
+                unindexed = "(id > %s AND vehicle_number LIKE %s)"
+                if not plates:
+                    predicates.append((0, unindexed, [plates_id] + like,
+                                       "vehicle_number: no indexed plates, only logs added since the last refresh"))
+                elif len(plates) <= MAX_PLATE_CANDIDATES:
+                    predicates.append((len(plates), f"(vehicle_number IN ({_placeholders(plates)}) OR {unindexed})",
+                                       plates + [plates_id] + like,
+                                       f"vehicle_number: trigram index, {len(plates)} plate(s)"))
+                else:
+                    predicates.append((total, "vehicle_number LIKE %s", like,
+                                       "vehicle_number: scan (too many trigram candidates)"))
+        if not predicates:
+            return SearchPlan("", [], ["full table"], total, False)
+        # most selective predicate first, it is the one the index lookup should drive
+        predicates.sort(key=lambda p: p[0])
+        where = " AND ".join(p[1] for p in predicates)
+        params = [value for p in predicates for value in p[2]]
+        return SearchPlan(where, params, [p[3] for p in predicates], predicates[0][0], False)
@@ -0,0 +1,621 @@
+import argparse
+import contextlib
+import datetime
+import decimal
+import json
+import math
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from db_pool import ConnectionPool, PoolTimeout, adapt_query, dialect_of, is_disconnect, sqlite_factory
+from diagnostics import QueryMonitor
+from query_cache import QueryCache
+
+#headless analytics service: the query, metrics, search and prediction logic behind the dashboard,
+# long-lived and importable without Streamlit; pandas, the DB driver and the optional backends
+# are only imported by the parts that use them
+
+
+class QueryFailed(Exception):
+    pass
+
+
+class Settings:
+
+    def __init__(self, sqlite_path=None, snapshot_path="snapshot", slow_query_ms=500.0, query_log_path=None,
+                 shards_path=None, host="localhost", user="root", password="", database="policedb",
+                 spool_dir=".", process=""):
+        self.sqlite_path = sqlite_path
+        self.snapshot_path = snapshot_path
+        self.slow_query_ms = slow_query_ms
+        self.query_log_path = query_log_path
+        self.shards_path = shards_path
+        self.host = host
+        self.user = user
+        self.password = password
+        self.database = database
+        # the stop writer's spool and dead-letter files live in spool_dir, named after the process
+        self.spool_dir = spool_dir
+        self.process = process
+
+    @classmethod
+    def from_env(cls, process=""):
+        # SECURECHECK_SQLITE runs without a MySQL server, the snapshot is written by snapshot.py export,
+        # SECURECHECK_SHARDS points at a shards.py config, SECURECHECK_PROCESS overrides the process name
+        return cls(
+            sqlite_path=os.environ.get("SECURECHECK_SQLITE"),
+            snapshot_path=os.environ.get("SECURECHECK_SNAPSHOT", "snapshot"),
+            slow_query_ms=float(os.environ.get("SECURECHECK_SLOW_MS", "500")),
+            query_log_path=os.environ.get("SECURECHECK_QUERY_LOG"),
+            shards_path=os.environ.get("SECURECHECK_SHARDS"),
+            spool_dir=os.environ.get("SECURECHECK_SPOOL_DIR", "."),
+            process=os.environ.get("SECURECHECK_PROCESS", process),
+        )
+
+    def writer_paths(self, shard=None):
+        # (spool, dead letter): the dashboard and the API server each replay only their own spool
+        suffix = "".join(f"_{part}" for part in (self.process, shard) if part)
+        return (os.path.join(self.spool_dir, f"pending_stops{suffix}.jsonl"),
+                os.path.join(self.spool_dir, f"dead_stops{suffix}.jsonl"))
+
+
+def _is_driver_error(error):
+    # pymysql is only imported once a MySQL connection exists
+    driver = sys.modules.get("pymysql")
+    return driver is not None and isinstance(error, driver.OperationalError)
+
+
+class AnalyticsService:
+
+    def __init__(self, settings=None):
+        self.settings = settings or Settings.from_env()
+        self.sharded = bool(self.settings.shards_path)
+        self._lock = threading.RLock()
+        self._resources = {}
+
+    @classmethod
+    def from_env(cls, process=""):
+        return cls(Settings.from_env(process))
+
+    def _resource(self, name, build):
+        # built once on first use and kept warm for every later call
+        resource = self._resources.get(name)
+        if resource is None:
+            with self._lock:
+                resource = self._resources.get(name)
+                if resource is None:
+                    resource = build()
+                    self._resources[name] = resource
+        return resource
+
+    #connections and caches
+
+    def new_connection(self):
+        if self.settings.sqlite_path:
+            return sqlite_factory(self.settings.sqlite_path)()
+        import pymysql
+        return pymysql.connect(
+            host=self.settings.host,
+            user=self.settings.user,
+            password=self.settings.password,
+            database=self.settings.database
+        )
+
+    @property
+    def pool(self):
+        return self._resource("pool", lambda: ConnectionPool(self.new_connection, max_size=5, checkout_timeout=5.0))
+
+    def logs_version(self):
+        # MAX(id) is an index lookup, it moves on every insert into logs
+        return self.run_query("SELECT MAX(id) FROM policedb.logs").iat[0, 0]
+
+    @property
+    def cache(self):
+        return self._resource("cache", lambda: QueryCache(
+            version_fn=self.shards.version if self.sharded else self.logs_version,
+            ttl=300, max_entries=256, max_bytes=256 * 1024 * 1024))
+
+    @property
+    def monitor(self):
+        return self._resource("monitor", lambda: QueryMonitor(
+            slow_ms=self.settings.slow_query_ms, explain_fn=self.explain_query,
+            metrics_path=self.settings.query_log_path))
+
+    @property
+    def snapshot(self):
+        def build():
+            from snapshot import SnapshotBackend
+            return SnapshotBackend(self.settings.snapshot_path)
+        return self._resource("snapshot", build)
+
+    @property
+    def shards(self):
+        def build():
+            from shards import ShardSet
+            shards = ShardSet.from_config(self.settings.shards_path)
+            shards.ensure_rollups()
+            shards.ensure_sort_indexes()
+            return shards
+        return self._resource("shards", build)
+
+    #indexes and background writers
+
+    @property
+    def sort_indexes(self):
+        def build():
+            from log_browser import ensure_sort_indexes
+            return ensure_sort_indexes(self.pool)
+        return self._resource("sort_indexes", build)
+
+    @property
+    def search(self):
+        def build():
+            from search import LogSearch
+            search = LogSearch(self.pool, monitor=self.monitor)
+            search.ensure_indexes()
+            search.refresh(force=True)
+            return search
+        return self._resource("search", build)
+
+    @property
+    def predictor(self):
+        def build():
+            if self.sharded:
+                from shards import ShardedPredictionIndex
+                predictor = ShardedPredictionIndex(self.shards)
+            else:
+                from predictor import PredictionIndex
+                predictor = PredictionIndex(self.pool)
+            predictor.refresh(force=True)
+            return predictor
+        return self._resource("predictor", build)
+
+    @property
+    def alerts(self):
+        def build():
+            if self.sharded:
+                from shards import ShardedAlertEngine
+                alerts = ShardedAlertEngine(self.shards)
+            else:
+                from alerts import AlertEngine
+                alerts = AlertEngine(self.pool)
+            alerts.ensure_tables()
+            alerts.load()
+            return alerts
+        return self._resource("alerts", build)
+
+    @property
+    def writer(self):
+        def build():
+            from write_queue import StopWriter
+            cache = self.cache
+            alerts = self.alerts
+            if self.sharded:
+                from shards import ShardedWriter
+                # each stop goes to the shard of its check post, with one spool and dead-letter file per shard
+                def make_writer(shard):
+                    spool_path, dead_letter_path = self.settings.writer_paths(shard.name)
+                    return StopWriter(shard.pool, batch_size=500, flush_interval=1.0, spool_path=spool_path,
+                                      dead_letter_path=dead_letter_path,
+                                      on_flush=[lambda rows: cache.invalidate(), lambda rows: alerts.scan_new()])
+                return ShardedWriter(self.shards, make_writer)
+            spool_path, dead_letter_path = self.settings.writer_paths()
+            return StopWriter(self.pool, batch_size=500, flush_interval=1.0, spool_path=spool_path,
+                              dead_letter_path=dead_letter_path,
+                              on_flush=[lambda rows: cache.invalidate(), lambda rows: alerts.scan_new()])
+        return self._resource("writer", build)
+
+    @property
+    def rollups(self):
+        def build():
+            if self.sharded:
+                from shards import ShardedRollups
+                rollups = ShardedRollups(self.shards)
+            else:
+                from rollups import Rollups
+                rollups = Rollups(self.pool)
+            rollups.ensure_tables()
+            rollups.refresh(force=True)
+            return rollups
+        return self._resource("rollups", build)
+
+    @property
+    def approx(self):
+        def build():
+            if self.sharded:
+                from shards import ShardedApproxAnalytics
+                approx = ShardedApproxAnalytics(self.shards)
+            else:
+                from approx import ApproxAnalytics
+                approx = ApproxAnalytics(self.pool)
+            approx.refresh(force=True)
+            return approx
+        return self._resource("approx", build)
+
+    #queries
+
+    def run_query(self, query, params=None, trace=None):
+        from frames import decode_rows
+        timed = trace.phase if trace is not None else lambda name: contextlib.nullcontext()
+        for attempt in range(2):
+            try:
+                with self.pool.connection() as conn:
+                    cursor = conn.cursor()
+                    with timed("execute"):
+                        if params is None:
+                            cursor.execute(query)
+                        else:
+                            cursor.execute(adapt_query(query, dialect_of(conn)), params)
+                    with timed("fetch"):
+                        data = cursor.fetchall()
+                    with timed("frame"):
+                        columns = [c_name[0] for c_name in cursor.description]
+                        return decode_rows(data, columns)
+            except Exception as e:
+                # a stale pooled socket was already dropped by the pool, retry once on a fresh one
+                if attempt == 0 and _is_driver_error(e) and is_disconnect(e):
+                    continue
+                raise
+
+    def explain_query(self, query, params, source):
+        if source == "shards":
+            return f"fanned out to {len(self.shards.shards)} shards and merged in memory"
+        if source == "snapshot":
+            plan = self.snapshot.fetch("EXPLAIN " + query, params)
+            return "\n".join(plan.iloc[:, -1].astype(str))
+        if source.startswith("shard:"):
+            # a statement one shard ran on its own, browse pages and search lookups
+            pool = next(shard.pool for shard in self.shards.shards if shard.source == source)
+        else:
+            pool = self.pool
+        with pool.connection() as conn:
+            dialect = dialect_of(conn)
+            cursor = conn.cursor()
+            prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+            if params is None:
+                cursor.execute(prefix + query)
+            else:
+                cursor.execute(adapt_query(prefix + query, dialect), params)
+            plan = cursor.fetchall()
+            columns = [c_name[0] for c_name in cursor.description]
+        from frames import decode_rows
+        return decode_rows(plan, columns).to_string(index=False)
+
+    def fetch(self, query, params=None, cached=True, snapshot=False, label="", group_by=()):
+        # group_by names the key columns of a sharded COUNT/SUM query, the partials are summed per key
+        source = "snapshot" if snapshot else "shards" if self.sharded else "live"
+        namespace = None if source == "live" else source
+        with self.monitor.track(query, params, source, label) as trace:
+            if snapshot:
+                try:
+                    backend = self.snapshot
+                    # MAX(id) of the live table says nothing about the snapshot, a re-export does
+                    namespace = (source, backend.version())
+                except (ImportError, FileNotFoundError) as e:
+                    trace.error = f"{type(e).__name__}: {e}"
+                    raise QueryFailed(f"Snapshot Error: {e}") from e
+                run = lambda: trace.result(backend.fetch(query, params, trace))
+            elif source == "shards":
+                def run():
+                    with trace.phase("execute"):
+                        return trace.result(self.shards.fetch(query, params, group_by))
+            else:
+                run = lambda: trace.result(self.run_query(query, params, trace))
+            try:
+                if cached:
+                    result = self.cache.get_or_compute(query, params, run, namespace=namespace)
+                else:
+                    result = run()
+            except Exception as e:
+                if not (isinstance(e, PoolTimeout) or _is_driver_error(e)):
+                    raise
+                trace.error = f"{type(e).__name__}: {e}"
+                raise QueryFailed(f"Connection Error: {e}") from e
+            if not trace.computed:
+                # served from the cache, its size was already counted when it was computed
+                trace.rows = len(result)
+            return result
+
+    def browse(self, sort="stop_date", descending=False, after=None, page_size=50, where="", params=(),
+               plans=None):
+        # one keyset page of logs and the approximate match count; plans maps shard -> (where, params)
+        from log_browser import approximate_count, fetch_page
+        try:
+            if self.sharded:
+                shards = self.shards
+                if plans is None:
+                    plans = {shard.name: (where, params) for shard in shards.shards}
+                page = shards.fetch_page(sort, descending, after, page_size, plans, self.monitor)
+                counted = [shard for shard in shards.shards if shard.name in plans]
+                total = sum(shards.map(lambda shard: approximate_count(shard.pool, *plans[shard.name], self.monitor,
+                                                                       shard.source), counted))
+            else:
+                self.sort_indexes
+                page = fetch_page(self.pool, sort, descending, after, page_size, where, params, self.monitor)
+                total = approximate_count(self.pool, where, params, self.monitor)
+        except Exception as e:
+            if not (isinstance(e, PoolTimeout) or _is_driver_error(e)):
+                raise
+            raise QueryFailed(f"Connection Error: {e}") from e
+        return page, total
+
+    def plan_search(self, vehicle="", violation="", country=""):
+        # (plans, strategy lines, empty); plans is None unless sharded
+        if self.sharded:
+            shard_plans = self.shards.search(vehicle, violation, country, self.monitor)
+            strategy = [f"{len(shard_plans)} of {len(self.shards.shards)} shards searched"]
+            strategy += [f"{name}: {'; '.join(plan.strategy)}" for name, plan in shard_plans.items()]
+            plans = {name: (plan.where, plan.params) for name, plan in shard_plans.items()}
+            return "", [], plans, strategy, not shard_plans
+        plan = self.search.plan(vehicle, violation, country)
+        return plan.where, plan.params, None, plan.strategy, plan.empty
+
+    def analysis(self, title, approximate=False, snapshot=False):
+        # a View logs insight by title: the rollup query (or the raw one without a rollup),
+        # answered from the sample when approximate; returns (result, estimate or None)
+        from analyses import QUERY_MAP
+        from rollups import ROLLUP_QUERIES
+        if title not in QUERY_MAP:
+            raise KeyError(f"unknown analysis {title!r}")
+        query = ROLLUP_QUERIES.get(title, QUERY_MAP[title])
+        if approximate and not snapshot and title in ROLLUP_QUERIES:
+            from approx import estimable
+            # plate-ordered vehicle analyses need every plate, they are answered exactly
+            if estimable(query):
+                self.approx.refresh()
+                estimate = self.approx.estimate(query)
+                return estimate.result, estimate
+        if not snapshot:
+            self.rollups.refresh()
+        return self.fetch(query, snapshot=snapshot, label=title), None
+
+    def metrics(self, snapshot=False):
+        from metrics import compute_metrics
+        return compute_metrics(lambda query: self.fetch(query, snapshot=snapshot, label="key metrics"))
+
+    def predict(self, driver_gender, driver_age, search_conducted, stop_time, drugs_related_stop):
+        self.predictor.refresh()
+        return self.predictor.predict(driver_gender, driver_age, search_conducted, stop_time, drugs_related_stop)
+
+    def submit_stop(self, record):
+        # queued for the background writer; returns the watchlist entries the plate matches
+        self.writer.submit(record)
+        return self.alerts.match(record.get("vehicle_number") or "")
+
+    def stats(self):
+        stats = {"resources": sorted(self._resources)}
+        for name in ("pool", "cache", "writer"):
+            if name in self._resources:
+                stats[name] = self._resources[name].stats()
+        if "shards" in self._resources:
+            stats["shards"] = self._resources["shards"].stats()
+        return stats
+
+    def close(self):
+        for name in ("writer", "shards", "pool"):
+            resource = self._resources.pop(name, None)
+            if resource is not None:
+                resource.close()
+
+
+#JSON calls, shared by the HTTP server and the command line
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return None if math.isnan(value) else value
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, datetime.timedelta):
+        seconds = int(value.total_seconds()) % 86400
+        return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if hasattr(value, "item"):
+        return _jsonable(value.item())
+    if hasattr(value, "to_pytimedelta"):
+        return _jsonable(value.to_pytimedelta())
+    if hasattr(value, "to_pydatetime"):
+        return value.to_pydatetime().isoformat()
+    if value != value:
+        return None
+    return str(value)
+
+
+def _frame(frame):
+    if "stop_date" in frame.columns and frame["stop_date"].dtype.kind == "M":
+        # a date, not midnight of it
+        frame = frame.assign(stop_date=frame["stop_date"].dt.date)
+    # NaT is a datetime and pd.NA can't be compared, missing cells go out as null before either is looked at
+    values = frame.astype(object).where(frame.notna(), None)
+    return {
+        "columns": [str(c) for c in frame.columns],
+        "rows": [[_jsonable(v) for v in row] for row in values.itertuples(index=False, name=None)],
+    }
+
+
+def _call_metrics(service, snapshot=False):
+    return [metric._asdict() for metric in service.metrics(snapshot)]
+
+
+def _call_analyses(service):
+    from analyses import QUERY_MAP
+    return list(QUERY_MAP)
+
+
+def _call_analysis(service, title, approximate=False, snapshot=False):
+    result, estimate = service.analysis(title, approximate, snapshot)
+    answer = _frame(result)
+    if estimate is not None:
+        answer["margins"] = _frame(estimate.margins)
+        answer["method"] = estimate.method
+    return answer
+
+
+def _call_search(service, vehicle="", violation="", country="", sort="stop_date", descending=False, after=None,
+                 page_size=50):
+    where, params, plans, strategy, empty = service.plan_search(vehicle, violation, country)
+    if empty:
+        return {"strategy": strategy, "columns": [], "rows": [], "next_cursor": None, "has_more": False, "total": 0}
+    page, total = service.browse(sort, descending, after, min(int(page_size), 500), where, params, plans)
+    answer = _frame(page.rows)
+    answer.update(strategy=strategy, next_cursor=_jsonable(page.next_cursor), has_more=page.has_more, total=total)
+    return answer
+
+
+def _call_predict(service, driver_gender, driver_age, search_conducted, stop_time, drugs_related_stop):
+    stop_time = datetime.time.fromisoformat(stop_time) if isinstance(stop_time, str) else stop_time
+    return service.predict(driver_gender, driver_age, search_conducted, stop_time, drugs_related_stop)._asdict()
+
+
+def _call_submit_stop(service, record):
+    return {"queued": True, "watchlist": [list(match) for match in service.submit_stop(record)]}
+
+
+def _call_flag(service, pattern, reason=""):
+    return service.alerts.flag(pattern, reason)
+
+
+def _call_watchlist(service):
+    return [list(entry) for entry in service.alerts.watchlist()]
+
+
+def _call_recent_hits(service, limit=50):
+    service.alerts.scan_new()
+    return [hit._asdict() for hit in service.alerts.recent_hits(limit)]
+
+
+def _call_stats(service):
+    return service.stats()
+
+
+# read-only and write calls callers may make; raw SQL is deliberately not one of them
+METHODS = {
+    "metrics": _call_metrics,
+    "analyses": _call_analyses,
+    "analysis": _call_analysis,
+    "search": _call_search,
+    "predict": _call_predict,
+    "submit_stop": _call_submit_stop,
+    "flag": _call_flag,
+    "watchlist": _call_watchlist,
+    "recent_hits": _call_recent_hits,
+    "stats": _call_stats,
+}
+
+
+def call(service, request):
+    # {"id": ..., "method": "analysis", "params": {"title": ...}} -> {"id": ..., "result": ...} or "error"
+    response = {"id": request.get("id") if isinstance(request, dict) else None}
+    try:
+        # a batch can hold anything JSON does, each bad element gets its own error
+        if not isinstance(request, dict):
+            raise TypeError(f"expected a call object, got {type(request).__name__}")
+        method = METHODS.get(request.get("method"))
+        if method is None:
+            raise KeyError(f"unknown method {request.get('method')!r}")
+        params = request.get("params") or {}
+        if not isinstance(params, dict):
+            raise TypeError(f"params must be an object, got {type(params).__name__}")
+        response["result"] = _jsonable(method(service, **params))
+    except Exception as e:
+        response["error"] = f"{type(e).__name__}: {e}"
+    return response
+
+
+def call_batch(service, requests, executor):
+    # a batch shares the warm connections and caches and runs side by side
+    return list(executor.map(lambda request: call(service, request), requests))
+
+
+#HTTP entry point
+
+def make_server(service, host="127.0.0.1", port=8765, workers=8):
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rpc")
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._reply(200, _jsonable(service.stats()))
+            else:
+                self._reply(404, {"error": "POST a call or a list of calls to /"})
+
+        def do_POST(self):
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+            except ValueError as e:
+                self._reply(400, {"error": f"invalid JSON: {e}"})
+                return
+            if isinstance(request, list):
+                self._reply(200, call_batch(service, request, executor))
+            elif isinstance(request, dict):
+                self._reply(200, call(service, request))
+            else:
+                self._reply(400, {"error": "expected a call object or a list of calls"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+#command line
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SecureCheck analytics service")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve JSON calls over HTTP")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--workers", type=int, default=8)
+    calls = commands.add_parser("call", help="run JSON calls, one per argument or per stdin line")
+    calls.add_argument("requests", nargs="*")
+    args = parser.parse_args(argv)
+
+    # "serve" and "call" keep their own spools, apart from the dashboard's
+    service = AnalyticsService.from_env(args.command)
+    try:
+        if args.command == "serve":
+            server = make_server(service, args.host, args.port, args.workers)
+            print(f"serving on http://{args.host}:{args.port}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+            return 0
+        lines = args.requests or sys.stdin
+        for line in lines:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if isinstance(request, list):
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    print(json.dumps(call_batch(service, request, executor)), flush=True)
+            else:
+                print(json.dumps(call(service, request)), flush=True)
+        return 0
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
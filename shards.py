@@ -0,0 +1,475 @@
+import argparse
+import datetime
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from alerts import REPEAT_OFFENDERS, AlertEngine, execute, read_version
+from approx import ApproxAnalytics
+from db_pool import ConnectionPool, adapt_query, add_connection_args, connect_from_args, dialect_of, sqlite_factory
+from frames import compact
+from log_browser import SORT_KEYS, Page, ensure_sort_indexes, fetch_rows
+from predictor import PredictionIndex
+from rollups import CUBES, Rollups, create_sql
+from schema import LOG_COLUMNS, create_logs_table, insert_sql
+from search import LogSearch
+from watermark import Watermark
+from write_queue import InvalidStop
+
+#check-post shards of policedb.logs, with pruning and parallel fan-out queries across them
+
+TABLE = "policedb.logs"
+BATCH = 50000
+
+_CUBE_NAMES = re.compile(r"policedb\.(rollup_\w+)")
+# per-shard partials of these don't add up to the answer over every shard
+_NOT_ADDITIVE = re.compile(r"\b(MAX|MIN|AVG|GROUP_CONCAT|STDDEV\w*|VARIANCE|VAR_POP|VAR_SAMP|DISTINCT|OVER|"
+                           r"HAVING|LIMIT)\b", re.IGNORECASE)
+_ADDITIVE = re.compile(r"\b(COUNT|SUM)\s*\(", re.IGNORECASE)
+_GROUPED = re.compile(r"\bGROUP\s+BY\b", re.IGNORECASE)
+_LITERALS = re.compile(r"'(?:[^']|'')*'")
+
+
+def _as_date(value):
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+
+class Shard:
+
+    def __init__(self, name, pool, countries=None, date_from=None, date_to=None):
+        # stops of these countries (any, if empty) with date_from <= stop_date < date_to
+        self.name = name
+        self.pool = pool
+        self.countries = {c.lower() for c in countries} if countries else None
+        self.date_from = _as_date(date_from)
+        self.date_to = _as_date(date_to)
+
+    @property
+    def source(self):
+        # how the query monitor labels a statement run on this shard alone
+        return f"shard:{self.name}"
+
+    def holds(self, country, stop_date):
+        if self.countries is not None and (country or "").lower() not in self.countries:
+            return False
+        stop_date = _as_date(stop_date)
+        if stop_date is None:
+            return self.date_from is None and self.date_to is None
+        if self.date_from is not None and stop_date < self.date_from:
+            return False
+        return self.date_to is None or stop_date < self.date_to
+
+    def may_match(self, country=""):
+        # country is the page's "contains" filter
+        return not country or self.countries is None or any(country.lower() in c for c in self.countries)
+
+
+def _check_additive(query, group_by):
+    # string literals (LIKE '%max%') are not SQL
+    sql = _LITERALS.sub("''", query)
+    found = _NOT_ADDITIVE.search(sql)
+    if found:
+        raise ValueError(f"{found.group(1).upper()} can't be merged across shards, "
+                         "only COUNT/SUM aggregates and the rollup cubes can")
+    if not _ADDITIVE.search(sql):
+        raise ValueError("only COUNT/SUM aggregates and the rollup cubes can be merged across shards")
+    if _GROUPED.search(sql) and not group_by:
+        raise ValueError("a grouped query needs its group_by columns to be merged across shards")
+
+
+def _connection_factory(entry):
+    args = argparse.Namespace(
+        sqlite=entry.get("sqlite"),
+        host=entry.get("host", "localhost"),
+        user=entry.get("user", "root"),
+        password=entry.get("password", ""),
+        database=entry.get("database", "policedb"),
+    )
+    return lambda: connect_from_args(args)
+
+
+def _sort_key(values):
+    # NULLs first, the order MySQL and SQLite give ascending
+    return tuple((value is not None, value) for value in values)
+
+
+class ShardSet:
+
+    def __init__(self, shards, workers=None):
+        if not shards:
+            raise ValueError("at least one shard is needed")
+        self.shards = list(shards)
+        self._executor = ThreadPoolExecutor(max_workers=workers or len(self.shards),
+                                            thread_name_prefix="shard")
+        self._lock = threading.Lock()
+        self._rollups = {}
+        self._searches = {}
+        self._merged = None
+        self._merged_version = None
+
+    @classmethod
+    def from_config(cls, path, pool_size=3, checkout_timeout=5.0):
+        # {"workers": 8, "shards": [{"name": "usa", "countries": ["USA"], "from": "2020-01-01",
+        #  "to": "2025-01-01", "sqlite": "usa.db"}, {"name": "india", "countries": ["India"], "host": ...}]}
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        shards = [
+            Shard(entry["name"], ConnectionPool(_connection_factory(entry), max_size=pool_size,
+                                                checkout_timeout=checkout_timeout),
+                  entry.get("countries"), entry.get("from"), entry.get("to"))
+            for entry in config["shards"]
+        ]
+        return cls(shards, config.get("workers"))
+
+    #routing and pruning
+
+    def route(self, country, stop_date):
+        for shard in self.shards:
+            if shard.holds(country, stop_date):
+                return shard
+        raise ValueError(f"no shard holds stops from {country!r} on {stop_date}")
+
+    def prune(self, country=""):
+        return [shard for shard in self.shards if shard.may_match(country)]
+
+    def map(self, fn, shards=None):
+        # fn(shard) on every shard at once, results in shard order
+        shards = self.shards if shards is None else shards
+        return list(self._executor.map(fn, shards))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        for shard in self.shards:
+            shard.pool.close()
+
+    def stats(self):
+        return {shard.name: shard.pool.stats() for shard in self.shards}
+
+    #fan-out queries
+
+    def _run(self, shard, query, params):
+        with shard.pool.connection() as conn:
+            cursor = conn.cursor()
+            if params is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(adapt_query(query, dialect_of(conn)), params)
+            return pd.DataFrame(cursor.fetchall(), columns=[c_name[0] for c_name in cursor.description])
+
+    def version(self):
+        # changes whenever any shard takes a new stop
+        return tuple(self.map(lambda shard: self._run(shard, f"SELECT MAX(id) FROM {TABLE}", None).iat[0, 0]))
+
+    def fetch(self, query, params=None, group_by=(), shards=None):
+        # rollup queries run on the merged cubes, anything else must be COUNT/SUM aggregates whose
+        # per-shard partials add up, grouped by the group_by columns
+        if _CUBE_NAMES.search(query):
+            return compact(self.fetch_rollup(query, params))
+        _check_additive(query, group_by)
+        partials = [p for p in self.map(lambda shard: self._run(shard, query, params), shards) if not p.empty]
+        if not partials:
+            return pd.DataFrame()
+        combined = pd.concat(partials, ignore_index=True)
+        measures = [c for c in combined.columns if c not in group_by]
+        combined[measures] = combined[measures].apply(pd.to_numeric)
+        if group_by:
+            merged = combined.groupby(list(group_by), dropna=False, sort=False)[measures].sum().reset_index()
+        else:
+            merged = combined[measures].sum().to_frame().T
+        return compact(merged)
+
+    #rollups, one set of cubes per shard merged into an in-memory copy
+
+    def ensure_rollups(self):
+        def ensure(shard):
+            rollups = Rollups(shard.pool)
+            rollups.ensure_tables()
+            return rollups
+        rollups = self.map(ensure)
+        with self._lock:
+            self._rollups = {shard.name: r for shard, r in zip(self.shards, rollups)}
+
+    def ensure_sort_indexes(self):
+        self.map(lambda shard: ensure_sort_indexes(shard.pool))
+
+    def refresh_rollups(self, force=False):
+        if not self._rollups:
+            self.ensure_rollups()
+        return sum(self.map(lambda shard: self._rollups[shard.name].refresh(force)))
+
+    def _rollup_version(self, shard):
+        # late rows folded below the watermark shrink the open gaps without moving last_id
+        return self._run(shard, "SELECT last_id, (SELECT COALESCE(SUM(high - low + 1), 0) "
+                                "FROM policedb.watermark_gaps WHERE name = 'rollups') "
+                                "FROM policedb.rollup_state WHERE name = 'logs'", None)
+
+    def _merge_cubes(self):
+        # cube cells are additive, so the merged cube is the per-key sum of the shard cubes
+        def load(shard):
+            return {name: self._run(shard, f"SELECT * FROM policedb.{name}", None) for name in CUBES}
+        parts = self.map(load)
+        merged = sqlite_factory(":memory:")()
+        cursor = merged.cursor()
+        for name, cube in CUBES.items():
+            cursor.execute(create_sql(name))
+            frames = [part[name] for part in parts if not part[name].empty]
+            if not frames:
+                continue
+            dims = [dim for dim, _, _ in cube["dims"]]
+            measures = [measure for measure, _, _ in cube["measures"]]
+            combined = pd.concat(frames, ignore_index=True)
+            combined[measures] = combined[measures].apply(pd.to_numeric)
+            if "stop_date" in dims:
+                # sqlite compares dates as ISO text
+                combined["stop_date"] = combined["stop_date"].astype(str)
+            cells = combined.groupby(dims, sort=False)[measures].sum().reset_index()
+            cursor.executemany(
+                f"INSERT INTO policedb.{name} ({', '.join(dims + measures)}) "
+                f"VALUES ({', '.join(['?'] * (len(dims) + len(measures)))})",
+                cells.astype(object).itertuples(index=False, name=None),
+            )
+        merged.commit()
+        return merged
+
+    def fetch_rollup(self, query, params=None):
+        # the analysis SQL runs unchanged on the merged cubes, so rates and RANK() OVER are computed
+        # over the combined totals, not per shard
+        version = tuple(self.map(lambda shard: tuple(self._rollup_version(shard).itertuples(index=False))))
+        with self._lock:
+            if self._merged is None or self._merged_version != version:
+                if self._merged is not None:
+                    self._merged.close()
+                self._merged = self._merge_cubes()
+                self._merged_version = version
+            cursor = self._merged.cursor()
+            if params is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(adapt_query(query, "sqlite"), params)
+            return pd.DataFrame(cursor.fetchall(), columns=[c_name[0] for c_name in cursor.description])
+
+    #search and paging across shards
+
+    def search(self, vehicle="", violation="", country="", monitor=None):
+        # one indexed plan per shard that may hold the country, the other shards drop out
+        def plan(shard):
+            with self._lock:
+                search = self._searches.get(shard.name)
+            if search is None:
+                search = LogSearch(shard.pool, monitor=monitor, source=shard.source)
+                search.ensure_indexes()
+                with self._lock:
+                    search = self._searches.setdefault(shard.name, search)
+            return search.plan(vehicle, violation, country)
+        shards = self.prune(country)
+        return {shard.name: p for shard, p in zip(shards, self.map(plan, shards)) if not p.empty}
+
+    def fetch_page(self, sort="stop_date", descending=False, after=None, page_size=50, plans=None, monitor=None):
+        # k-way merge of per-shard keyset pages, the cursor keeps each shard's own position
+        # so equal keys (ids repeat across shards) are never skipped or repeated
+        if plans is None:
+            plans = {shard.name: ("", []) for shard in self.shards}
+        else:
+            plans = {name: (p.where, p.params) if hasattr(p, "where") else p for name, p in plans.items()}
+        after = after or {}
+        shards = [shard for shard in self.shards if shard.name in plans]
+        pages = self.map(lambda shard: fetch_rows(shard.pool, sort, descending, after.get(shard.name), page_size,
+                                                  *plans[shard.name], monitor, shard.source), shards)
+        keys = SORT_KEYS[sort]
+        candidates = []
+        columns = pages[0][0] if pages else ["id"] + LOG_COLUMNS
+        for index, (shard, (shard_columns, rows)) in enumerate(zip(shards, pages)):
+            positions = [shard_columns.index(k) for k in keys]
+            for row in rows:
+                candidates.append((_sort_key([row[i] for i in positions]), index, shard.name, row,
+                                   tuple(row[i] for i in positions)))
+        candidates.sort(key=lambda c: (c[0], c[1]), reverse=descending)
+        taken = candidates[:page_size]
+        next_cursor = dict(after)
+        for _, _, name, _, cursor_values in taken:
+            next_cursor[name] = cursor_values
+        data = compact(pd.DataFrame([c[3] for c in taken], columns=columns))
+        return Page(data, next_cursor, len(candidates) > page_size)
+
+    #writes and loading
+
+    def split(self, conn, progress=print):
+        # copy an existing logs table into the shards, routing each stop by country and date
+        for shard in self.shards:
+            with shard.pool.connection() as shard_conn:
+                create_logs_table(shard_conn)
+        cursor = conn.cursor()
+        query = adapt_query(
+            f"SELECT id, {', '.join(LOG_COLUMNS)} FROM {TABLE} WHERE id > %s ORDER BY id LIMIT {BATCH}",
+            dialect_of(conn))
+        country_at, date_at = LOG_COLUMNS.index("country_name"), LOG_COLUMNS.index("stop_date")
+        last_id = 0
+        copied = 0
+        unrouted = 0
+        while True:
+            cursor.execute(query, (last_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            batches = {shard.name: [] for shard in self.shards}
+            for row in rows:
+                values = row[1:]
+                try:
+                    shard = self.route(values[country_at], values[date_at])
+                except ValueError:
+                    unrouted += 1
+                    continue
+                batches[shard.name].append(values)
+                copied += 1
+
+            def write(shard):
+                if not batches[shard.name]:
+                    return
+                with shard.pool.connection() as shard_conn:
+                    shard_cursor = shard_conn.cursor()
+                    shard_cursor.executemany(adapt_query(insert_sql(), dialect_of(shard_conn)), batches[shard.name])
+                    shard_conn.commit()
+            self.map(write)
+            last_id = rows[-1][0]
+            progress(f"{copied:,} rows copied, {unrouted:,} without a shard")
+        return copied, unrouted
+
+
+class ShardedWriter:
+    # same interface as StopWriter, each stop goes to the writer of the shard that holds it
+
+    def __init__(self, shards, make_writer):
+        self.shards = shards
+        self._writers = {shard.name: make_writer(shard) for shard in shards.shards}
+
+    def submit(self, record, timeout=2.0):
+        try:
+            shard = self.shards.route(record.get("country_name"), record.get("stop_date"))
+        except ValueError as e:
+            raise InvalidStop(str(e)) from None
+        self._writers[shard.name].submit(record, timeout)
+
+    def flush(self, timeout=None):
+        for writer in self._writers.values():
+            writer.flush(timeout)
+
+    def close(self, timeout=10.0):
+        for writer in self._writers.values():
+            writer.close(timeout)
+
+    def stats(self):
+        return {name: writer.stats() for name, writer in self._writers.items()}
+
+
+#shard-wide indexes, one in-memory state fed by every shard past its own id watermark (ids repeat across shards)
+
+class ShardedRollups:
+    # same interface as Rollups, over the cubes of every shard
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def ensure_tables(self):
+        self.shards.ensure_rollups()
+
+    def refresh(self, force=False):
+        return self.shards.refresh_rollups(force)
+
+
+class ShardedPredictionIndex(PredictionIndex):
+
+    def __init__(self, shards, refresh_interval=10.0):
+        super().__init__(None, refresh_interval)
+        self.shards = shards
+        self._watermarks = {shard.name: Watermark() for shard in shards.shards}
+
+    def refresh(self, force=False):
+        if self._due(force):
+            self.shards.map(lambda shard: self._read(shard.pool, self._watermarks[shard.name]))
+
+
+class ShardedApproxAnalytics(ApproxAnalytics):
+    # the shards hold disjoint stops, so one sample and one set of sketches over all of them
+    # answer for the union
+
+    def __init__(self, shards, per_stratum=5000, replicates=10, refresh_interval=10.0, seed=7):
+        super().__init__(None, per_stratum, replicates, refresh_interval, seed)
+        self.shards = shards
+        self._watermarks = {shard.name: Watermark() for shard in shards.shards}
+
+    def refresh(self, force=False):
+        if self._due(force):
+            self.shards.map(lambda shard: self._read(shard.pool, self._watermarks[shard.name]))
+
+    def stats(self):
+        stats = super().stats()
+        stats["last_id"] = {name: watermark.last_id for name, watermark in self._watermarks.items()}
+        return stats
+
+
+class ShardedAlertEngine(AlertEngine):
+    # the watchlist is written to every shard, hits carry the shard name with the log id
+
+    def __init__(self, shards, max_hits=500):
+        super().__init__(None, max_hits)
+        self.shards = shards
+        self._watermarks = None
+
+    def _execute(self, query, params=(), bump_version=False):
+        self.shards.map(lambda shard: execute(shard.pool, query, params, bump_version))
+
+    def _read_version(self):
+        return tuple(self.shards.map(lambda shard: read_version(shard.pool)))
+
+    def load(self, version=None):
+        version = self._read_version() if version is None else version
+        loaded = self.shards.map(lambda shard: self._read_watchlist(shard.pool))
+        if self._watermarks is None:
+            self._watermarks = {shard.name: watermark for shard, (_, watermark) in zip(self.shards.shards, loaded)}
+        # a flag missed by a shard that was down is still read from the others
+        self._set_watchlist(dict(row for rows, _ in loaded for row in rows).items())
+        self._version = version
+
+    def _offenders(self, min_drug_stops, min_searches):
+        # from the merged vehicle cube, a plate's stops add up across check posts
+        offenders = self.shards.fetch_rollup(REPEAT_OFFENDERS, (min_drug_stops, min_searches))
+        return list(offenders.itertuples(index=False, name=None))
+
+    def scan_new(self):
+        with self._scan_lock:
+            if self._watermarks is None:
+                self.load()
+            else:
+                self._reload_if_changed()
+            parts = self.shards.map(lambda shard: self._scan(shard.pool, self._watermarks[shard.name], shard.name))
+            hits = [hit for part in parts for hit in part]
+            with self._lock:
+                self._hits.extend(hits)
+            return hits
+
+
+#command line
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Split policedb.logs into the check-post shards of a config")
+    parser.add_argument("command", choices=["split"])
+    parser.add_argument("config", help="shards JSON config")
+    add_connection_args(parser)
+    args = parser.parse_args(argv)
+
+    shards = ShardSet.from_config(args.config)
+    conn = connect_from_args(args)
+    try:
+        shards.split(conn)
+    finally:
+        conn.close()
+        shards.close()
+
+
+if __name__ == "__main__":
+    main()
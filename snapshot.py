@@ -0,0 +1,189 @@
+import argparse
+import contextlib
+import os
+import re
+import shutil
+import threading
+import time
+
+import pandas as pd
+
+from db_pool import adapt_query, add_connection_args, connect_from_args, dialect_of
+from frames import compact
+from rollups import CUBES
+from schema import LOG_COLUMNS
+
+#columnar snapshots of policedb.logs for read-heavy analytics
+# needs the optional pyarrow (export) and duckdb (queries) packages
+
+TABLE = "policedb.logs"
+BATCH = 200000
+PARTITIONS = ["stop_year", "country_name"]
+# leading number of '16-30 Min' etc., what MySQL's AVG(stop_duration) averages
+DUCKDB_DURATION = "TRY_CAST(regexp_extract(stop_duration, '^[0-9.]+') AS DOUBLE)"
+
+
+def _require(module):
+    try:
+        return __import__(module)
+    except ImportError:
+        raise ImportError(f"snapshot mode needs the {module} package: pip install {module}") from None
+
+
+#export
+
+def _arrow_batch(pa, rows, columns):
+    data = pd.DataFrame(rows, columns=columns)
+    # TIME arrives as timedelta from pymysql and as text from sqlite
+    stop_time = pd.to_timedelta(data["stop_time"].astype("string"), errors="coerce")
+    stop_date = pd.to_datetime(data["stop_date"], errors="coerce")
+    arrays = {
+        "id": pa.array(data["id"], pa.int64()),
+        "stop_date": pa.array(stop_date.dt.date, pa.date32(), from_pandas=True),
+        "stop_time": pa.array((stop_time.dt.total_seconds() * 1e6).round().astype("Int64"),
+                              pa.int64(), from_pandas=True).cast(pa.time64("us")),
+        "stop_year": pa.array(stop_date.dt.year.astype("Int32"), pa.int32(), from_pandas=True),
+    }
+    for column in LOG_COLUMNS:
+        if column in arrays:
+            continue
+        if column in ("driver_age", "search_conducted", "is_arrested", "drugs_related_stop"):
+            arrays[column] = pa.array(pd.to_numeric(data[column]).astype("Int64"), pa.int64(), from_pandas=True)
+        else:
+            arrays[column] = pa.array(data[column].astype("string"), pa.string(), from_pandas=True)
+    return pa.RecordBatch.from_pydict(arrays)
+
+
+def _batches(conn, pa, progress):
+    # keyset over id, one bounded batch in memory at a time
+    cursor = conn.cursor()
+    query = adapt_query(f"SELECT * FROM {TABLE} WHERE id > %s ORDER BY id LIMIT {BATCH}", dialect_of(conn))
+    last_id = 0
+    exported = 0
+    while True:
+        cursor.execute(query, (last_id,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        columns = [c_name[0] for c_name in cursor.description]
+        yield _arrow_batch(pa, rows, columns)
+        last_id = rows[-1][columns.index("id")]
+        exported += len(rows)
+        progress(f"{exported:,} rows exported")
+
+
+def export_snapshot(conn, out_dir, progress=print):
+    # written next to the live snapshot and swapped in when complete
+    _require("pyarrow")
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    started = time.monotonic()
+    tmp_dir = out_dir.rstrip("/\\") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    batches = _batches(conn, pa, progress)
+    first = next(batches, None)
+    if first is None:
+        raise ValueError(f"{TABLE} is empty, nothing to snapshot")
+
+    def all_batches():
+        yield first
+        yield from batches
+
+    ds.write_dataset(
+        all_batches(),
+        tmp_dir,
+        schema=first.schema,
+        format="parquet",
+        partitioning=PARTITIONS,
+        partitioning_flavor="hive",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    old_dir = out_dir.rstrip("/\\") + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old_dir)
+    os.replace(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    progress(f"snapshot written to {out_dir} in {time.monotonic() - started:.1f}s")
+
+
+#query backend
+
+def _duckdb_sql(query):
+    # MySQL accepts "text" as a string literal, duckdb reads it as an identifier
+    return re.sub(r'"([^"]*)"', r"'\1'", query)
+
+
+class SnapshotBackend:
+
+    def __init__(self, path):
+        duckdb = _require("duckdb")
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"no snapshot at {path}, run: python snapshot.py export {path}")
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = duckdb.connect(":memory:")
+        # MySQL's default collation compares text case-insensitively
+        self._conn.execute("SET default_collation = 'nocase'")
+        self._conn.execute("CREATE SCHEMA policedb")
+        files = os.path.join(path, "**", "*.parquet").replace("'", "''")
+        self._conn.execute(
+            "CREATE VIEW policedb.logs AS SELECT * EXCLUDE (stop_year) "
+            f"FROM read_parquet('{files}', hive_partitioning = true)"
+        )
+        # the rollup tables become views, so the rollup analyses run unchanged on the snapshot
+        for name, cube in CUBES.items():
+            selects = [f"{expression} AS {dim}" for dim, _, expression in cube["dims"]]
+            selects += [f"{expression.format(duration=DUCKDB_DURATION)} AS {measure}"
+                        for measure, _, expression in cube["measures"]]
+            keys = ", ".join(str(i + 1) for i in range(len(cube["dims"])))
+            self._conn.execute(
+                f"CREATE VIEW policedb.{name} AS SELECT {', '.join(selects)} FROM policedb.logs GROUP BY {keys}"
+            )
+
+    def fetch(self, query, params=None, trace=None):
+        # duckdb connections are not thread-safe, each query gets its own cursor
+        timed = trace.phase if trace is not None else lambda name: contextlib.nullcontext()
+        with self._lock:
+            cursor = self._conn.cursor()
+        try:
+            sql = _duckdb_sql(query)
+            with timed("execute"):
+                if params is None:
+                    result = cursor.execute(sql)
+                else:
+                    result = cursor.execute(sql.replace("%s", "?"), list(params))
+            with timed("frame"):
+                return compact(result.df())
+        finally:
+            cursor.close()
+
+    def version(self):
+        # export swaps in a freshly written directory, cached answers are keyed on which one is live
+        info = os.stat(self.path)
+        return (info.st_ino, info.st_mtime_ns)
+
+    def stats(self):
+        files = [os.path.join(d, f) for d, _, names in os.walk(self.path) for f in names if f.endswith(".parquet")]
+        return {"path": self.path, "files": len(files), "bytes": sum(os.path.getsize(f) for f in files)}
+
+
+#command line
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export policedb.logs to a partitioned Parquet snapshot")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("out_dir", nargs="?", default="snapshot")
+    add_connection_args(parser)
+    args = parser.parse_args(argv)
+
+    conn = connect_from_args(args)
+    try:
+        export_snapshot(conn, args.out_dir)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
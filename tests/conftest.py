@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+from benchmark import generate
+from db_pool import ConnectionPool, adapt_query, dialect_of, sqlite_factory
+
+#sqlite stand-ins for policedb, filled with the benchmark's synthetic stops
+
+
+@pytest.fixture
+def logs_path(tmp_path):
+    path = str(tmp_path / "policedb.sqlite")
+    conn = sqlite_factory(path)()
+    generate(conn, 3000, batch_size=1000, seed=11, progress=lambda message: None)
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def pool(logs_path):
+    pool = ConnectionPool(sqlite_factory(logs_path), max_size=4, checkout_timeout=5.0)
+    yield pool
+    pool.close()
+
+
+def query_frame(pool, query, params=()):
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(adapt_query(query, dialect_of(conn)), params)
+        return pd.DataFrame(cursor.fetchall(), columns=[column[0] for column in cursor.description])
+
+
+def query_rows(pool, query, params=()):
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(adapt_query(query, dialect_of(conn)), params)
+        return cursor.fetchall()
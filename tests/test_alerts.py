@@ -0,0 +1,79 @@
+import sqlite3
+
+import pytest
+
+from alerts import AlertEngine
+from conftest import query_rows
+from db_pool import ConnectionPool, sqlite_factory
+from schema import LOG_COLUMNS
+
+
+@pytest.fixture
+def alerts(pool):
+    alerts = AlertEngine(pool)
+    alerts.ensure_tables()
+    alerts.load()
+    return alerts
+
+
+def test_flag_normalises_plates_and_patterns(alerts):
+    assert alerts.flag("tn-01 ab 1234", "stolen") == "TN01AB1234"
+    alerts.flag("ka05*", "fleet")
+    assert alerts.match("TN 01 AB 1234") == [("TN01AB1234", "stolen")]
+    assert alerts.match("KA05MN0001") == [("KA05*", "fleet")]
+    assert alerts.match("KL07CD0002") == []
+
+
+@pytest.mark.parametrize("pattern", ["--", " . "])
+def test_pattern_without_plate_characters_is_rejected(alerts, pool, pattern):
+    # the flag form shows this as an error instead of crashing the page
+    with pytest.raises(ValueError):
+        alerts.flag(pattern)
+    assert alerts.watchlist() == []
+    assert query_rows(pool, "SELECT COUNT(*) FROM policedb.watchlist") == [(0,)]
+
+
+def test_pattern_too_long_for_the_table_is_rejected(alerts, pool):
+    with pytest.raises(ValueError, match="longer than 50"):
+        alerts.flag("A" * 51)
+    with pytest.raises(ValueError, match="longer than 255"):
+        alerts.flag("TN01AB1234", "x" * 256)
+    assert alerts.flag("A" * 50) == "A" * 50
+    assert query_rows(pool, "SELECT pattern FROM policedb.watchlist") == [("A" * 50,)]
+
+
+def test_failed_write_leaves_no_flag_in_memory(alerts, pool):
+    with pool.connection() as conn:
+        conn.execute("DROP TABLE policedb.watchlist")
+        conn.commit()
+    with pytest.raises(sqlite3.OperationalError):
+        alerts.flag("TN01AB1234", "stolen")
+    assert alerts.match("TN01AB1234") == []
+    assert alerts.watchlist() == []
+
+
+def _log_plate(pool, plate):
+    columns = ", ".join(LOG_COLUMNS)
+    copied = ", ".join("?" if column == "vehicle_number" else column for column in LOG_COLUMNS)
+    with pool.connection() as conn:
+        conn.execute(f"INSERT INTO policedb.logs ({columns}) SELECT {copied} FROM policedb.logs ORDER BY id LIMIT 1",
+                     (plate,))
+        conn.commit()
+
+
+def test_flags_from_another_process_are_picked_up_by_the_scan(alerts, pool, logs_path):
+    # the API server flags through its own engine and connections, the dashboard's engine scans
+    other_pool = ConnectionPool(sqlite_factory(logs_path), max_size=1)
+    try:
+        other = AlertEngine(other_pool)
+        other.ensure_tables()
+        other.load()
+        other.flag("ZZ99XY*", "seen at the border")
+        _log_plate(pool, "ZZ99XY0001")
+        assert [(hit.vehicle_number, hit.pattern) for hit in alerts.scan_new()] == [("ZZ99XY0001", "ZZ99XY*")]
+        other.unflag("zz99xy*")
+        _log_plate(pool, "ZZ99XY0002")
+        assert alerts.scan_new() == []
+        assert alerts.watchlist() == []
+    finally:
+        other_pool.close()
@@ -0,0 +1,80 @@
+import pytest
+
+from approx import ApproxAnalytics, StratifiedSample, estimable
+from conftest import query_rows
+from rollups import ROLLUP_QUERIES, Rollups
+from schema import LOG_COLUMNS
+from service import AnalyticsService, Settings
+
+
+@pytest.fixture
+def approx(pool):
+    return ApproxAnalytics(pool, per_stratum=100, replicates=4)
+
+
+def test_first_refresh_samples_in_sql(approx, pool, monkeypatch):
+    def fold(self, batch, rows):
+        raise AssertionError("existing stops were read row by row")
+    monkeypatch.setattr(ApproxAnalytics, "_fold", fold)
+    approx.refresh(force=True)
+    assert approx.stats() == {"sampled": 300, "population": 3000, "last_id": 3000, "plate_sketch_total": 3000}
+    # one reservoir per country, filled to per_stratum
+    rows = list(approx._sample.weighted_rows())
+    countries = {row[LOG_COLUMNS.index("country_name")] for row, _ in rows}
+    assert countries == {"USA", "Canada", "India"}
+    assert sum(weight for _, weight in rows) == pytest.approx(3000)
+
+
+def test_new_stops_are_folded_after_the_seed(approx, pool):
+    approx.refresh(force=True)
+    with pool.connection() as conn:
+        conn.execute("INSERT INTO policedb.logs (country_name, vehicle_number, drugs_related_stop, search_type) "
+                     "VALUES ('India', 'ZZ99XY0001', 1, 'Frisk')")
+        conn.commit()
+    approx.refresh(force=True)
+    assert approx.stats()["population"] == 3001
+    assert approx._plates["drug_stops"].estimate(["ZZ99XY0001"])[0] >= 1
+
+
+def test_seeded_plate_sketches_never_under_count(approx, pool):
+    approx.refresh(force=True)
+    exact = query_rows(pool, "SELECT vehicle_number, COUNT(*) FROM policedb.logs GROUP BY vehicle_number")
+    estimates = approx._plates["stops"].estimate([plate for plate, _ in exact])
+    assert all(estimate >= count for estimate, (_, count) in zip(estimates, exact))
+
+
+def test_estimates_come_with_margins(approx, pool):
+    approx.refresh(force=True)
+    for title in ("Gender Distribution of Drivers Stopped in each Country",
+                  "Top 10 vehicle_Number involved in Drug-Related Stops"):
+        estimate = approx.estimate(ROLLUP_QUERIES[title])
+        # REAL cube columns keep the estimates numeric, so each gets a ± bound
+        assert len(estimate.margins.columns) and estimate.margins.notna().all().all(), title
+
+
+def test_plate_ordered_analysis_is_answered_exactly(logs_path, pool):
+    title = "Most Frequently Searched Vehicles"
+    assert not estimable(ROLLUP_QUERIES[title])
+    assert estimable(ROLLUP_QUERIES["Top 10 vehicle_Number involved in Drug-Related Stops"])
+    rollups = Rollups(pool)
+    rollups.ensure_tables()
+    rollups.refresh(force=True)
+    service = AnalyticsService(Settings(sqlite_path=logs_path))
+    try:
+        result, estimate = service.analysis(title, approximate=True)
+    finally:
+        service.close()
+    assert estimate is None
+    assert list(result.itertuples(index=False, name=None)) == query_rows(pool, ROLLUP_QUERIES[title])
+
+
+def test_merged_samples_stay_within_the_reservoir():
+    sample = StratifiedSample(per_stratum=10, seed=1)
+    for i in range(4):
+        sample.add("USA", ("usa", i))
+    sample.merge("USA", [("shard", i) for i in range(10)], 40)
+    sample.merge("India", [("india", i) for i in range(3)], 3)
+    assert sample.sampled() == 13 and sample.population() == 47
+    # the USA reservoir now stands for 44 stops, drawn from both sides
+    weights = {(source == "india", weight) for (source, _), weight in sample.weighted_rows()}
+    assert weights == {(False, 4.4), (True, 1.0)}
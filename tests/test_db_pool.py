@@ -0,0 +1,205 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from db_pool import ConnectionPool, PoolTimeout, is_disconnect, sqlite_factory
+
+
+class FakeConnection:
+    # a pymysql-like connection whose ping and rollback can be made to fail
+    def __init__(self, number):
+        self.number = number
+        self.open = True
+        self.ping_fails = False
+        self.rollback_fails = False
+        self.pings = 0
+
+    def ping(self, reconnect=True):
+        self.pings += 1
+        if self.ping_fails:
+            raise ConnectionError("server has gone away")
+
+    def rollback(self):
+        if self.rollback_fails:
+            raise ConnectionError("lost connection")
+
+    def close(self):
+        self.open = False
+
+
+class InterfaceError(Exception):
+    pass
+
+
+@pytest.fixture
+def connections():
+    return []
+
+
+@pytest.fixture
+def make_pool(connections):
+    pools = []
+
+    def make(**options):
+        def factory():
+            conn = FakeConnection(len(connections))
+            connections.append(conn)
+            return conn
+        pool = ConnectionPool(factory, **options)
+        pools.append(pool)
+        return pool
+    yield make
+    for pool in pools:
+        pool.close()
+
+
+def test_checkout_times_out_when_every_connection_is_in_use(make_pool):
+    pool = make_pool(max_size=1, checkout_timeout=0.1)
+    conn = pool.acquire()
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert time.monotonic() - started >= 0.1
+    assert pool.stats()["timeouts"] == 1
+    pool.release(conn)
+    assert pool.acquire() is conn
+
+
+def test_waiting_checkout_gets_the_released_connection(make_pool):
+    pool = make_pool(max_size=1, checkout_timeout=5.0)
+    conn = pool.acquire()
+    threading.Timer(0.05, pool.release, (conn,)).start()
+    assert pool.acquire() is conn
+    assert pool.stats()["wait_time"] >= 0.05
+
+
+@pytest.mark.parametrize("failure", ["ping", "closed"])
+def test_stale_connection_is_replaced_in_its_slot(make_pool, connections, failure):
+    # max_idle=0: every idle connection counts as stale and is pinged on checkout
+    pool = make_pool(max_size=1, max_idle=0.0)
+    pool.release(pool.acquire())
+    if failure == "ping":
+        connections[0].ping_fails = True
+    else:
+        connections[0].open = False
+    conn = pool.acquire()
+    assert conn is connections[1]
+    assert not connections[0].open
+    stats = pool.stats()
+    assert (stats["created"], stats["reconnects"], stats["open"]) == (2, 1, 1)
+
+
+def test_healthy_or_recently_used_connections_are_kept(make_pool, connections):
+    pool = make_pool(max_size=1, max_idle=0.0)
+    pool.release(pool.acquire())
+    assert pool.acquire() is connections[0]
+    assert connections[0].pings == 1
+    pool.release(connections[0])
+    # used a moment ago: not pinged at all, even if the ping would fail
+    fresh = make_pool(max_size=1, max_idle=300.0)
+    fresh.release(fresh.acquire())
+    connections[-1].ping_fails = True
+    assert fresh.acquire() is connections[-1]
+    assert connections[-1].pings == 0
+    assert fresh.stats()["reconnects"] == 0
+
+
+def test_failed_replacement_frees_the_slot(connections):
+    calls = []
+
+    def factory():
+        calls.append(1)
+        if len(calls) == 2:
+            raise ConnectionError("can't connect")
+        conn = FakeConnection(len(connections))
+        connections.append(conn)
+        return conn
+
+    pool = ConnectionPool(factory, max_size=1, max_idle=0.0)
+    pool.release(pool.acquire())
+    connections[0].ping_fails = True
+    with pytest.raises(ConnectionError):
+        pool.acquire()
+    assert pool.stats()["open"] == 0
+    assert pool.acquire() is connections[1]
+
+
+def test_broken_release_discards_the_connection(make_pool, connections):
+    pool = make_pool(max_size=1)
+    conn = pool.acquire()
+    pool.release(conn, broken=True)
+    assert not conn.open
+    assert pool.stats()["open"] == 0
+    assert pool.acquire() is connections[1]
+
+
+def test_failed_rollback_on_release_counts_as_broken(make_pool):
+    pool = make_pool(max_size=2)
+    conn = pool.acquire()
+    conn.rollback_fails = True
+    pool.release(conn)
+    assert not conn.open
+    assert (pool.stats()["open"], pool.stats()["idle"]) == (0, 0)
+
+
+def test_connection_block_discards_only_disconnected_connections(make_pool, connections):
+    pool = make_pool(max_size=2)
+    with pytest.raises(ValueError):
+        with pool.connection():
+            raise ValueError("bad value")
+    assert pool.stats()["idle"] == 1 and connections[0].open
+    with pytest.raises(ConnectionError):
+        with pool.connection() as conn:
+            assert conn is connections[0]
+            raise ConnectionError("lost connection")
+    assert not connections[0].open
+    assert (pool.stats()["open"], pool.stats()["idle"]) == (0, 0)
+
+
+def test_closed_sqlite_connection_is_dropped(logs_path):
+    pool = ConnectionPool(sqlite_factory(logs_path), max_size=1)
+    try:
+        with pytest.raises(sqlite3.ProgrammingError):
+            with pool.connection() as conn:
+                conn.close()
+                conn.execute("SELECT COUNT(*) FROM policedb.logs")
+        with pool.connection() as fresh:
+            assert fresh is not conn
+            assert fresh.execute("SELECT COUNT(*) FROM policedb.logs").fetchone() == (3000,)
+    finally:
+        pool.close()
+
+
+@pytest.mark.parametrize("error, expected", [
+    (OSError("broken pipe"), True),
+    (ConnectionResetError("reset by peer"), True),
+    (InterfaceError(0, ""), True),
+    (Exception(2006, "MySQL server has gone away"), True),
+    (Exception(2013, "Lost connection to MySQL server during query"), True),
+    (Exception(2055, "Lost connection to MySQL server"), True),
+    (Exception(1062, "Duplicate entry"), False),
+    (sqlite3.ProgrammingError("Cannot operate on a closed database."), True),
+    (sqlite3.OperationalError("database is locked"), False),
+    (ValueError("bad value"), False),
+])
+def test_is_disconnect(error, expected):
+    assert is_disconnect(error) is expected
+
+
+def test_stats_account_for_every_checkout(make_pool):
+    pool = make_pool(max_size=3)
+    held = [pool.acquire() for _ in range(3)]
+    stats = pool.stats()
+    assert {key: stats[key] for key in ("checkouts", "created", "open", "idle", "in_use", "max_size")} == {
+        "checkouts": 3, "created": 3, "open": 3, "idle": 0, "in_use": 3, "max_size": 3}
+    pool.release(held[0])
+    pool.release(held[1])
+    pool.release(pool.acquire())
+    stats = pool.stats()
+    assert (stats["checkouts"], stats["created"], stats["idle"], stats["in_use"]) == (4, 3, 2, 1)
+    pool.close()
+    assert (pool.stats()["open"], pool.stats()["in_use"]) == (1, 1)
+    pool.release(held[2], broken=True)
+    assert pool.stats()["open"] == 0
@@ -0,0 +1,107 @@
+import json
+
+import pandas as pd
+import pytest
+
+from diagnostics import QueryMonitor, tracked
+from service import AnalyticsService, Settings
+
+
+def _run(monitor, query, params=None, rows=1, label="", source="live"):
+    with monitor.track(query, params, source, label) as trace:
+        with trace.phase("execute"):
+            pass
+        return trace.result(pd.DataFrame({"n": range(rows)}))
+
+
+def test_recent_queries_are_a_bounded_ring_newest_first():
+    monitor = QueryMonitor(capacity=3)
+    for i in range(5):
+        _run(monitor, f"SELECT {i}")
+    assert [record.sql for record in monitor.recent()] == ["SELECT 4", "SELECT 3", "SELECT 2"]
+    assert [record.sql for record in monitor.recent(limit=1)] == ["SELECT 4"]
+
+
+def test_slow_queries_keep_one_explain_per_statement():
+    explained = []
+
+    def explain(query, params, source):
+        explained.append((query, params, source))
+        return "SCAN logs"
+
+    monitor = QueryMonitor(slow_ms=0.0, slow_capacity=2, explain_fn=explain)
+    for value in (1, 2, 3):
+        _run(monitor, "SELECT *  FROM logs WHERE id = %s", (value,), label="by id")
+    # the same normalised statement is explained once, the ring keeps the last two
+    assert explained == [("SELECT *  FROM logs WHERE id = %s", (1,), "live")]
+    slow = monitor.slow()
+    assert [record.params for record in slow] == [(3,), (2,)]
+    assert all(record.plan == "SCAN logs" and record.label == "by id" for record in slow)
+
+
+def test_cached_and_failed_queries_are_never_slow():
+    monitor = QueryMonitor(slow_ms=0.0, explain_fn=lambda *args: "plan")
+    with monitor.track("SELECT 1") as trace:
+        trace.rows = 1
+    with pytest.raises(ZeroDivisionError):
+        with monitor.track("SELECT 2") as trace:
+            with trace.phase("execute"):
+                1 / 0
+    cached, failed = monitor.recent()[::-1]
+    assert cached.cached and not cached.error
+    assert failed.error.startswith("ZeroDivisionError") and not failed.cached
+    assert monitor.slow() == []
+
+
+def test_explain_failure_is_recorded_as_the_plan():
+    def explain(query, params, source):
+        raise RuntimeError("no such table")
+
+    monitor = QueryMonitor(slow_ms=0.0, explain_fn=explain)
+    _run(monitor, "SELECT 1")
+    assert monitor.slow()[0].plan == "EXPLAIN failed: RuntimeError: no such table"
+
+
+def test_summary_totals_per_statement_and_reset():
+    monitor = QueryMonitor()
+    for rows in (2, 5):
+        _run(monitor, "SELECT a FROM t", rows=rows, label="a")
+    _run(monitor, "SELECT b FROM t", label="b")
+    summary = {row["label"]: row for row in monitor.summary()}
+    assert summary["a"]["calls"] == 2 and summary["a"]["rows"] == 5
+    assert summary["b"]["calls"] == 1
+    monitor.reset()
+    assert monitor.summary() == monitor.recent() == monitor.slow() == []
+
+
+def test_every_query_is_exported_as_a_json_line(tmp_path):
+    path = tmp_path / "queries.jsonl"
+    monitor = QueryMonitor(slow_ms=0.0, explain_fn=lambda *args: "plan", metrics_path=str(path))
+    _run(monitor, "SELECT %s", (1,), rows=3, label="one")
+    _run(monitor, "SELECT %s", (2,), rows=3, label="one")
+    lines = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [line["params"] for line in lines] == [["1"], ["2"]]
+    assert lines[0]["label"] == "one" and lines[0]["rows"] == 3 and lines[0]["plan"] == "plan"
+    assert set(lines[0]["phases"]) == {"execute"}
+    assert "T" in lines[0]["started_at"]
+
+
+def test_tracked_without_a_monitor_still_times_phases():
+    with tracked(None, "SELECT 1") as trace:
+        with trace.phase("execute"):
+            pass
+    assert set(trace.phases) == {"execute"}
+
+
+def test_browse_and_search_are_monitored(logs_path):
+    service = AnalyticsService(Settings(sqlite_path=logs_path, slow_query_ms=0.0))
+    try:
+        where, params, plans, _, _ = service.plan_search(vehicle="TN1")
+        service.browse(where=where, params=params, plans=plans)
+        labels = {record.label: record for record in service.monitor.recent()}
+    finally:
+        service.close()
+    assert {"search/plate candidates", "browse/page by stop_date", "browse/approximate count"} <= set(labels)
+    page = labels["browse/page by stop_date"]
+    assert page.source == "live" and page.rows > 0 and "execute" in page.phases
+    assert "policedb.logs" in page.plan
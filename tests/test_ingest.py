@@ -0,0 +1,62 @@
+import io
+
+import pandas as pd
+
+from db_pool import sqlite_factory
+from ingest import clean_chunk, ingest_csv, read_checkpoint, write_load_data_csv
+
+CSV = """stop_date,stop_time,country_name,driver_gender,driver_age_raw,driver_age,driver_race,violation_raw,violation,search_conducted,search_type,stop_outcome,is_arrested,stop_duration,drugs_related_stop,vehicle_number
+2020-01-02,10:11:12,Canada,M,30,30,White,Speeding,Speeding,False,,Ticket,False,0-15 Min,False,TN10AA0001
+,not a time,,F,,,Asian,,Signal,,,Warning,True,,1,TN10AA0002
+2020-13-40,23:59:59,India,,41,41.0,,DUI,DUI,True,Frisk,Arrest,,30+ Min,0,
+"""
+
+
+def _load(tmp_path, **options):
+    csv_path = tmp_path / "stops.csv"
+    csv_path.write_text(CSV)
+    conn = sqlite_factory(str(tmp_path / "ingest.sqlite"))()
+    ingest_csv(conn, str(csv_path), progress=lambda message: None, **options)
+    return conn, str(csv_path)
+
+
+def test_missing_values_load_as_null(tmp_path):
+    conn, _ = _load(tmp_path, chunk_size=2)
+    rows = conn.execute("SELECT stop_date, stop_time, country_name, driver_age, search_conducted, search_type, "
+                        "is_arrested, drugs_related_stop, vehicle_number FROM policedb.logs ORDER BY id").fetchall()
+    assert rows == [
+        ("2020-01-02", "10:11:12", "Canada", 30, 0, "No Search", 0, 0, "TN10AA0001"),
+        (None, None, None, None, None, "No Search", 1, 1, "TN10AA0002"),
+        (None, "23:59:59", "India", 41, 1, "Frisk", None, 0, None),
+    ]
+
+
+def test_resume_skips_loaded_rows(tmp_path):
+    conn, csv_path = _load(tmp_path, chunk_size=2)
+    assert read_checkpoint(conn, csv_path) == 3
+    conn.close()
+    # a second run with the checkpoint in place loads nothing new
+    conn, _ = _load(tmp_path, chunk_size=2)
+    assert conn.execute("SELECT COUNT(*) FROM policedb.logs").fetchone() == (3,)
+
+
+def test_resume_mid_file_loads_each_remaining_row_once(tmp_path):
+    conn, csv_path = _load(tmp_path, chunk_size=1)
+    # as if the run had stopped after the first chunk
+    conn.execute("DELETE FROM policedb.logs WHERE id > 1")
+    conn.execute("UPDATE policedb.ingest_checkpoints SET rows_done = 1")
+    conn.commit()
+    conn.close()
+    conn, _ = _load(tmp_path, chunk_size=1)
+    rows = conn.execute("SELECT vehicle_number FROM policedb.logs ORDER BY id").fetchall()
+    assert rows == [("TN10AA0001",), ("TN10AA0002",), (None,)]
+    assert read_checkpoint(conn, csv_path) == 3
+
+
+def test_load_data_file_writes_unquoted_null(tmp_path):
+    chunk = clean_chunk(pd.read_csv(io.StringIO(CSV)))
+    out = io.StringIO()
+    write_load_data_csv(chunk, out)
+    second = out.getvalue().splitlines()[1].split(",")
+    assert second[:6] == ["NULL", "NULL", "NULL", "F", "NULL", "Asian"]
+    assert "\\N" not in out.getvalue()
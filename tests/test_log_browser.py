@@ -0,0 +1,80 @@
+import pytest
+
+from conftest import query_rows
+from db_pool import adapt_query
+from log_browser import SORT_INDEXES, SORT_KEYS, approximate_count, ensure_sort_indexes, fetch_page, page_query
+
+
+def _walk(pool, sort, descending, page_size, where="", params=()):
+    ids = []
+    after = None
+    while True:
+        page = fetch_page(pool, sort, descending, after, page_size, where, params)
+        ids.extend(int(i) for i in page.rows["id"])
+        if not page.has_more:
+            return ids, page
+        after = page.next_cursor
+
+
+@pytest.fixture
+def pool_with_nulls(pool):
+    # NULL sort keys sort first ascending and last descending, the keyset has to step over them
+    with pool.connection() as conn:
+        conn.execute("UPDATE policedb.logs SET driver_age = NULL, vehicle_number = NULL WHERE id % 7 = 0")
+        conn.execute("UPDATE policedb.logs SET stop_date = NULL WHERE id % 11 = 0")
+        conn.commit()
+    return pool
+
+
+@pytest.mark.parametrize("sort", list(SORT_KEYS))
+@pytest.mark.parametrize("descending", [False, True])
+def test_every_row_exactly_once_in_order(pool_with_nulls, sort, descending):
+    ids, _ = _walk(pool_with_nulls, sort, descending, 250)
+    assert len(ids) == len(set(ids)) == 3000
+    keys = ", ".join(k + (" DESC" if descending else "") for k in SORT_KEYS[sort])
+    expected = [row[0] for row in query_rows(pool_with_nulls, f"SELECT id FROM policedb.logs ORDER BY {keys}")]
+    assert ids == expected
+
+
+def test_page_size_dividing_the_table_has_no_empty_last_page(pool):
+    # 3000 rows in pages of 1000: the third page must say there is nothing more
+    pages = []
+    after = None
+    while True:
+        page = fetch_page(pool, "id", False, after, 1000)
+        pages.append(len(page.rows))
+        if not page.has_more:
+            break
+        after = page.next_cursor
+    assert pages == [1000, 1000, 1000]
+
+
+def test_filtered_pages_and_empty_result(pool):
+    where, params = "country_name = %s", ["India"]
+    ids, _ = _walk(pool, "driver_age", False, 97, where, params)
+    expected = query_rows(pool, "SELECT COUNT(*) FROM policedb.logs WHERE country_name = ?", params)[0][0]
+    assert len(ids) == len(set(ids)) == expected
+    assert approximate_count(pool, where, params) == expected
+
+    page = fetch_page(pool, "id", False, None, 50, "country_name = %s", ["Nowhere"])
+    assert page.rows.empty and not page.has_more and page.next_cursor is None
+
+
+def test_unknown_sort_key_is_rejected(pool):
+    with pytest.raises(ValueError):
+        fetch_page(pool, "id; DROP TABLE logs", False, None, 10)
+
+
+@pytest.mark.parametrize("sort", list(SORT_KEYS))
+@pytest.mark.parametrize("descending", [False, True])
+def test_pages_range_scan_the_sort_index(pool, sort, descending):
+    ensure_sort_indexes(pool)
+    ensure_sort_indexes(pool)
+    after = fetch_page(pool, sort, descending, page_size=50).next_cursor
+    query, params = page_query(sort, descending, after, page_size=50)
+    plan = " | ".join(row[-1] for row in query_rows(pool, "EXPLAIN QUERY PLAN " + adapt_query(query, "sqlite"),
+                                                    params))
+    assert "TEMP B-TREE" not in plan
+    for name, keys in SORT_INDEXES.items():
+        if keys == SORT_KEYS[sort]:
+            assert name in plan
@@ -0,0 +1,81 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from conftest import query_rows
+from db_pool import ConnectionPool, sqlite_factory
+from predictor import PredictionIndex
+from schema import create_logs_table
+
+
+@pytest.fixture
+def stops(pool):
+    return pd.DataFrame(query_rows(pool, "SELECT driver_gender, driver_age, search_conducted, stop_time, "
+                                         "drugs_related_stop, stop_outcome, violation FROM policedb.logs"),
+                        columns=["gender", "age", "search", "time", "drugs", "outcome", "violation"])
+
+
+@pytest.fixture
+def index(pool):
+    index = PredictionIndex(pool)
+    index.refresh(force=True)
+    return index
+
+
+def _expected(group):
+    # pandas mode()[0] is the reference the index reproduces
+    return group["outcome"].mode()[0], group["violation"].mode()[0], len(group)
+
+
+def test_same_hour_is_the_most_specific_level(index, stops):
+    row = stops.iloc[0]
+    stop_time = datetime.time.fromisoformat(row["time"])
+    same = stops[(stops["gender"] == row["gender"]) & (stops["age"] == row["age"])
+                 & (stops["search"] == row["search"]) & (stops["drugs"] == row["drugs"])
+                 & (stops["time"].str[:2] == row["time"][:2])]
+    # any second of the hour answers the same
+    for moment in (stop_time, stop_time.replace(minute=59, second=59)):
+        prediction = index.predict(row["gender"], row["age"], row["search"], moment, row["drugs"])
+        assert prediction.level == "same hour"
+        assert (prediction.outcome, prediction.violation, prediction.support) == _expected(same)
+
+
+def test_index_size_follows_feature_cardinality(index):
+    sizes = [len(level) for level in index._levels]
+    # a busy hour of stops, every one at its own second, adds no keys
+    for second in range(3600):
+        index.add("M", 30, 0, datetime.time(13, second // 60, second % 60), 0, "Warning", "Speeding")
+    assert all(len(level) <= size + 1 for level, size in zip(index._levels, sizes))
+
+
+@pytest.mark.parametrize("form_gender, stored", [("Male", "M"), ("Female", "F"), ("male", "M")])
+def test_form_gender_uses_the_stored_codes(index, form_gender, stored):
+    args = (30, "0", datetime.time(13, 0), "0")
+    assert index.predict(form_gender, *args) == index.predict(stored, *args)
+    assert index.predict(form_gender, *args).level != "same search and drug flags"
+
+
+def test_unseen_age_falls_back_to_the_age_band(index, stops):
+    prediction = index.predict("M", 99, "1", datetime.time(3, 0), "1")
+    assert prediction.level in ("same age band and hour", "same age band", "same search and drug flags")
+    if prediction.level == "same search and drug flags":
+        group = stops[(stops["search"] == 1) & (stops["drugs"] == 1)]
+        assert (prediction.outcome, prediction.violation, prediction.support) == _expected(group)
+
+
+def test_new_stops_are_picked_up_and_empty_table_defaults(index, tmp_path):
+    index.add("F", 77, 1, "04:05:06", 1, "Arrest", "DUI")
+    assert index.predict("Female", 77, "1", datetime.time(4, 30), "1")[:3] == ("Arrest", "DUI", "same hour")
+
+    path = str(tmp_path / "empty.sqlite")
+    conn = sqlite_factory(path)()
+    create_logs_table(conn)
+    conn.close()
+    empty = ConnectionPool(sqlite_factory(path), max_size=1)
+    try:
+        empty_index = PredictionIndex(empty)
+        empty_index.refresh(force=True)
+        assert empty_index.predict("M", 30, "0", datetime.time(12, 0), "0").level == "default"
+    finally:
+        empty.close()
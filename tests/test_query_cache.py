@@ -0,0 +1,88 @@
+import pandas as pd
+
+from query_cache import QueryCache
+
+
+def _frame(value):
+    return pd.DataFrame({"counts": [value]})
+
+
+def test_hit_until_table_version_moves():
+    version = [1]
+    cache = QueryCache(version_fn=lambda: version[0], version_check_interval=0)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return _frame(len(calls))
+
+    assert cache.get_or_compute("SELECT  1;", None, compute)["counts"][0] == 1
+    # whitespace and the trailing semicolon don't change the key
+    assert cache.get_or_compute("SELECT 1", None, compute)["counts"][0] == 1
+    version[0] = 2
+    assert cache.get_or_compute("SELECT 1", None, compute)["counts"][0] == 2
+    assert len(calls) == 2
+
+
+def test_invalidate_and_params_and_namespace():
+    cache = QueryCache(version_fn=lambda: 1, version_check_interval=60)
+    cache.put("SELECT %s", (1,), _frame(1))
+    cache.put("SELECT %s", (1,), _frame(9), namespace="snapshot")
+    assert cache.get("SELECT %s", (2,)) is None
+    assert cache.get("SELECT %s", (1,))["counts"][0] == 1
+    assert cache.get("SELECT %s", (1,), namespace="snapshot")["counts"][0] == 9
+    cache.invalidate()
+    assert cache.get("SELECT %s", (1,)) is None
+
+
+def test_result_computed_across_a_version_change_is_not_stored():
+    version = [1]
+    cache = QueryCache(version_fn=lambda: version[0], version_check_interval=0)
+
+    def compute():
+        # a write lands while the query runs
+        cache.invalidate()
+        return _frame(1)
+
+    cache.get_or_compute("SELECT 1", None, compute)
+    assert cache.get("SELECT 1") is None
+
+
+def test_ttl_and_lru_bounds():
+    cache = QueryCache(ttl=0, max_entries=2)
+    cache.put("SELECT 1", None, _frame(1))
+    assert cache.get("SELECT 1") is None
+    cache = QueryCache(max_entries=2)
+    for i in range(3):
+        cache.put(f"SELECT {i}", None, _frame(i))
+    assert cache.get("SELECT 0") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cached_frames_are_not_shared_with_callers():
+    cache = QueryCache()
+    result = cache.get_or_compute("SELECT 1", None, lambda: _frame(1))
+    result["counts"] = 5
+    assert cache.get("SELECT 1")["counts"][0] == 1
+
+
+def test_snapshot_answers_follow_a_re_export(logs_path, tmp_path):
+    from benchmark import generate
+    from db_pool import sqlite_factory
+    from service import AnalyticsService, Settings
+    from snapshot import export_snapshot
+
+    # the live table doesn't move between the exports, only the snapshot does
+    source = sqlite_factory(str(tmp_path / "source.sqlite"))()
+    snapshot_path = str(tmp_path / "snapshot")
+    generate(source, 200, batch_size=100, seed=3, progress=lambda message: None)
+    export_snapshot(source, snapshot_path, progress=lambda message: None)
+    service = AnalyticsService(Settings(sqlite_path=logs_path, snapshot_path=snapshot_path))
+    query = "SELECT COUNT(*) AS total FROM policedb.logs"
+    assert service.fetch(query, snapshot=True)["total"][0] == 200
+    assert service.fetch(query)["total"][0] == 3000
+
+    generate(source, 100, batch_size=100, seed=4, progress=lambda message: None)
+    export_snapshot(source, snapshot_path, progress=lambda message: None)
+    source.close()
+    assert service.fetch(query, snapshot=True)["total"][0] == 300
@@ -0,0 +1,128 @@
+import pytest
+
+from analyses import QUERY_MAP
+from conftest import query_frame, query_rows
+from db_pool import adapt_query, dialect_of
+from rollups import ROLLUP_QUERIES, Rollups
+from schema import LOG_COLUMNS
+
+
+def _rows(frame):
+    # order-insensitive, floats compared to 6 places, NaN as None
+    rows = [tuple((None if v != v else round(v, 6)) if isinstance(v, float) else v for v in row)
+            for row in frame.itertuples(index=False, name=None)]
+    return sorted(rows, key=repr)
+
+
+# raw-table references for analyses whose QUERY_MAP text doesn't run on SQLite or isn't what the rollup answers
+# on MySQL (stray semicolons, the traffic_stops table, YEAR(stop_time), EXTRACT, integer division,
+# case-sensitive != 'NO SEARCH')
+REFERENCE = {
+    "Most Frequently Searched Vehicles": """
+        SELECT vehicle_number, COUNT(*) FROM policedb.logs WHERE LOWER(search_type) <> 'no search'
+        GROUP BY vehicle_number ORDER BY vehicle_number DESC LIMIT 10""",
+    "Most Common Violations for Young Drivers Under 25": """
+        SELECT violation, COUNT(*) FROM policedb.logs WHERE driver_age < 25 GROUP BY violation""",
+    "Yearly Breakdown of Stops and Arrests by Country": """
+        SELECT COUNTRY_NAME, STOP_YEAR, TOTAL_STOP, TOTAL_ARREST, ROUND(TOTAL_ARREST * 100.0 / TOTAL_STOP, 2),
+               RANK() OVER (PARTITION BY STOP_YEAR ORDER BY TOTAL_ARREST DESC)
+        FROM (SELECT country_name AS COUNTRY_NAME, YEAR(stop_date) AS STOP_YEAR, COUNT(*) AS TOTAL_STOP,
+                     SUM(CASE WHEN is_arrested = 1 THEN 1 ELSE 0 END) AS TOTAL_ARREST
+              FROM policedb.logs GROUP BY country_name, YEAR(stop_date)) AS YEARLY_STATS""",
+    "Time Period Analysis of Stops, Number of Stops by Year, Month, Hour of the Day": """
+        SELECT YEAR(stop_date), MONTH(stop_date), HOUR(stop_time), COUNT(*) FROM policedb.logs
+        GROUP BY YEAR(stop_date), MONTH(stop_date), HOUR(stop_time)""",
+    "Violations with High Search & Arrest Rates": """
+        SELECT VIOLATION, TOTAL_STOP, TOTAL_ARREST, TOTAL_SEARCH, ROUND(100.0 * TOTAL_ARREST / TOTAL_STOP, 2),
+               ROUND(100.0 * TOTAL_SEARCH / TOTAL_STOP, 2),
+               RANK() OVER (ORDER BY TOTAL_ARREST * 1.0 / TOTAL_STOP DESC),
+               RANK() OVER (ORDER BY TOTAL_SEARCH * 1.0 / TOTAL_STOP DESC)
+        FROM (SELECT violation AS VIOLATION, COUNT(*) AS TOTAL_STOP,
+                     SUM(CASE WHEN is_arrested = 1 THEN 1 ELSE 0 END) AS TOTAL_ARREST,
+                     SUM(CASE WHEN search_conducted = 1 THEN 1 ELSE 0 END) AS TOTAL_SEARCH
+              FROM policedb.logs GROUP BY violation) AS VIOLATION_STATS""",
+}
+
+# top-N analyses whose ties may come back in any order: the reference is the full ranking
+TOP = {
+    "Top 10 vehicle_Number involved in Drug-Related Stops": (10, """
+        SELECT vehicle_number, COUNT(*) FROM policedb.logs WHERE drugs_related_stop = 1 GROUP BY vehicle_number"""),
+    "Race & Gender Combination with Highest Search Rate": (1, """
+        SELECT driver_race, driver_gender, COUNT(*) FROM policedb.logs WHERE LOWER(search_type) <> 'no search'
+        GROUP BY driver_race, driver_gender"""),
+}
+
+
+def _assert_equivalent(pool, title):
+    answer = _rows(query_frame(pool, ROLLUP_QUERIES[title]))
+    if title in TOP:
+        limit, query = TOP[title]
+        full = _rows(query_frame(pool, query))
+        # every returned row is right and the counts are the top ones
+        assert len(answer) == limit and set(answer) <= set(full)
+        assert sorted(row[-1] for row in answer) == sorted(row[-1] for row in full)[-limit:]
+        return
+    assert answer == _rows(query_frame(pool, REFERENCE.get(title, QUERY_MAP[title])))
+
+
+def _copy_rows(pool, ids, new_ids):
+    # re-inserts existing stops under explicit ids, like a transaction that took its ids earlier
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        for old, new in zip(ids, new_ids):
+            cursor.execute(adapt_query(
+                f"INSERT INTO policedb.logs (id, {', '.join(LOG_COLUMNS)}) "
+                f"SELECT %s, {', '.join(LOG_COLUMNS)} FROM policedb.logs WHERE id = %s", dialect_of(conn)),
+                (new, old))
+        conn.commit()
+
+
+@pytest.fixture
+def rollups(pool):
+    rollups = Rollups(pool, refresh_interval=0)
+    rollups.ensure_tables()
+    rollups.refresh(force=True)
+    return rollups
+
+
+@pytest.mark.parametrize("title", list(ROLLUP_QUERIES))
+def test_rollup_answers_match_the_raw_queries(pool, rollups, title):
+    _assert_equivalent(pool, title)
+
+
+def test_refresh_folds_new_rows_once(pool, rollups):
+    _copy_rows(pool, range(1, 101), range(3001, 3101))
+    assert rollups.refresh(force=True) == 100
+    assert rollups.refresh(force=True) == 0
+    assert query_rows(pool, "SELECT SUM(stops) FROM policedb.rollup_daily") == [(3100,)]
+    _assert_equivalent(pool, "Time of Day with Most Traffic Stops")
+
+
+def test_rows_committed_below_the_watermark_are_folded_late(pool, rollups):
+    # 3001-3003 commit first, 3004-3006 belong to a transaction that commits after the refresh
+    _copy_rows(pool, [1, 2, 3], [3001, 3002, 3007])
+    rollups.refresh(force=True)
+    assert query_rows(pool, "SELECT last_id FROM policedb.rollup_state") == [(3007,)]
+    assert query_rows(pool, "SELECT low, high FROM policedb.watermark_gaps WHERE name = 'rollups'") == [(3003, 3006)]
+
+    _copy_rows(pool, [4, 5], [3004, 3005])
+    rollups.refresh(force=True)
+    assert query_rows(pool, "SELECT low, high FROM policedb.watermark_gaps WHERE name = 'rollups'") == [(3003, 3003),
+                                                                                                    (3006, 3006)]
+    _copy_rows(pool, [6], [3003])
+    rollups.refresh(force=True)
+    assert query_rows(pool, "SELECT SUM(stops) FROM policedb.rollup_daily") == [(3006,)]
+    for title in ROLLUP_QUERIES:
+        _assert_equivalent(pool, title)
+
+
+def test_stops_without_a_duration_fold_as_zero(pool, rollups):
+    # a new profile cell whose only stop has no duration sums NULL durations
+    _copy_rows(pool, [1], [3001])
+    with pool.connection() as conn:
+        conn.execute("UPDATE policedb.logs SET violation = 'Loitering', stop_duration = NULL WHERE id = 3001")
+        conn.commit()
+    assert rollups.refresh(force=True) == 1
+    assert query_rows(pool, "SELECT stops, duration_sum, duration_count FROM policedb.rollup_profile "
+                            "WHERE violation = 'Loitering'") == [(1, 0, 0)]
+    _assert_equivalent(pool, "Average Stop Duration for different Violations")
@@ -0,0 +1,69 @@
+import pytest
+
+from conftest import query_rows
+from db_pool import adapt_query, dialect_of
+from schema import insert_sql
+from search import LogSearch
+
+
+def _insert(pool, **values):
+    row = {"stop_date": "2024-05-01", "stop_time": "10:00:00", "country_name": "India", "driver_gender": "M",
+           "driver_age": 30, "driver_race": "Asian", "violation_raw": "Speeding", "violation": "Speeding",
+           "search_conducted": 0, "search_type": "No Search", "stop_outcome": "Ticket", "is_arrested": 0,
+           "stop_duration": "0-15 Min", "drugs_related_stop": 0, "vehicle_number": "TN10AA0000"}
+    row.update(values)
+    with pool.connection() as conn:
+        conn.cursor().execute(adapt_query(insert_sql(), dialect_of(conn)), list(row.values()))
+        conn.commit()
+
+
+def _search(pool, search, **filters):
+    plan = search.plan(**filters)
+    if plan.empty:
+        return set()
+    where = f" WHERE {plan.where}" if plan.where else ""
+    return {row[0] for row in query_rows(pool, f"SELECT id FROM policedb.logs{where}", plan.params)}
+
+
+def _like(pool, vehicle="", violation="", country=""):
+    # the baseline filter: case-insensitive substring match on each column
+    return {row[0] for row in query_rows(
+        pool, "SELECT id FROM policedb.logs WHERE vehicle_number LIKE ? AND violation LIKE ? AND country_name LIKE ?",
+        [f"%{vehicle}%", f"%{violation}%", f"%{country}%"])}
+
+
+@pytest.fixture
+def search(pool):
+    search = LogSearch(pool, refresh_interval=3600)
+    search.ensure_indexes()
+    search.refresh(force=True)
+    return search
+
+
+@pytest.mark.parametrize("filters", [
+    {"vehicle": "TN1"}, {"vehicle": "aa00"}, {"vehicle": "T"}, {"vehicle": "ZZZ"},
+    {"country": "ind", "violation": "dui"}, {"country": "a", "vehicle": "BA0"}, {"violation": "nothing"},
+])
+def test_plan_matches_the_like_filter(pool, search, filters):
+    assert _search(pool, search, **filters) == _like(pool, **filters)
+
+
+def test_stops_written_after_the_last_refresh_are_found(pool, search):
+    # the index isn't refreshed for an hour, new plates and values still have to match
+    _insert(pool, vehicle_number="ZZ99XY0001", country_name="Nepal", violation="Overloading")
+    for filters in ({"vehicle": "ZZ99XY0001"}, {"country": "nepal"}, {"violation": "overload"},
+                    {"vehicle": "XY0", "country": "Nep"}, {"vehicle": "TN1"}):
+        found = _search(pool, search, **filters)
+        assert found == _like(pool, **filters) and found
+
+
+def test_incremental_refresh_counts_new_values(pool, search):
+    before = dict(search._values["country_name"])
+    _insert(pool, country_name="Nepal")
+    _insert(pool, country_name="India")
+    search.refresh(force=True)
+    after = search._values["country_name"]
+    assert after["Nepal"] == 1 and after["India"] == before["India"] + 1
+    assert after == {value: count for value, count in query_rows(
+        pool, "SELECT country_name, COUNT(*) FROM policedb.logs GROUP BY country_name")}
+    assert search.plan(country="nepal").strategy == ["country_name: exact index on 1 value(s)"]
@@ -0,0 +1,61 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from conftest import query_rows
+from frames import date_text
+from service import AnalyticsService, Settings, call, call_batch
+
+
+def test_search_serialises_stop_date_as_a_date(logs_path, pool):
+    with pool.connection() as conn:
+        conn.execute("UPDATE policedb.logs SET stop_date = NULL WHERE id = 1")
+        conn.commit()
+    service = AnalyticsService(Settings(sqlite_path=logs_path))
+    try:
+        response = call(service, {"id": 1, "method": "search", "params": {"page_size": 5}})
+    finally:
+        service.close()
+    answer = response["result"]
+    dates = [row[answer["columns"].index("stop_date")] for row in answer["rows"]]
+    # NULLs sort first, the rest are plain dates
+    assert dates[0] is None
+    assert all(re.fullmatch(r"\d{4}-\d{2}-\d{2}", date) for date in dates[1:])
+    assert dates[1:] == [str(row[0]) for row in query_rows(
+        pool, "SELECT stop_date FROM policedb.logs WHERE stop_date IS NOT NULL ORDER BY stop_date, stop_time, id "
+              "LIMIT 4")]
+
+
+def test_date_text_drops_the_midnight():
+    dates = pd.Series(pd.to_datetime(["2019-01-11", None]))
+    assert date_text(dates).tolist() == ["2019-01-11", ""]
+
+
+def test_batch_answers_every_element_even_malformed_ones(logs_path):
+    service = AnalyticsService(Settings(sqlite_path=logs_path))
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            responses = call_batch(service, [{"id": 1, "method": "stats"}, 5, None, ["stats"],
+                                             {"id": 2, "method": "stats", "params": [1]},
+                                             {"id": 3, "method": "nope"}], executor)
+    finally:
+        service.close()
+    assert "result" in responses[0]
+    assert [response["id"] for response in responses] == [1, None, None, None, 2, 3]
+    errors = [response["error"].split(":")[0] for response in responses[1:]]
+    assert errors == ["TypeError", "TypeError", "TypeError", "TypeError", "KeyError"]
+
+
+def test_each_process_writes_its_own_spool(logs_path, tmp_path):
+    settings = Settings(sqlite_path=logs_path, spool_dir=str(tmp_path), process="serve")
+    assert settings.writer_paths("usa") == (str(tmp_path / "pending_stops_serve_usa.jsonl"),
+                                            str(tmp_path / "dead_stops_serve_usa.jsonl"))
+    service = AnalyticsService(settings)
+    try:
+        writer = service.writer
+        assert (writer.spool_path, writer.dead_letter_path) == settings.writer_paths()
+    finally:
+        service.close()
+    dashboard = Settings(spool_dir=str(tmp_path), process="dashboard")
+    assert dashboard.writer_paths()[0] != settings.writer_paths()[0]
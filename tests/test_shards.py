@@ -0,0 +1,204 @@
+import json
+
+import pytest
+
+from alerts import AlertEngine
+from conftest import query_frame, query_rows
+from predictor import PredictionIndex
+from rollups import ROLLUP_QUERIES, Rollups
+from schema import LOG_COLUMNS
+from service import AnalyticsService, Settings, call
+from shards import ShardedAlertEngine, ShardedApproxAnalytics, ShardedPredictionIndex, ShardSet
+from test_rollups import TOP, _rows
+
+
+@pytest.fixture
+def shards_path(tmp_path, pool):
+    # the synthetic stops split into a USA shard and one for every other country
+    path = tmp_path / "shards.json"
+    path.write_text(json.dumps({"shards": [
+        {"name": "usa", "countries": ["USA"], "sqlite": str(tmp_path / "usa.sqlite")},
+        {"name": "rest", "sqlite": str(tmp_path / "rest.sqlite")},
+    ]}))
+    shards = ShardSet.from_config(str(path))
+    with pool.connection() as conn:
+        shards.split(conn, progress=lambda message: None)
+    shards.close()
+    return str(path)
+
+
+@pytest.fixture
+def shards(shards_path):
+    shards = ShardSet.from_config(shards_path)
+    yield shards
+    shards.close()
+
+
+def _add_stop(shard, vehicle_number):
+    # a copy of the shard's first stop under a new plate, returns its id
+    columns = ", ".join(LOG_COLUMNS)
+    copied = ", ".join("?" if column == "vehicle_number" else column for column in LOG_COLUMNS)
+    with shard.pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"INSERT INTO policedb.logs ({columns}) "
+                       f"SELECT {copied} FROM policedb.logs ORDER BY id LIMIT 1",
+                       (vehicle_number,))
+        conn.commit()
+        return cursor.lastrowid
+
+
+def test_split_routes_every_stop(shards):
+    usa, rest = shards.shards
+    assert query_rows(usa.pool, "SELECT DISTINCT country_name FROM policedb.logs") == [("USA",)]
+    counts = [query_rows(shard.pool, "SELECT COUNT(*) FROM policedb.logs")[0][0] for shard in shards.shards]
+    assert sum(counts) == 3000 and all(counts)
+
+
+def test_fetch_sums_partials_per_key(shards, pool):
+    query = "SELECT violation, COUNT(*) AS stops, SUM(is_arrested) AS arrests FROM policedb.logs GROUP BY violation"
+    merged = shards.fetch(query, group_by=["violation"])
+    merged["violation"] = merged["violation"].astype(str)
+    assert _rows(merged) == _rows(query_frame(pool, query))
+
+
+@pytest.mark.parametrize("query, group_by", [
+    ("SELECT MAX(driver_age) AS oldest FROM policedb.logs", ()),
+    ("SELECT country_name, AVG(driver_age) AS age FROM policedb.logs GROUP BY country_name", ["country_name"]),
+    ("SELECT COUNT(DISTINCT vehicle_number) AS vehicles FROM policedb.logs", ()),
+    ("SELECT violation, COUNT(*) AS stops FROM policedb.logs GROUP BY violation HAVING COUNT(*) > 5",
+     ["violation"]),
+    ("SELECT violation, COUNT(*) AS stops FROM policedb.logs GROUP BY violation ORDER BY stops DESC LIMIT 3",
+     ["violation"]),
+    ("SELECT violation, COUNT(*) AS stops FROM policedb.logs GROUP BY violation", ()),
+    ("SELECT vehicle_number FROM policedb.logs", ()),
+])
+def test_fetch_refuses_partials_that_do_not_add_up(shards, query, group_by):
+    with pytest.raises(ValueError, match="across shards"):
+        shards.fetch(query, group_by=group_by)
+
+
+def test_fetch_ignores_keywords_inside_literals(shards, pool):
+    query = "SELECT SUM(CASE WHEN LOWER(stop_outcome) LIKE '%max%' THEN 1 ELSE 0 END) AS n, COUNT(*) AS stops " \
+            "FROM policedb.logs"
+    assert _rows(shards.fetch(query)) == _rows(query_frame(pool, query))
+
+
+@pytest.mark.parametrize("title", list(ROLLUP_QUERIES))
+def test_merged_cubes_answer_like_one_database(shards, pool, title):
+    shards.ensure_rollups()
+    shards.refresh_rollups(force=True)
+    rollups = Rollups(pool)
+    rollups.ensure_tables()
+    rollups.refresh(force=True)
+    merged = _rows(shards.fetch_rollup(ROLLUP_QUERIES[title]))
+    single = _rows(query_frame(pool, ROLLUP_QUERIES[title]))
+    if title in TOP:
+        # ties at the cut may come back in either order
+        assert sorted(row[-1] for row in merged) == sorted(row[-1] for row in single)
+    else:
+        assert merged == single
+
+
+def test_predictor_counts_every_shard(shards, pool):
+    sharded = ShardedPredictionIndex(shards)
+    sharded.refresh(force=True)
+    single = PredictionIndex(pool)
+    single.refresh(force=True)
+    for features in [("Male", 30, 0, "10:15:00", 0), ("F", 19, 1, "23:59:59", 1), ("M", 70, 0, "03:00:00", 1)]:
+        assert sharded.predict(*features) == single.predict(*features)
+
+
+def test_approx_samples_every_shard(shards):
+    shards.ensure_rollups()
+    shards.refresh_rollups(force=True)
+    approx = ShardedApproxAnalytics(shards, replicates=2)
+    approx.refresh(force=True)
+    assert approx.stats()["population"] == 3000
+    # every stratum fits its reservoir, so the estimate is the exact answer
+    query = ROLLUP_QUERIES["Gender Distribution of Drivers Stopped in each Country"]
+    assert _rows(approx.estimate(query).result) == _rows(shards.fetch_rollup(query))
+
+
+def test_alerts_watch_every_shard(shards):
+    alerts = ShardedAlertEngine(shards)
+    alerts.ensure_tables()
+    alerts.load()
+    alerts.flag("zz-99*", "stolen")
+    for shard in shards.shards:
+        assert query_rows(shard.pool, "SELECT pattern FROM policedb.watchlist") == [("ZZ99*",)]
+
+    usa, rest = shards.shards
+    log_id = _add_stop(rest, "ZZ99XY0001")
+    hits = alerts.scan_new()
+    assert [(hit.vehicle_number, hit.log_id) for hit in hits] == [("ZZ99XY0001", f"rest:{log_id}")]
+    assert alerts.recent_hits() == hits
+    # a reload reads the same watchlist back
+    alerts.load()
+    assert alerts.watchlist() == [("ZZ99*", "stolen", "pattern")]
+
+
+def test_sharded_alerts_pick_up_flags_from_another_engine(shards):
+    alerts, other = ShardedAlertEngine(shards), ShardedAlertEngine(shards)
+    for engine in (alerts, other):
+        engine.ensure_tables()
+        engine.load()
+    other.flag("ZZ98XY0001", "stolen")
+    log_id = _add_stop(shards.shards[0], "ZZ98XY0001")
+    assert [(hit.vehicle_number, hit.log_id) for hit in alerts.scan_new()] == [("ZZ98XY0001", f"usa:{log_id}")]
+
+
+def test_repeat_offenders_add_up_across_shards(shards, pool):
+    shards.ensure_rollups()
+    shards.refresh_rollups(force=True)
+    rollups = Rollups(pool)
+    rollups.ensure_tables()
+    rollups.refresh(force=True)
+    sharded, single = ShardedAlertEngine(shards), AlertEngine(pool)
+    for alerts in (sharded, single):
+        alerts.ensure_tables()
+        alerts.load()
+    assert sorted(sharded.promote_repeat_offenders(1, 2)) == sorted(single.promote_repeat_offenders(1, 2))
+
+
+def test_service_runs_without_a_central_database(shards_path, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    service = AnalyticsService(Settings(shards_path=shards_path, host="central-db.invalid"))
+    try:
+        prediction = call(service, {"method": "predict", "params": {
+            "driver_gender": "Female", "driver_age": 30, "search_conducted": 0, "stop_time": "10:00:00",
+            "drugs_related_stop": 0}})
+        assert "result" in prediction, prediction
+        assert "result" in call(service, {"method": "flag", "params": {"pattern": "ZZ99XY0002"}})
+        assert call(service, {"method": "recent_hits"}) == {"id": None, "result": []}
+        # the shard writers scan for watchlist hits when they flush
+        stop = {"stop_date": "2024-02-03", "stop_time": "04:05:06", "country_name": "India", "driver_gender": "M",
+                "driver_age": 30, "violation": "DUI", "search_conducted": "0", "stop_outcome": "Arrest",
+                "is_arrested": True, "drugs_related_stop": "1", "vehicle_number": "ZZ99XY0002"}
+        assert call(service, {"method": "submit_stop", "params": {"record": stop}})["result"]["watchlist"]
+        service.writer.flush(5.0)
+        hits = call(service, {"method": "recent_hits"})["result"]
+        assert [(hit["vehicle_number"], hit["log_id"].split(":")[0]) for hit in hits] == [("ZZ99XY0002", "rest")]
+        title = "Gender Distribution of Drivers Stopped in each Country"
+        for approximate in (False, True):
+            answer = call(service, {"method": "analysis", "params": {"title": title, "approximate": approximate}})
+            assert answer.get("result", {}).get("rows"), answer
+        assert "pool" not in service._resources
+    finally:
+        service.close()
+
+
+def test_shard_pages_are_monitored_with_their_own_plan(shards_path, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    service = AnalyticsService(Settings(shards_path=shards_path, slow_query_ms=0.0))
+    try:
+        _, _, plans, _, _ = service.plan_search(vehicle="TN1", country="usa")
+        service.browse(plans=plans)
+        records = service.monitor.recent()
+    finally:
+        service.close()
+    assert {(r.label, r.source) for r in records} >= {
+        ("search/plate candidates", "shard:usa"), ("browse/page by stop_date", "shard:usa"),
+        ("browse/approximate count", "shard:usa")}
+    # each EXPLAIN ran on the shard that ran the statement
+    shard_records = [r for r in records if r.source.startswith("shard:")]
+    assert all(r.plan and not r.plan.startswith("EXPLAIN failed") for r in shard_records)
@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from conftest import query_rows
+from db_pool import PoolTimeout
+from write_queue import InvalidStop, StopWriter, validate_stop
+
+
+class FlakyPool:
+    # the real pool, or PoolTimeout while the database is "down"
+    def __init__(self, pool):
+        self.pool = pool
+        self.down = False
+
+    @contextmanager
+    def connection(self):
+        if self.down:
+            raise PoolTimeout("database down")
+        with self.pool.connection() as conn:
+            yield conn
+
+
+def _stop(plate, **values):
+    return {"stop_date": "2024-02-03", "stop_time": "04:05:06", "country_name": "India", "driver_gender": "M",
+            "driver_age": 30, "violation": "DUI", "search_conducted": "0", "stop_outcome": "Arrest",
+            "is_arrested": True, "drugs_related_stop": "1", "vehicle_number": plate, **values}
+
+
+def _plates(pool):
+    return [row[0] for row in query_rows(pool, "SELECT vehicle_number FROM policedb.logs WHERE id > 3000 ORDER BY id")]
+
+
+def _wait(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def make_writer(tmp_path):
+    writers = []
+
+    def make(pool, **options):
+        options = {"batch_size": 10, "flush_interval": 0.05, "max_backoff": 0.1,
+                   "spool_path": str(tmp_path / "spool.jsonl"), "dead_letter_path": str(tmp_path / "dead.jsonl"),
+                   **options}
+        writer = StopWriter(pool, **options)
+        writers.append(writer)
+        return writer
+    yield make
+    for writer in writers:
+        writer.close(timeout=5)
+
+
+def test_batches_are_written_in_order(pool, make_writer):
+    flushed = []
+    writer = make_writer(pool, on_flush=[flushed.append])
+    for i in range(25):
+        writer.submit(_stop(f"TN00QQ{i:04d}"))
+    assert writer.flush(timeout=10)
+    assert _plates(pool) == [f"TN00QQ{i:04d}" for i in range(25)]
+    assert sum(len(rows) for rows in flushed) == 25
+
+
+def test_invalid_stops_are_refused_before_queueing(pool, make_writer):
+    writer = make_writer(pool)
+    with pytest.raises(InvalidStop):
+        writer.submit(_stop("TN00QQ0001", driver_age="old"))
+    with pytest.raises(InvalidStop):
+        writer.submit(_stop(""))
+
+
+def test_spooled_stops_are_replayed_in_order(pool, make_writer, tmp_path):
+    flaky = FlakyPool(pool)
+    flaky.down = True
+    writer = make_writer(flaky)
+    for i in range(15):
+        writer.submit(_stop(f"TN00SP{i:04d}"))
+    assert writer.flush(timeout=30)
+    assert writer.stats()["spooled"] == 15 and os.path.exists(tmp_path / "spool.jsonl")
+    flaky.down = False
+    writer.submit(_stop("TN00SP9999"))
+    _wait(lambda: len(_plates(pool)) == 16)
+    assert _plates(pool) == [f"TN00SP{i:04d}" for i in range(15)] + ["TN00SP9999"]
+    assert not os.path.exists(tmp_path / "spool.jsonl")
+
+
+def test_refused_rows_are_dead_lettered_and_the_rest_written(pool, make_writer, tmp_path):
+    with pool.connection() as conn:
+        conn.execute("CREATE TRIGGER policedb.refuse_bad BEFORE INSERT ON logs "
+                     "WHEN NEW.vehicle_number = 'BAD' BEGIN SELECT RAISE(ABORT, 'refused'); END")
+        conn.commit()
+    writer = make_writer(pool, max_attempts=2)
+    for plate in ["TN00DL0001", "BAD", "TN00DL0002"]:
+        writer.submit(_stop(plate))
+    assert writer.flush(timeout=30)
+    # later stops are not stuck behind the refused one
+    writer.submit(_stop("TN00DL0003"))
+    _wait(lambda: writer.stats()["dead_lettered"] == 1 and len(_plates(pool)) == 3)
+    _wait(lambda: not os.path.exists(tmp_path / "spool.jsonl"))
+    assert _plates(pool) == ["TN00DL0001", "TN00DL0002", "TN00DL0003"]
+    dead = [json.loads(line) for line in open(tmp_path / "dead.jsonl")]
+    assert [entry["row"][-1] for entry in dead] == ["BAD"] and "refused" in dead[0]["error"]
+
+
+def test_lost_rows_and_callback_errors_are_logged(pool, make_writer, caplog):
+    flaky = FlakyPool(pool)
+    flaky.down = True
+    writer = make_writer(flaky, spool_path=None)
+    with caplog.at_level(logging.ERROR, logger="write_queue"):
+        writer.submit(_stop("TN00LG0001"))
+        assert writer.flush(timeout=30)
+    assert writer.stats()["dropped"] == 1
+    assert any("TN00LG0001" in record.getMessage() for record in caplog.records)
+
+    def broken(rows):
+        raise RuntimeError("cache gone")
+
+    writer = make_writer(pool, on_flush=[broken])
+    with caplog.at_level(logging.ERROR, logger="write_queue"):
+        writer.submit(_stop("TN00LG0002"))
+        assert writer.flush(timeout=10)
+    assert _plates(pool) == ["TN00LG0002"]
+    assert any("cache gone" in (record.exc_text or "") or record.exc_info for record in caplog.records)
+
+
+def test_writers_sharing_a_spool_replay_it_once(pool, make_writer, tmp_path):
+    rows = [validate_stop(_stop(f"TN00SS{i:04d}")) for i in range(200)]
+    (tmp_path / "spool.jsonl").write_text("".join(json.dumps(row) + "\n" for row in rows), encoding="utf-8")
+    # two processes pointed at the same spool: the lock lets one replay it, the other finds it gone
+    writers = [make_writer(pool) for _ in range(2)]
+    _wait(lambda: not os.path.exists(tmp_path / "spool.jsonl"))
+    for writer in writers:
+        assert writer.flush(timeout=10)
+    assert _plates(pool) == [f"TN00SS{i:04d}" for i in range(200)]
+    assert sum(writer.stats()["written"] for writer in writers) == 200
@@ -0,0 +1,116 @@
+import bisect
+import time
+
+from db_pool import adapt_query
+
+#id watermarks that don't skip rows committed out of id order
+
+# a transaction can take an id before another one that commits first (the bulk loader next to the
+# write queue), so ids missing below the watermark when their range is read are kept as gaps and read
+# again until they show up; rolled-back inserts and deleted rows leave gaps that never fill, they expire
+GAP_TTL = 600.0
+MAX_GAPS = 1000
+
+GAPS_DDL = (
+    "CREATE TABLE IF NOT EXISTS policedb.watermark_gaps ("
+    "name VARCHAR(50) NOT NULL, low INT NOT NULL, high INT NOT NULL, seen_at DOUBLE NOT NULL, "
+    "PRIMARY KEY (name, low))"
+)
+
+
+def missing_runs(ids, low, high):
+    # (first, last) runs of ids in (low, high] that are not in the sorted ids
+    runs = []
+    expected = low + 1
+    for i in ids:
+        if i > expected:
+            runs.append((expected, i - 1))
+        expected = max(expected, i + 1)
+    if expected <= high:
+        runs.append((expected, high))
+    return runs
+
+
+def read_runs(cursor, dialect, table, low, high):
+    # (rows, missing runs) of the ids in (low, high], the ids themselves are only read when some are missing
+    cursor.execute(adapt_query(f"SELECT COUNT(*) FROM {table} WHERE id > %s AND id <= %s", dialect), (low, high))
+    rows = cursor.fetchone()[0]
+    if rows == high - low:
+        return rows, []
+    cursor.execute(adapt_query(f"SELECT id FROM {table} WHERE id > %s AND id <= %s ORDER BY id", dialect), (low, high))
+    return rows, missing_runs([row[0] for row in cursor.fetchall()], low, high)
+
+
+def between(runs, column="id"):
+    # (sql, params) matching the ids of the runs
+    sql = " OR ".join(f"{column} BETWEEN %s AND %s" for _ in runs)
+    return f"({sql})", [bound for run in runs for bound in run[:2]]
+
+
+class Watermark:
+
+    def __init__(self, last_id=0, gaps=(), gap_ttl=GAP_TTL):
+        self.last_id = last_id
+        self.gap_ttl = gap_ttl
+        # [low, high, seen_at]: ids low..high were missing when their range was read at seen_at
+        self.gaps = [list(gap) for gap in gaps]
+
+    def copy(self):
+        return Watermark(self.last_id, self.gaps, self.gap_ttl)
+
+    def covered(self):
+        # every id up to here has been read, bar expired gaps
+        if self.gaps:
+            return min(self.last_id, min(gap[0] for gap in self.gaps) - 1)
+        return self.last_id
+
+    def missing(self):
+        return sum(high - low + 1 for low, high, _ in self.gaps)
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        gaps = [gap for gap in self.gaps if now - gap[2] < self.gap_ttl]
+        self.gaps = sorted(gaps, key=lambda gap: gap[2])[-MAX_GAPS:]
+
+    def gap_filter(self, column="id"):
+        # (sql, params) for the rows still to read below the watermark, None without gaps
+        self.expire()
+        if not self.gaps:
+            return None
+        return between(self.gaps, column)
+
+    def advance(self, high, runs=(), now=None):
+        # ids up to high have been read except the missing runs in between, which become gaps
+        now = time.time() if now is None else now
+        self.gaps.extend([low, last, now] for low, last in runs)
+        # late commits land near the top, the oldest gaps go first
+        self.gaps = self.gaps[-MAX_GAPS:]
+        self.last_id = max(self.last_id, high)
+
+    def advance_to(self, ids, high, now=None):
+        # the sorted ids are everything read from (last_id, high]
+        self.advance(high, missing_runs(ids, self.last_id, high), now)
+
+    def fill(self, ids):
+        # the sorted ids were read late, what is left of their gaps stays open
+        gaps = []
+        for low, high, seen_at in self.gaps:
+            inside = ids[bisect.bisect_left(ids, low):bisect.bisect_right(ids, high)]
+            gaps.extend([first, last, seen_at] for first, last in missing_runs(inside, low - 1, high))
+        self.gaps = gaps
+
+
+#gaps of watermarks kept in the database next to their last_id
+
+def load_gaps(cursor, dialect, name):
+    cursor.execute(adapt_query("SELECT low, high, seen_at FROM policedb.watermark_gaps WHERE name = %s", dialect),
+                   (name,))
+    return [list(row) for row in cursor.fetchall()]
+
+
+def save_gaps(cursor, dialect, name, gaps):
+    cursor.execute(adapt_query("DELETE FROM policedb.watermark_gaps WHERE name = %s", dialect), (name,))
+    if gaps:
+        cursor.executemany(adapt_query(
+            "INSERT INTO policedb.watermark_gaps (name, low, high, seen_at) VALUES (%s, %s, %s, %s)", dialect),
+            [(name, low, high, seen_at) for low, high, seen_at in gaps])
@@ -0,0 +1,334 @@
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+from db_pool import PoolTimeout, adapt_query, dialect_of, is_disconnect
+from schema import COLUMN_TYPES, LOG_COLUMNS, insert_sql
+
+#write-behind queue for new stops: validate, buffer, flush in batched transactions
+
+log = logging.getLogger(__name__)
+
+# MySQL errors that mean "try again later" rather than "this row is refused":
+# too many connections, can't connect, lock wait timeout, deadlock
+UNAVAILABLE_CODES = {1040, 1205, 1213, 2003}
+
+class InvalidStop(ValueError):
+    pass
+
+
+class WriterBusy(Exception):
+    pass
+
+
+#validation against the logs schema
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value))
+
+
+def _as_time(value):
+    if isinstance(value, datetime.datetime):
+        return value.time().replace(microsecond=0)
+    if isinstance(value, datetime.time):
+        return value.replace(microsecond=0)
+    return datetime.time.fromisoformat(str(value))
+
+
+def _as_flag(value):
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ("1", "true", "yes"):
+            return 1
+        if value in ("0", "false", "no"):
+            return 0
+        raise ValueError(f"not a yes/no value: {value!r}")
+    return 1 if int(value) else 0
+
+
+def validate_stop(record):
+    unknown = set(record) - set(LOG_COLUMNS)
+    if unknown:
+        raise InvalidStop(f"unknown columns: {', '.join(sorted(unknown))}")
+    row = []
+    for column in LOG_COLUMNS:
+        value = record.get(column)
+        if value is None or value == "":
+            row.append(None)
+            continue
+        kind, length = COLUMN_TYPES[column]
+        try:
+            if kind == "date":
+                value = _as_date(value).isoformat()
+            elif kind == "time":
+                value = _as_time(value).strftime("%H:%M:%S")
+            elif kind == "int":
+                value = int(value)
+            elif kind == "bool":
+                value = _as_flag(value)
+            else:
+                value = str(value).strip()
+                if len(value) > length:
+                    raise ValueError(f"longer than {length} characters")
+        except (TypeError, ValueError) as e:
+            raise InvalidStop(f"{column}: {e}") from None
+        row.append(value)
+    if row[LOG_COLUMNS.index("vehicle_number")] is None:
+        raise InvalidStop("vehicle_number is required")
+    return tuple(row)
+
+
+def is_unavailable(error):
+    if isinstance(error, PoolTimeout) or is_disconnect(error):
+        return True
+    if error.args and error.args[0] in UNAVAILABLE_CODES:
+        return True
+    # sqlite reports a busy database file as "database is locked"
+    return "locked" in str(error).lower()
+
+
+@contextmanager
+def _locked(path):
+    # exclusive across processes, a second writer on the same spool waits for the replay to finish
+    # instead of replaying and rewriting it at the same time
+    with open(path + ".lock", "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class StopWriter:
+
+    def __init__(self, pool, batch_size=500, flush_interval=1.0, max_pending=10000,
+                 spool_path="pending_stops.jsonl", on_flush=None, max_backoff=30.0,
+                 dead_letter_path="dead_stops.jsonl", max_attempts=3):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.max_backoff = max_backoff
+        # spooled rows the database refuses max_attempts replays in a row are moved to dead_letter_path
+        self.dead_letter_path = dead_letter_path
+        self.max_attempts = max_attempts
+        self._attempts = {}
+        # on_flush(rows) runs after each committed batch (cache invalidation, index updates)
+        self.on_flush = on_flush or []
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._stats = {"submitted": 0, "written": 0, "batches": 0, "failures": 0, "spooled": 0, "rejected": 0,
+                       "dead_lettered": 0, "dropped": 0}
+        self._thread = threading.Thread(target=self._run, name="stop-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, record, timeout=2.0):
+        # backpressure: callers block while the queue is full and get WriterBusy after timeout
+        row = validate_stop(record)
+        try:
+            self._queue.put(row, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise WriterBusy(f"{self._queue.maxsize} stops are already waiting to be written") from None
+        with self._lock:
+            self._stats["submitted"] += 1
+        return row
+
+    def flush(self, timeout=None):
+        # wait until everything submitted so far is written or spooled
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout=10.0):
+        self.flush(timeout)
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pending"] = self._queue.qsize()
+        stats["spool_exists"] = bool(self.spool_path and os.path.exists(self.spool_path))
+        return stats
+
+    #background writer
+
+    def _next_batch(self):
+        # flush on whichever comes first: batch_size stops or flush_interval seconds
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, rows):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.executemany(adapt_query(insert_sql(), dialect_of(conn)), rows)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        with self._lock:
+            self._stats["written"] += len(rows)
+            self._stats["batches"] += 1
+        for callback in self.on_flush:
+            try:
+                callback(rows)
+            except Exception:
+                # the rows are committed, a failing callback must not spool them again
+                log.exception("on_flush callback %r failed after writing %d stops", callback, len(rows))
+
+    def _write_with_retry(self, rows, attempts=3):
+        # None once written, otherwise the last error
+        delay = 0.5
+        for attempt in range(attempts):
+            try:
+                self._write(rows)
+                return None
+            except Exception as e:
+                error = e
+                with self._lock:
+                    self._stats["failures"] += 1
+                if attempt < attempts - 1:
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_backoff)
+        log.warning("writing %d stops failed: %s", len(rows), error)
+        return error
+
+    def _spool(self, rows):
+        # the database is unavailable: keep the batch on disk and replay it later
+        if not self.spool_path:
+            log.error("no spool file configured, %d unwritten stops are lost: %s",
+                      len(rows), json.dumps(rows))
+            with self._lock:
+                self._stats["dropped"] += len(rows)
+            return
+        with _locked(self.spool_path), open(self.spool_path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self._stats["spooled"] += len(rows)
+
+    def _dead_letter(self, row, error):
+        log.error("stop refused %d times, moved to %s: %s (%s)", self.max_attempts, self.dead_letter_path,
+                  json.dumps(row), error)
+        if self.dead_letter_path:
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"row": row, "error": f"{type(error).__name__}: {error}",
+                                    "at": datetime.datetime.now().isoformat()}) + "\n")
+        with self._lock:
+            self._stats["dead_lettered"] += 1
+
+    def _write_singly(self, rows):
+        # the database is up but refused the batch: write row by row so only the refused rows stay behind,
+        # returns (rows still to write, whether the database became unavailable)
+        kept = []
+        for index, row in enumerate(rows):
+            error = self._write_with_retry([row], attempts=1)
+            if error is None:
+                self._attempts.pop(row, None)
+                continue
+            if is_unavailable(error):
+                return kept + rows[index:], True
+            attempts = self._attempts.pop(row, 0) + 1
+            if attempts >= self.max_attempts:
+                self._dead_letter(row, error)
+            else:
+                self._attempts[row] = attempts
+                kept.append(row)
+        return kept, False
+
+    def _replay_spool(self):
+        if not self.spool_path or not os.path.exists(self.spool_path):
+            return True
+        with _locked(self.spool_path):
+            return self._replay_locked()
+
+    def _replay_locked(self):
+        if not os.path.exists(self.spool_path):
+            # another writer replayed it while we waited for the lock
+            return True
+        with open(self.spool_path, encoding="utf-8") as f:
+            rows = [tuple(json.loads(line)) for line in f if line.strip()]
+        kept = []
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            error = self._write_with_retry(batch, attempts=1)
+            if error is None:
+                continue
+            unavailable = is_unavailable(error)
+            if not unavailable:
+                batch, unavailable = self._write_singly(batch)
+            kept.extend(batch)
+            if unavailable:
+                kept.extend(rows[start + self.batch_size:])
+                break
+        if kept:
+            # keep what is still unwritten for the next attempt
+            tmp_path = self.spool_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for row in kept:
+                    f.write(json.dumps(row) + "\n")
+            os.replace(tmp_path, self.spool_path)
+            return False
+        os.remove(self.spool_path)
+        return True
+
+    def _run(self):
+        backoff = self.flush_interval
+        spool_ok = self._replay_spool()
+        next_replay = time.monotonic() + backoff
+        while not (self._stop.is_set() and self._queue.empty()):
+            if not spool_ok and time.monotonic() >= next_replay:
+                spool_ok = self._replay_spool()
+                backoff = self.flush_interval if spool_ok else min(backoff * 2, self.max_backoff)
+                next_replay = time.monotonic() + backoff
+            batch = self._next_batch()
+            if not batch:
+                continue
+            # while older stops sit in the spool, new ones queue up behind them
+            if not spool_ok or self._write_with_retry(batch) is not None:
+                self._spool(batch)
+                spool_ok = False
+            for _ in batch:
+                self._queue.task_done()